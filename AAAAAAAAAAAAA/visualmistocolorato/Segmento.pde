@@ -1,5 +1,8 @@
 class Segmento {
+  int id = -1;
   String categoria;
   String testo;
+  boolean streamed = false;  // arrivato frase per frase (/sentence): voice_server.py lo sta già leggendo
   Segmento(String c, String t) { categoria = c; testo = t; }
+  Segmento(int i, String c, String t) { id = i; categoria = c; testo = t; streamed = true; }
 }
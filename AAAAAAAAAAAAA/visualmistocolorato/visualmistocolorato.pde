@@ -165,10 +165,16 @@ void loadNextSegment() {
   calculatePages(); 
   loadPage(0);    
   
-  OscMessage msgVoce = new OscMessage("/speak");
-  msgVoce.add(seg.testo); // Aggiunge il testo al messaggio
-  oscP5.send(msgVoce, pythonVoiceLocation); // Spedisce a Python (porta 12001)
-  println(">>> COMANDO VOCALE INVIATO PER: " + seg.testo);
+  if (seg.streamed) {
+    // Prima lettura di un frammento in streaming: la voce è già partita dalle /sentence
+    // (--osc_stream ... 127.0.0.1:5006); dal giro successivo si usa /speak come sempre
+    seg.streamed = false;
+  } else {
+    OscMessage msgVoce = new OscMessage("/speak");
+    msgVoce.add(seg.testo); // Aggiunge il testo al messaggio
+    oscP5.send(msgVoce, pythonVoiceLocation); // Spedisce a Python (porta 12001)
+    println(">>> COMANDO VOCALE INVIATO PER: " + seg.testo);
+  }
   
   // DEBUG: Controlliamo se ha creato le parole volanti
   println(">>> PAROLE CREATE: " + wordsObjects.size());
@@ -306,6 +312,28 @@ void oscEvent(OscMessage msg) {
     return;
   }
   
+  // Frase in streaming (story_from_description.py --osc_stream): [id, categoria, frase]
+  // Le frasi dello stesso frammento si accodano al suo segmento.
+  if (msg.checkAddrPattern("/sentence")) {
+    int id = msg.get(0).intValue();
+    String cat = msg.get(1).stringValue();
+    String txt = msg.get(2).stringValue();
+    Segmento last = playlist.size() > 0 ? playlist.get(playlist.size() - 1) : null;
+    if (last != null && last.id == id) {
+      last.testo = last.testo + " " + txt;
+    } else {
+      playlist.add(new Segmento(id, cat, txt));
+    }
+    println(">>> Frase " + id + ": " + txt);
+    if (!isPlaying) {
+      // si parte dalla prima frase, senza aspettare /start
+      println(">>> START (prima frase)");
+      isPlaying = true;
+      lastSegmentTime = millis() - (int)(slideDuration*1000);
+    }
+    return;
+  }
+  
   if (msg.checkAddrPattern("/start")) {
     if (playlist.size() > 0) {
       println(">>> START!");
@@ -1,7 +1,16 @@
+import argparse
 import asyncio
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
 import edge_tts
 import pygame
-import os
 from pythonosc.dispatcher import Dispatcher
 from pythonosc.osc_server import BlockingOSCUDPServer
 
@@ -11,54 +20,245 @@ from pythonosc.osc_server import BlockingOSCUDPServer
 # "en-US-GuyNeural" (Più casual, standard)
 # "en-US-EricNeural" (Energico)
 # "en-GB-RyanNeural" (Britannico)
-VOICE = "en-US-ChristopherNeural" 
-OUTPUT_FILE = "temp_voice.mp3"
+VOICE = "en-US-ChristopherNeural"
+CACHE_DIR = Path(__file__).resolve().parent / "voice_cache"  # un mp3 per frammento, riusato tra un'esecuzione e l'altra
 
-# Inizializza audio background
-pygame.mixer.init()
 
 # Funzione asincrona per generare l'audio con Edge
 async def generate_edge_audio(text, output_file):
     communicate = edge_tts.Communicate(text, VOICE)
     await communicate.save(output_file)
 
-def speak_handler(address, *args):
-    text_to_read = args[0]
-    print(f"🗣️  [Christopher]: {text_to_read}")
-    
-    try:
-        # 1. Ferma e libera l'audio precedente
-        if pygame.mixer.music.get_busy():
-            pygame.mixer.music.stop()
-        pygame.mixer.music.unload()
-        
-        # 2. Cancella il vecchio file se esiste (per sicurezza su Windows)
-        if os.path.exists(OUTPUT_FILE):
+
+def fragment_key(text: str) -> str:
+    """Chiave del frammento: voce + testo (spazi normalizzati, come in story.json)."""
+    norm = " ".join(text.split())
+    return hashlib.sha1(f"{VOICE}|{norm}".encode("utf-8")).hexdigest()[:16]
+
+
+class PreRenderer:
+    """
+    Sintesi in background: ogni frammento noto (/segment o story.json) viene
+    generato in anticipo in CACHE_DIR/<chiave>.mp3, al massimo `workers` alla
+    volta, su un event loop asyncio in un thread dedicato. /speak trova il file
+    già pronto (o aspetta solo quello che manca).
+    """
+
+    def __init__(self, workers: int = 3):
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        self.loop = asyncio.new_event_loop()
+        self.jobs = {}  # chiave -> concurrent.futures.Future con il percorso dell'mp3
+        self.prefetched = set()  # chiavi richieste da story.json / /segment: mai annullate
+        self.lock = threading.Lock()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.slots = asyncio.run_coroutine_threadsafe(self._make_slots(workers), self.loop).result()
+
+    @staticmethod
+    async def _make_slots(workers: int) -> asyncio.Semaphore:
+        return asyncio.Semaphore(max(1, workers))
+
+    async def _render(self, text: str, path: Path, urgent: bool) -> Path:
+        if urgent:
+            # testo chiesto da /speak e mai pre-generato: non fa la coda dietro ai frammenti futuri
+            await self._synthesize(text, path)
+        else:
+            async with self.slots:
+                await self._synthesize(text, path)
+        return path
+
+    @staticmethod
+    async def _synthesize(text: str, path: Path) -> None:
+        if path.exists():
+            return
+        tmp = path.with_suffix(".part")
+        try:
+            await generate_edge_audio(text, str(tmp))
+            os.replace(tmp, path)  # mai un mp3 a metà in cache
+        finally:
+            if tmp.exists():
+                tmp.unlink()  # sintesi annullata o fallita
+
+    def submit(self, text: str, urgent: bool = False):
+        """Avvia (una volta sola) la sintesi di text; ritorna il Future del suo mp3."""
+        key = fragment_key(text)
+        with self.lock:
+            if not urgent:
+                self.prefetched.add(key)
+            job = self.jobs.get(key)
+            if job is None or (job.done() and (job.cancelled() or job.exception() is not None)):
+                path = CACHE_DIR / f"{key}.mp3"
+                job = asyncio.run_coroutine_threadsafe(self._render(text, path, urgent), self.loop)
+                self.jobs[key] = job
+            return job
+
+    def cancel(self, text: str) -> bool:
+        """Annulla la sintesi di un testo non più richiesto (mai quella di un frammento pre-generato)."""
+        key = fragment_key(text)
+        with self.lock:
+            job = self.jobs.get(key)
+            if key in self.prefetched or job is None or job.done():
+                return False
+            del self.jobs[key]
+        return job.cancel()
+
+    def submit_story(self, story_json: str) -> int:
+        data = json.loads(Path(story_json).read_text(encoding="utf-8"))
+        fragments = [str(item["text"]) for item in data["fragments"] if str(item.get("text", "")).strip()]
+        for text in fragments:
+            self.submit(text)
+        return len(fragments)
+
+
+class Player:
+    """
+    Coda di riproduzione su un thread dedicato (l'unico che tocca pygame), così
+    gli handler OSC ritornano subito e il server può riceverli in ordine su un solo thread.
+      - interrupt: svuota la coda, ferma la frase in corso, annulla le sintesi
+        ormai inutili e legge subito il nuovo testo
+      - enqueue:   il testo viene letto dopo quelli già in coda
+    """
+
+    POLL_S = 0.05
+
+    def __init__(self, renderer: PreRenderer):
+        self.renderer = renderer
+        self.queue = deque()  # (testo, Future dell'mp3)
+        self.current = None
+        self.generation = 0  # cambia a ogni interrupt / stop: la frase in corso è superata
+        self.cond = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def speak(self, text: str, mode: str) -> None:
+        with self.cond:
+            if mode == "interrupt":
+                self._drop_all()  # prima di submit: non deve annullare la sintesi appena chiesta
+            job = self.renderer.submit(text, urgent=True)
+            self.queue.append((text, job))
+            self.cond.notify()
+
+    def stop(self) -> None:
+        with self.cond:
+            self._drop_all()
+
+    def _drop_all(self) -> None:
+        # da chiamare con self.cond acquisito
+        stale = [text for text, _ in self.queue]
+        if self.current is not None:
+            stale.append(self.current)
+        self.queue.clear()
+        self.generation += 1
+        for text in stale:
+            if self.renderer.cancel(text):
+                print(f"✂️  Sintesi annullata: {text[:60]}")
+
+    def _run(self) -> None:
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                text, job = self.queue.popleft()
+                self.current, gen = text, self.generation
+
             try:
-                os.remove(OUTPUT_FILE)
-            except PermissionError:
-                print("⚠️  Impossibile rimuovere il file precedente (ancora in uso?)")
-
-        # 3. Genera il nuovo audio (chiamata asincrona dentro codice sincrono)
-        asyncio.run(generate_edge_audio(text_to_read, OUTPUT_FILE))
-        
-        # 4. Riproduci
-        pygame.mixer.music.load(OUTPUT_FILE)
-        pygame.mixer.music.play()
-        
-    except Exception as e:
-        print(f"❌ Errore Audio: {e}")
-
-# Configurazione Server OSC
-dispatcher = Dispatcher()
-dispatcher.map("/speak", speak_handler)
-
-ip = "127.0.0.1"
-port = 5006
-
-print(f"🎤 Server Vocale EDGE (Maschile) in ascolto su {ip}:{port}")
-print(f"🔊 Voce selezionata: {VOICE}")
-
-# Avvio server
-server = BlockingOSCUDPServer((ip, port), dispatcher)
-server.serve_forever()
\ No newline at end of file
+                # 1. mp3 del frammento: pronto se pre-generato, altrimenti si aspetta la sua sintesi
+                if not job.done():
+                    print("⏳ Frammento non ancora pronto, attendo la sintesi...")
+                while gen == self.generation and not job.done():
+                    concurrent.futures.wait([job], timeout=self.POLL_S)
+                if gen != self.generation or job.cancelled():
+                    continue
+                path = job.result()
+
+                # 2. Ferma e libera l'audio precedente, poi riproduci
+                print(f"🗣️  [Christopher]: {text}")
+                if pygame.mixer.music.get_busy():
+                    pygame.mixer.music.stop()
+                pygame.mixer.music.unload()
+                pygame.mixer.music.load(str(path))
+                pygame.mixer.music.play()
+
+                # 3. Resta sulla frase finché finisce o arriva un interrupt
+                while pygame.mixer.music.get_busy() and gen == self.generation:
+                    time.sleep(self.POLL_S)
+                if gen != self.generation:
+                    pygame.mixer.music.stop()
+
+            except Exception as e:
+                print(f"❌ Errore Audio: {e}")
+            finally:
+                with self.cond:
+                    self.current = None
+
+
+renderer = None
+player = None
+SPEAK_MODE = "interrupt"
+
+
+def segment_handler(address, *args):
+    # /segment [categoria, testo]: frammento noto in anticipo -> si pre-genera
+    if len(args) >= 2:
+        renderer.submit(str(args[1]))
+
+
+def speak_handler(address, *args):
+    # /speak segue --on_speak; /speak/now interrompe sempre, /speak/queue accoda sempre
+    if not args:
+        return
+    mode = {"/speak/now": "interrupt", "/speak/queue": "enqueue"}.get(address, SPEAK_MODE)
+    player.speak(str(args[0]), mode)
+
+
+def sentence_handler(address, *args):
+    # /sentence [id, categoria, frase] (story_from_description.py --osc_stream): la voce parte
+    # dalla prima frase mentre il resto del frammento è ancora in generazione
+    if len(args) >= 3:
+        player.speak(str(args[2]), "enqueue")
+
+
+def stop_handler(address, *args):
+    player.stop()
+    print("⏹️  Stop: coda svuotata")
+
+
+def main():
+    global renderer, player, SPEAK_MODE
+
+    ap = argparse.ArgumentParser(description="Server vocale OSC (edge-tts) con pre-generazione dei frammenti.")
+    ap.add_argument("--ip", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=5006)
+    ap.add_argument("--story", default=None, help="story.json: pre-genera subito la voce di tutti i frammenti")
+    ap.add_argument("--workers", type=int, default=3, help="Sintesi edge-tts in parallelo")
+    ap.add_argument("--on_speak", choices=["interrupt", "enqueue"], default="interrupt",
+                    help="/speak interrompe la frase in corso (default) o si mette in coda")
+    args = ap.parse_args()
+    SPEAK_MODE = args.on_speak
+
+    # Inizializza audio background
+    pygame.mixer.init()
+    renderer = PreRenderer(args.workers)
+    player = Player(renderer)
+    if args.story:
+        n = renderer.submit_story(args.story)
+        print(f"⏳ Pre-generazione di {n} frammenti da {args.story} in {CACHE_DIR}/")
+
+    # Configurazione Server OSC: gli handler accodano e ritornano subito
+    dispatcher = Dispatcher()
+    dispatcher.map("/speak", speak_handler)
+    dispatcher.map("/speak/now", speak_handler)
+    dispatcher.map("/speak/queue", speak_handler)
+    dispatcher.map("/stop", stop_handler)
+    dispatcher.map("/segment", segment_handler)
+    dispatcher.map("/sentence", sentence_handler)
+
+    print(f"🎤 Server Vocale EDGE (Maschile) in ascolto su {args.ip}:{args.port}")
+    print(f"🔊 Voce selezionata: {VOICE} (/speak: {SPEAK_MODE})")
+
+    # Avvio server: un solo thread riceve i messaggi, così /speak/queue resta nell'ordine di arrivo
+    # (gli handler durano ~0.1 ms; sintesi e riproduzione hanno già i loro thread)
+    server = BlockingOSCUDPServer((args.ip, args.port), dispatcher)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,9 @@
 import argparse
+import os
 import subprocess
 import sys
 from pathlib import Path
 
-import librosa
-
 
 def parse_ratio(r: str) -> float:
     """
@@ -49,7 +48,15 @@ def run_pipeline(
     reading_wpm: float = 180.0,
     build_labelbank: bool = False,
     force_labelbank: bool = False,
+    story_model: str = None,
+    model_paths: dict = None,
 ):
+    """
+    model_paths ({model id: local snapshot}, see model_registry.py) runs every
+    stage from local snapshots with the Hugging Face Hub switched off.
+    """
+    import librosa  # after the (cheap) model preflight in __main__
+
     root_dir = Path(__file__).parent.resolve()
     dir_audio_analysis = root_dir / "audioAnalysis"
     dir_story_creation = root_dir / "storyCreation"
@@ -59,6 +66,8 @@ def run_pipeline(
     # Fixed default outputs (as you requested)
     labelbank_path = (dir_audio_analysis / "clap_unified_labelbank.json").resolve()
     clap_out_path = (dir_audio_analysis / "clap_output.json").resolve()
+    label_cache_path = (dir_audio_analysis / "clap_unified_labelbank.emb.npz").resolve()
+    track_index_path = (dir_audio_analysis / "track_index").resolve()
 
     # --- checks ---
     if not dir_audio_analysis.exists():
@@ -97,6 +106,16 @@ def run_pipeline(
 
     py = sys.executable
 
+    # --- offline: stages read pinned local snapshots, never the Hub ---
+    env = None
+    clap_args, story_args = [], ([] if story_model is None else ["--model", story_model])
+    if model_paths:
+        from model_registry import CLAP_MODEL_ID
+
+        env = {**os.environ, "HF_HUB_OFFLINE": "1", "TRANSFORMERS_OFFLINE": "1"}
+        clap_args = ["--clap_path", model_paths[CLAP_MODEL_ID]]
+        story_args += ["--model_path", model_paths[story_model]]
+
     # --- [0/2] labelbank (optional) ---
     try:
         should_build = False
@@ -117,8 +136,11 @@ def run_pipeline(
                     "--max_chars", "100",
                     "--no-context",
                     "--no-ensemble",
+                    "--out_json", str(labelbank_path),
+                    "--out_txt", str(dir_audio_analysis / "clap_unified_labels.txt"),
                 ],
                 cwd=str(root_dir),
+                env=env,
                 check=True
             )
             if not labelbank_path.exists():
@@ -139,11 +161,15 @@ def run_pipeline(
                 "--audio", str(audio_path),
                 "--mode", "embeddings",
                 "--labelbank_json", str(labelbank_path),
+                "--label_cache", str(label_cache_path),
+                "--index", str(track_index_path),
                 "--top_k", "1",
                 "--chunk_s", str(chunk_s),
                 "--out", str(clap_out_path),
+                *clap_args,
             ],
             cwd=str(root_dir),   # run like your terminal command (paths from project root)
+            env=env,
             check=True
         )
 
@@ -169,8 +195,10 @@ def run_pipeline(
                 "--segments", str(clap_out_path),
                 "--words", str(words),
                 "--print_live",
+                *story_args,
             ],
             cwd=str(root_dir),  # same as your terminal usage
+            env=env,
             check=True
         )
 
@@ -198,6 +226,12 @@ def run_pipeline(
         data = json.load(f)
 
 
+    # Server vocale su 5006: pre-genera subito la voce di tutti i frammenti di story.json,
+    # così i /speak di Processing partono senza attendere la sintesi
+    voice_proc = subprocess.Popen(
+        [sys.executable, str(Path(__file__).resolve().parent / "voice_server.py"), "--story", str(json_path)]
+    )
+
     ip = "127.0.0.1"
     port = 5005
     client = udp_client.SimpleUDPClient(ip, port)
@@ -238,70 +272,11 @@ def run_pipeline(
 
     play_song("arabesque1.wav")
 
-    import asyncio
-    import edge_tts
-    import pygame
-    import os
-    from pythonosc.dispatcher import Dispatcher
-    from pythonosc.osc_server import BlockingOSCUDPServer
-
-    # --- CONFIGURAZIONE VOCE ---
-    # Voci Maschili Inglesi consigliate:
-    # "en-US-ChristopherNeural" (Narrativo, profondo, ottimo per storie)
-    # "en-US-GuyNeural" (Più casual, standard)
-    # "en-US-EricNeural" (Energico)
-    # "en-GB-RyanNeural" (Britannico)
-    VOICE = "en-US-ChristopherNeural" 
-    OUTPUT_FILE = "temp_voice.mp3"
-
-    # Inizializza audio background
-    pygame.mixer.init()
-
-    # Funzione asincrona per generare l'audio con Edge
-    async def generate_edge_audio(text, output_file):
-        communicate = edge_tts.Communicate(text, VOICE)
-        await communicate.save(output_file)
-
-    def speak_handler(address, *args):
-        text_to_read = args[0]
-        print(f"  [Christopher]: {text_to_read}")
-        
-        try:
-            # 1. Ferma e libera l'audio precedente
-            if pygame.mixer.music.get_busy():
-                pygame.mixer.music.stop()
-            pygame.mixer.music.unload()
-            
-            # 2. Cancella il vecchio file se esiste (per sicurezza su Windows)
-            if os.path.exists(OUTPUT_FILE):
-                try:
-                    os.remove(OUTPUT_FILE)
-                except PermissionError:
-                    print(" Impossibile rimuovere il file precedente (ancora in uso?)")
-
-            # 3. Genera il nuovo audio (chiamata asincrona dentro codice sincrono)
-            asyncio.run(generate_edge_audio(text_to_read, OUTPUT_FILE))
-            
-            # 4. Riproduci
-            pygame.mixer.music.load(OUTPUT_FILE)
-            pygame.mixer.music.play()
-            
-        except Exception as e:
-            print(f"Errore Audio: {e}")
-
-    # Configurazione Server OSC
-    dispatcher = Dispatcher()
-    dispatcher.map("/speak", speak_handler)
-
-    ip = "127.0.0.1"
-    port = 5006
-
-    print(f" Server Vocale EDGE (Maschile) in ascolto su {ip}:{port}")
-    print(f" Voce selezionata: {VOICE}")
-
-    # Avvio server
-    server = BlockingOSCUDPServer((ip, port), dispatcher)
-    server.serve_forever()
+    # Server vocale (voice_server.py): già avviato prima di /start, qui resta in ascolto
+    try:
+        voice_proc.wait()
+    except KeyboardInterrupt:
+        voice_proc.terminate()
 
 if __name__ == "__main__":
     ap = argparse.ArgumentParser(description="BARD pipeline: CLAP -> story, with ratio-based chunking + reading-based words.")
@@ -310,12 +285,36 @@ if __name__ == "__main__":
     ap.add_argument("--wpm", type=float, default=180.0, help="Reading speed in words-per-minute (used to compute --words).")
     ap.add_argument("--build_labelbank", action="store_true", help="Build labelbank only if you ask (or if missing).")
     ap.add_argument("--force_labelbank", action="store_true", help="Always rebuild labelbank even if it exists.")
+    ap.add_argument("--model_dir", default=None,
+                    help="Directory with local snapshots of every model (or a Hugging Face cache): run fully offline.")
+    ap.add_argument("--models", default=None,
+                    help="JSON registry {model id: local snapshot dir}: run fully offline (see model_registry.py).")
+    ap.add_argument("--story_model", default=None,
+                    help="Story LLM id (default: the story script's own, Mistral-7B-Instruct-v0.2 with CUDA, "
+                         "Qwen2.5-1.5B-Instruct without).")
     args = ap.parse_args()
 
+    model_paths = None
+    if args.model_dir or args.models:
+        from model_registry import CLAP_MODEL_ID, default_story_model, preflight
+
+        args.story_model = args.story_model or default_story_model()
+        try:
+            model_paths = preflight(
+                [("CLAP", CLAP_MODEL_ID, "clap"), ("story", args.story_model, "causal-lm")],
+                model_dir=args.model_dir,
+                registry_path=args.models,
+            )
+        except (FileNotFoundError, ValueError) as e:
+            print(f"ERRORE: {e}")
+            sys.exit(1)
+
     run_pipeline(
         audio_file=args.audio,
         ratio_str=args.ratio,
         reading_wpm=args.wpm,
         build_labelbank=args.build_labelbank,
         force_labelbank=args.force_labelbank,
+        story_model=args.story_model,
+        model_paths=model_paths,
     )
\ No newline at end of file
@@ -1,9 +1,15 @@
+import hashlib
+import itertools
 import json
+import math
+import os
 import re
 import urllib.request
 from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import random
 import argparse
+from pathlib import Path
 
 ONTOLOGY_URL = "https://raw.githubusercontent.com/audioset/ontology/master/ontology.json"
 
@@ -179,35 +185,6 @@ def extract_instrument_and_genre_terms(leaf_labels):
     return instruments, genres
 
 
-def choose_instrument_phrase(rng: random.Random, instruments, p_include: float = 0.80):
-    if (not instruments) or (rng.random() > p_include):
-        return ""
-    k = 1 if rng.random() < 0.75 else 2
-    picks = rng.sample(instruments, k=min(k, len(instruments)))
-
-    if len(picks) == 1:
-        inst = picks[0]
-        style = rng.choice([
-            f"featuring {inst}",
-            f"with prominent {inst}",
-            f"centered on {inst}",
-        ])
-        return style
-
-    inst_a, inst_b = picks[0], picks[1]
-    return rng.choice([
-        f"featuring {inst_a} and {inst_b}",
-        f"interplay between {inst_a} and {inst_b}",
-    ])
-
-
-def choose_genre_phrase(rng: random.Random, genres, p_include: float = 0.65):
-    if (not genres) or (rng.random() > p_include):
-        return ""
-    g = rng.choice(genres)
-    return rng.choice([f"{g} feel", f"in a {g} style", f"{g} leaning"])
-
-
 def format_caption(head_parts, body_parts):
     head = ", ".join([p for p in head_parts if p])
     body = "; ".join([p for p in body_parts if p])
@@ -216,36 +193,193 @@ def format_caption(head_parts, body_parts):
     return head or body
 
 
-def shrink_to_max_chars(items, max_chars: int):
+# Separator length between caption parts: head joins with ", ", body and head/body with "; ".
+SEP_LEN = 2
+
+
+def length_table(phrases):
+    """Group unique phrases by length: [(length, [phrases...]), ...] sorted by length."""
+    buckets = {}
+    for p in sorted(set(p for p in phrases if p)):
+        buckets.setdefault(len(p), []).append(p)
+    return sorted(buckets.items())
+
+
+def completion_counts(tables, budget: int):
     """
-    items = list of dicts: {"key":..., "text":..., "prio":...}
-    Higher prio gets dropped first.
+    counts[i][b] = number of phrase combinations drawn from tables[i:] whose
+    total length is <= b. counts[len(tables)] is all ones (empty completion).
     """
-    # Keep only non-empty
-    items = [it for it in items if it["text"]]
-    # Try removing least important until fits
-    while True:
-        head_parts = [it["text"] for it in items if it.get("group") == "head"]
-        body_parts = [it["text"] for it in items if it.get("group") == "body"]
-        s = format_caption(head_parts, body_parts)
-        if len(s) <= max_chars:
-            return s
-
-        # Find droppable with highest prio
-        droppables = sorted(items, key=lambda it: it["prio"], reverse=True)
-        if not droppables:
-            break
-        # drop one
-        items.remove(droppables[0])
-
-    # Last resort: truncate
-    s = format_caption(
-        [it["text"] for it in items if it.get("group") == "head"],
-        [it["text"] for it in items if it.get("group") == "body"],
-    )
-    if len(s) <= max_chars:
-        return s
-    return s[: max(0, max_chars - 1)].rstrip(",; ") + "…"
+    counts = [None] * len(tables) + [[1] * (budget + 1)]
+    for i in range(len(tables) - 1, -1, -1):
+        nxt = counts[i + 1]
+        counts[i] = [
+            sum(len(ps) * nxt[b - n] for n, ps in tables[i] if n <= b)
+            for b in range(budget + 1)
+        ]
+    return counts
+
+
+def instrument_phrase_tables(instruments):
+    singles = []
+    for inst in instruments:
+        singles += [f"featuring {inst}", f"with prominent {inst}", f"centered on {inst}"]
+    pairs = []
+    for inst_a, inst_b in itertools.permutations(instruments, 2):
+        pairs += [f"featuring {inst_a} and {inst_b}", f"interplay between {inst_a} and {inst_b}"]
+    # 75% one instrument, 25% a pair
+    return [(0.75, length_table(singles)), (0.25, length_table(pairs))]
+
+
+def genre_phrase_tables(genres):
+    phrases = []
+    for g in genres:
+        phrases += [f"{g} feel", f"in a {g} style", f"{g} leaning"]
+    return [(1.0, length_table(phrases))]
+
+
+def build_facets(
+    instruments,
+    genres,
+    use_context: bool,
+    use_ensemble: bool,
+    use_instruments: bool,
+    use_genres: bool,
+    use_energy: bool,
+    use_tempo: bool,
+    use_mood: bool,
+    use_texture: bool,
+    use_tension: bool,
+    use_phrasing: bool,
+    use_arc: bool,
+):
+    """
+    Facets in caption order. Each facet has a drop priority (higher -> dropped first
+    if the caption cannot fit), an inclusion probability and one or more weighted
+    length tables to draw phrases from.
+    """
+    def simple(phrases):
+        return [(1.0, length_table(phrases))]
+
+    facets = []
+    # head (drop context/ensemble first)
+    if use_context:
+        facets.append({"group": "head", "key": "ctx", "prio": 90, "p_include": 1.0, "tables": simple(CONTEXT)})
+    if use_genres and genres:
+        facets.append({"group": "head", "key": "gen", "prio": 70, "p_include": 0.65, "tables": genre_phrase_tables(genres)})
+    if use_ensemble:
+        facets.append({"group": "head", "key": "ens", "prio": 80, "p_include": 1.0, "tables": simple(ENSEMBLE)})
+    if use_instruments and instruments:
+        facets.append({"group": "head", "key": "inst", "prio": 60, "p_include": 0.80, "tables": instrument_phrase_tables(instruments)})
+
+    # body (drop arc/phrasing first)
+    if use_energy:
+        facets.append({"group": "body", "key": "energy", "prio": 10, "p_include": 1.0, "tables": simple(ENERGY)})
+    if use_tempo:
+        facets.append({"group": "body", "key": "tempo", "prio": 20, "p_include": 1.0, "tables": simple(TEMPO)})
+    if use_mood:
+        facets.append({"group": "body", "key": "mood", "prio": 30, "p_include": 1.0, "tables": simple([m + " tone" for m in MOOD])})
+    if use_texture:
+        facets.append({"group": "body", "key": "texture", "prio": 50, "p_include": 1.0, "tables": simple(TEXTURE)})
+    if use_tension:
+        facets.append({"group": "body", "key": "tension", "prio": 55, "p_include": 1.0, "tables": simple(TENSION)})
+    if use_phrasing:
+        facets.append({"group": "body", "key": "phrasing", "prio": 85, "p_include": 1.0, "tables": simple(PHRASING)})
+    if use_arc:
+        facets.append({"group": "body", "key": "arc", "prio": 95, "p_include": 1.0, "tables": simple(ARC)})
+
+    # drop empty tables so every table has at least one phrase length
+    for f in facets:
+        f["tables"] = [(w, t) for w, t in f["tables"] if t[0]]
+    return [f for f in facets if f["tables"]]
+
+
+def sample_caption(rng: random.Random, facets, max_chars: int, cache) -> str:
+    """
+    Draw one caption that fits max_chars by construction:
+      1. pick which facets appear (and which table, for weighted facets)
+      2. pick how many facets to drop (highest prio first), weighted by the
+         number of feasible captions each choice leaves
+      3. draw phrases uniformly over all length-feasible combinations, using
+         per-facet length tables and completion counts (cached per facet layout)
+    """
+    chosen = []
+    for f in facets:
+        if f["p_include"] < 1.0 and rng.random() > f["p_include"]:
+            continue
+        tables = f["tables"]
+        ti = 0 if len(tables) == 1 else rng.choices(range(len(tables)), weights=[w for w, _t in tables])[0]
+        chosen.append((f, ti))
+
+    layout = tuple((f["key"], ti) for f, ti in chosen)
+    if layout not in cache:
+        # Dropping facets in prio order gives nested layouts; each one that can fit
+        # is a candidate, weighted by how many feasible captions it has.
+        by_prio = sorted(chosen, key=lambda fti: fti[0]["prio"])
+        options = []
+        for k in range(len(by_prio), 0, -1):
+            keep = [fti for fti in chosen if fti in by_prio[:k]]  # caption order
+            tables = [f["tables"][ti][1] for f, ti in keep]
+            budget = max_chars - SEP_LEN * (len(keep) - 1)
+            if sum(buckets[0][0] for buckets in tables) > budget:
+                continue
+            counts = completion_counts(tables, budget)
+            options.append((keep, tables, budget, counts, {}))
+        totals = [opt[3][0][opt[2]] for opt in options]
+        cache[layout] = (options, list(itertools.accumulate(totals)))
+    options, cum_totals = cache[layout]
+    if not options:
+        return ""
+    keep, tables, budget, counts, cum_cache = rng.choices(options, cum_weights=cum_totals)[0]
+
+    head_parts, body_parts = [], []
+    for i, ((f, _ti), buckets) in enumerate(zip(keep, tables)):
+        # cumulative weights depend only on (facet position, remaining budget)
+        cum = cum_cache.get((i, budget))
+        if cum is None:
+            nxt = counts[i + 1]
+            cum = list(itertools.accumulate(len(ps) * nxt[budget - n] if n <= budget else 0 for n, ps in buckets))
+            cum_cache[(i, budget)] = cum
+        n, ps = rng.choices(buckets, cum_weights=cum)[0]
+        (head_parts if f["group"] == "head" else body_parts).append(rng.choice(ps))
+        budget -= n
+
+    return format_caption(head_parts, body_parts)
+
+
+def sample_unique_captions(facets, seed: int, n: int, max_chars: int, oversample_factor: int, exclude=()):
+    """Up to n unique captions (not in exclude) drawn from one random.Random(seed) stream."""
+    rng = random.Random(seed)
+    exclude = set(exclude)
+    found = set()
+
+    # Every draw fits max_chars, so attempts are only spent on duplicates.
+    # Stop early once the reachable combination space looks exhausted.
+    attempts = 0
+    max_attempts = n * oversample_factor * 50
+    stall = 0
+    max_stall = max(1000, oversample_factor * 100)
+    cache = {}
+
+    while len(found) < n and attempts < max_attempts and stall < max_stall:
+        s = sample_caption(rng, facets, max_chars, cache)
+        if s and s not in found and s not in exclude:
+            found.add(s)
+            stall = 0
+        else:
+            stall += 1
+        attempts += 1
+    return found
+
+
+def _caption_worker(job):
+    facets, seed, n, max_chars, oversample_factor = job
+    return sorted(sample_unique_captions(facets, seed, n, max_chars, oversample_factor))
+
+
+def sub_seed(seed: int, worker: int, round_idx: int) -> int:
+    """Deterministic per-worker seed (independent of scheduling and PYTHONHASHSEED)."""
+    return random.Random(f"{seed}:{round_idx}:{worker}").getrandbits(64)
 
 
 def build_unified_captions(
@@ -265,88 +399,128 @@ def build_unified_captions(
     use_tension: bool,
     use_phrasing: bool,
     use_arc: bool,
+    workers: int = 1,
 ):
-    rng = random.Random(seed)
-
+    """
+    workers > 1 splits the target count across processes, each with a sub-seed
+    derived from (seed, round, worker). Results are merged as sets, the
+    overshoot is trimmed with a seeded shuffle and the rest sorted, so the
+    same seed and worker count always give the same bank.
+    """
     instruments, genres = [], []
     if use_instruments or use_genres:
         leaf = build_music_leaf_names()
         instruments, genres = extract_instrument_and_genre_terms(leaf)
 
+    facets = build_facets(
+        instruments,
+        genres,
+        use_context=use_context,
+        use_ensemble=use_ensemble,
+        use_instruments=use_instruments,
+        use_genres=use_genres,
+        use_energy=use_energy,
+        use_tempo=use_tempo,
+        use_mood=use_mood,
+        use_texture=use_texture,
+        use_tension=use_tension,
+        use_phrasing=use_phrasing,
+        use_arc=use_arc,
+    )
+
     filtered = set()
     # include base examples (truncate if needed)
     for b in BASE_EXAMPLES:
         b2 = b if len(b) <= max_chars else (b[: max(0, max_chars - 1)].rstrip(",; ") + "…")
         filtered.add(b2)
-
-    def make_one():
-        # head
-        ctx = rng.choice(CONTEXT) if use_context else ""
-        ens = rng.choice(ENSEMBLE) if use_ensemble else ""
-        inst = choose_instrument_phrase(rng, instruments) if use_instruments else ""
-        gen = choose_genre_phrase(rng, genres) if use_genres else ""
-
-        # body
-        e = rng.choice(ENERGY) if use_energy else ""
-        t = rng.choice(TEMPO) if use_tempo else ""
-        m = (rng.choice(MOOD) + " tone") if use_mood else ""
-        x = rng.choice(TEXTURE) if use_texture else ""
-        ten = rng.choice(TENSION) if use_tension else ""
-        p = rng.choice(PHRASING) if use_phrasing else ""
-        a = rng.choice(ARC) if use_arc else ""
-
-        # items with drop priority (higher -> drop first if too long)
-        items = []
-        # head (drop context/ensemble first)
-        if ctx: items.append({"group": "head", "key": "ctx", "text": ctx, "prio": 90})
-        if gen: items.append({"group": "head", "key": "gen", "text": gen, "prio": 70})
-        if ens: items.append({"group": "head", "key": "ens", "text": ens, "prio": 80})
-        if inst: items.append({"group": "head", "key": "inst", "text": inst, "prio": 60})
-
-        # body (drop arc/phrasing first)
-        if e: items.append({"group": "body", "key": "energy", "text": e, "prio": 10})
-        if t: items.append({"group": "body", "key": "tempo", "text": t, "prio": 20})
-        if m: items.append({"group": "body", "key": "mood", "text": m, "prio": 30})
-        if x: items.append({"group": "body", "key": "texture", "text": x, "prio": 50})
-        if ten: items.append({"group": "body", "key": "tension", "text": ten, "prio": 55})
-        if p: items.append({"group": "body", "key": "phrasing", "text": p, "prio": 85})
-        if a: items.append({"group": "body", "key": "arc", "text": a, "prio": 95})
-
-        return shrink_to_max_chars(items, max_chars=max_chars)
-
-    attempts = 0
-    max_attempts = max_caps * oversample_factor * 50
-
-    while len(filtered) < max_caps and attempts < max_attempts:
-        s = make_one()
-        if len(s) <= max_chars:
-            filtered.add(s)
-        attempts += 1
+    base_caps = set(filtered)
+
+    workers = max(1, workers)
+    if workers == 1:
+        need = max(0, max_caps - len(filtered))
+        filtered |= sample_unique_captions(facets, seed, need, max_chars, oversample_factor, exclude=filtered)
+    else:
+        # The job split (not the pool size) defines the output, so the bank
+        # does not depend on how many CPUs the host has.
+        with ProcessPoolExecutor(max_workers=min(workers, os.cpu_count() or 1)) as pool:
+            # Workers don't see each other's captions: overshoot a little and top up
+            # in further rounds if cross-worker duplicates leave us short.
+            for round_idx in range(8):
+                need = max_caps - len(filtered)
+                if need <= 0:
+                    break
+                per_worker = math.ceil(need * 1.05 / workers)
+                jobs = [
+                    (facets, sub_seed(seed, w, round_idx), per_worker, max_chars, oversample_factor)
+                    for w in range(workers)
+                ]
+                before = len(filtered)
+                for caps in pool.map(_caption_worker, jobs):
+                    filtered.update(caps)
+                if len(filtered) == before:
+                    break
 
     if len(filtered) < max_caps:
         print(
-            f"[WARN] Only got {len(filtered)} captions <= {max_chars} chars. "
-            f"Try increasing max_chars or oversample_factor, or disabling some sections."
+            f"[WARN] Only got {len(filtered)} unique captions <= {max_chars} chars. "
+            f"Try increasing max_chars or enabling more sections."
         )
 
-    out = sorted(filtered, key=lambda s: (len(s), s.lower()))
-    return out[:max_caps]
+    if len(filtered) > max_caps:
+        # the multi-worker overshoot: drop the surplus at random (seeded), not by
+        # length, so the bank has the same caption lengths as with one worker
+        base = sorted(b for b in filtered if b in base_caps)[:max_caps]
+        rest = sorted(filtered - set(base))
+        random.Random(f"{seed}:trim").shuffle(rest)
+        filtered = set(base) | set(rest[: max_caps - len(base)])
+
+    return sorted(filtered, key=lambda s: (len(s), s.lower()))
+
+
+def label_id(label: str, prompts) -> str:
+    """Stable content-derived id: same label + same prompts -> same id across builds."""
+    h = hashlib.sha1()
+    h.update(label.encode("utf-8"))
+    for p in prompts:
+        h.update(b"\n")
+        h.update(str(p).encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+def expand_prompts(templates, label: str):
+    return sorted({w.format(c=label) for w in templates})
 
 
 def build_unified_labelbank(captions):
     bank = []
     for c in captions:
-        prompts = sorted({w.format(c=c) for w in CAPTION_WRAPPERS})
-        bank.append({"label": c, "synonyms": [], "prompts": prompts})
+        prompts = expand_prompts(CAPTION_WRAPPERS, c)
+        bank.append({"id": label_id(c, prompts), "label": c, "synonyms": [], "prompts": prompts})
     return bank
 
 
+def labelbank_diff(old_bank, new_bank):
+    """Compare two labelbanks by id -> {"added": [...], "removed": [...], "unchanged": [...]}."""
+    old_ids = {item.get("id") or label_id(item["label"], item.get("prompts", [])) for item in old_bank}
+    new_ids = [item["id"] for item in new_bank]
+    new_set = set(new_ids)
+    return {
+        "added": [i for i in new_ids if i not in old_ids],
+        "removed": sorted(old_ids - new_set),
+        "unchanged": [i for i in new_ids if i in old_ids],
+    }
+
+
 def main():
     p = argparse.ArgumentParser()
     p.add_argument("--max_caps", type=int, default=300)
     p.add_argument("--max_chars", type=int, default=100)
     p.add_argument("--seed", type=int, default=3)
     p.add_argument("--oversample_factor", type=int, default=10)
+    p.add_argument("--workers", type=int, default=1, help="Caption generation processes (same seed + workers -> same bank)")
+    p.add_argument("--out_json", default="clap_unified_labelbank.json", help="Labelbank JSON output path")
+    p.add_argument("--out_txt", default="clap_unified_labels.txt", help="Plain caption list output path")
+    p.add_argument("--out_bin", default=None, help="Also write the compact labelbank directory (see labelbank_bin.py)")
 
     # toggles (Python 3.9+)
     boo = argparse.BooleanOptionalAction
@@ -381,17 +555,40 @@ def main():
         use_tension=args.tension,
         use_phrasing=args.phrasing,
         use_arc=args.arc,
+        workers=args.workers,
     )
     bank = build_unified_labelbank(captions)
 
-    with open("clap_unified_labels.txt", "w", encoding="utf-8") as f:
+    # Diff against the previous bank so the embedding step can reuse vectors by id
+    old_bank = []
+    out_json = Path(args.out_json)
+    if out_json.exists():
+        try:
+            old_bank = json.loads(out_json.read_text(encoding="utf-8"))
+        except (ValueError, OSError) as e:
+            print(f"[WARN] Could not read previous labelbank ({e}); treating all labels as added.")
+    diff = labelbank_diff(old_bank, bank)
+
+    with open(args.out_txt, "w", encoding="utf-8") as f:
         f.write("\n".join(captions) + "\n")
 
-    with open("clap_unified_labelbank.json", "w", encoding="utf-8") as f:
+    with open(out_json, "w", encoding="utf-8") as f:
         json.dump(bank, f, ensure_ascii=False, indent=2)
 
-    print(f"Wrote clap_unified_labels.txt ({len(captions)} captions, max {args.max_chars} chars)")
-    print(f"Wrote clap_unified_labelbank.json ({len(bank)} items)")
+    diff_path = out_json.with_suffix(".diff.json")
+    with open(diff_path, "w", encoding="utf-8") as f:
+        json.dump(diff, f, ensure_ascii=False, indent=2)
+
+    print(f"Wrote {args.out_txt} ({len(captions)} captions, max {args.max_chars} chars)")
+    print(f"Wrote {out_json} ({len(bank)} items)")
+    if args.out_bin:
+        from labelbank_bin import write_labelbank_bin
+        write_labelbank_bin(args.out_bin, bank)
+        print(f"Wrote {args.out_bin} (compact labelbank)")
+    print(
+        f"Wrote {diff_path} (added {len(diff['added'])}, removed {len(diff['removed'])}, "
+        f"unchanged {len(diff['unchanged'])})"
+    )
     print("\nPreview:")
     for c in captions[:6]:
         print(" -", c)
@@ -15,8 +15,10 @@ CLAP is typically used with ~10s chunks; we chunk long audio.
 import argparse
 import json
 import math
+import time
+import warnings
 from pathlib import Path
-from typing import List, Tuple, Optional, Dict, Any
+from typing import List, Tuple, Optional, Dict, Any, Sequence
 
 import numpy as np
 import torch
@@ -25,6 +27,15 @@ import librosa
 
 from transformers import pipeline, ClapModel, ClapProcessor
 
+from build_label_v2 import (
+    ARC, CAPTION_WRAPPERS, CONTEXT, ENERGY, ENSEMBLE, MOOD, PHRASING, TEMPO, TENSION, TEXTURE,
+    expand_prompts, extract_instrument_and_genre_terms, format_caption, label_id,
+)
+from labelbank_bin import BinaryLabelbank, is_labelbank_bin, publish_labelbank_bin
+from track_index import TrackIndex
+
+CLAP_MODEL_ID = "laion/clap-htsat-fused"
+
 
 DEFAULT_LABELS = [
     "a string quartet performance",
@@ -84,11 +95,24 @@ def seconds_str(start_s: float, end_s: float) -> str:
     return f"{start_s:0.2f}s–{end_s:0.2f}s"
 
 
-def run_pipeline(audio_path: str, labels: List[str], top_k: int, device: int):
+def load_clap(device, clap_path: Optional[str] = None):
+    """
+    CLAP processor + model. clap_path: a local snapshot of CLAP_MODEL_ID, read
+    without any Hub lookup (label caches and banks stay keyed by CLAP_MODEL_ID).
+    """
+    source = clap_path or CLAP_MODEL_ID
+    local = {"local_files_only": True} if clap_path else {}
+    processor = ClapProcessor.from_pretrained(source, **local)
+    model = ClapModel.from_pretrained(source, **local).to(device)
+    model.eval()
+    return processor, model
+
+
+def run_pipeline(audio_path: str, labels: List[str], top_k: int, device: int, clap_path: Optional[str] = None):
     """Quick test mode: requires candidate_labels."""
     clf = pipeline(
         task="zero-shot-audio-classification",
-        model="laion/clap-htsat-fused",
+        model=clap_path or CLAP_MODEL_ID,
         device=device,
     )
 
@@ -100,26 +124,76 @@ def run_pipeline(audio_path: str, labels: List[str], top_k: int, device: int):
     return out[:top_k]
 
 
-def load_labelbank_json(path: str) -> List[Dict[str, Any]]:
+def load_labelbank_json(path: str) -> Sequence[Dict[str, Any]]:
     """
     Expected structure (per item):
-      { "label": "Violin", "synonyms": [...], "prompts": ["a violin solo", ...] }
+      { "id": "...", "label": "Violin", "synonyms": [...], "prompts": ["a violin solo", ...] }
+
+    "id" is optional (older banks); it is derived from label + prompts when missing.
+    A compact labelbank directory (labelbank_bin.py) is opened memory-mapped instead.
     """
+    if is_labelbank_bin(path):
+        bank = BinaryLabelbank(path)
+        if len(bank) == 0:
+            raise ValueError("labelbank must not be empty.")
+        return bank
+
     data = json.loads(Path(path).read_text(encoding="utf-8"))
     if not isinstance(data, list) or not data:
         raise ValueError("labelbank_json must be a non-empty JSON list.")
     for item in data[:3]:
         if "label" not in item or "prompts" not in item:
             raise ValueError("labelbank_json items must have 'label' and 'prompts'.")
+    for item in data:
+        if not item.get("id"):
+            item["id"] = label_id(item["label"], item.get("prompts", []))
     return data
 
 
+def load_label_cache(path: str, model_id: str) -> Dict[str, torch.Tensor]:
+    """
+    Load label embeddings saved by save_label_cache: {label_id: (D,) tensor}.
+    Returns an empty dict if the file is missing or was built with another model.
+    """
+    p = Path(path)
+    if not p.exists():
+        return {}
+    with np.load(p, allow_pickle=False) as data:
+        if str(data["model"]) != model_id:
+            print(f"[cache] {p.name} was built with {data['model']}, ignoring it.")
+            return {}
+        vecs = torch.from_numpy(data["vecs"].astype(np.float32))
+        return {str(i): vecs[k] for k, i in enumerate(data["ids"])}
+
+
+def save_label_cache(path: str, model_id: str, ids: List[str], label_mat: torch.Tensor) -> None:
+    """Store label embeddings by id (only the current bank, so removed labels are dropped)."""
+    np.savez(
+        path,
+        model=np.array(model_id),
+        ids=np.array(ids),
+        vecs=label_mat.numpy().astype(np.float32),
+    )
+
+
+def padding_ratio(lengths: List[int], batch_size: int) -> float:
+    """Fraction of token slots that are padding when lengths are batched in this order."""
+    slots = real = 0
+    for start in range(0, len(lengths), batch_size):
+        batch = lengths[start:start + batch_size]
+        slots += max(batch) * len(batch)
+        real += sum(batch)
+    return (slots - real) / slots if slots else 0.0
+
+
 def compute_label_embeddings_from_labelbank(
     processor: ClapProcessor,
     model: ClapModel,
-    labelbank: List[Dict[str, Any]],
+    labelbank: Sequence[Dict[str, Any]],
     device: torch.device,
     batch_size: int = 64,
+    cache: Optional[Dict[str, torch.Tensor]] = None,
+    sort_by_length: bool = True,
 ) -> Tuple[List[str], torch.Tensor]:
     """
     Build a label embedding matrix using prompt ensembling:
@@ -128,15 +202,28 @@ def compute_label_embeddings_from_labelbank(
       - average per label
       - normalize label embeddings
 
+    If cache ({label_id: vector}) is given, labels whose id is in it reuse the
+    stored vector and only the prompts of new labels are encoded.
+
+    Duplicate prompts are encoded once; with sort_by_length they are batched
+    in token-length order and scattered back afterwards.
+
     Returns:
       labels: list[str] length N
       label_mat: torch.Tensor shape (N, D) on CPU
     """
-    labels = [item["label"] for item in labelbank]
+    cache = cache or {}
+    labels: List[str] = []
+    cached_rows: List[Tuple[int, str]] = []  # (label index, label id)
     prompts: List[str] = []
     prompt_label_idx: List[int] = []
 
+    # single pass: compact banks decode entries on access
     for i, item in enumerate(labelbank):
+        labels.append(item["label"])
+        if item.get("id") in cache:
+            cached_rows.append((i, item["id"]))
+            continue
         ps = item.get("prompts", [])
         if not ps:
             continue
@@ -144,17 +231,30 @@ def compute_label_embeddings_from_labelbank(
             prompts.append(str(p))
             prompt_label_idx.append(i)
 
+    print(f"[labels] reused {len(cached_rows)} cached, encoding {len(labels) - len(cached_rows)} new")
     if not prompts:
+        if len(cached_rows) == len(labels):
+            label_mat = torch.stack([cache[lid] for _i, lid in cached_rows])
+            return labels, F.normalize(label_mat, dim=-1)
         raise ValueError("No prompts found in labelbank_json.")
 
-    # Embed prompts in batches
-    all_prompt_embs = []
+    # Encode each distinct prompt once. Sorting by token length keeps prompts of
+    # similar length in the same batch, so padding=True pads very little.
+    unique_prompts = list(dict.fromkeys(prompts))
+    prompt_row = {p: k for k, p in enumerate(unique_prompts)}
+    lengths = [len(ids) for ids in processor.tokenizer(unique_prompts, truncation=True)["input_ids"]]
+    order = list(range(len(unique_prompts)))
+    if sort_by_length:
+        order.sort(key=lambda k: lengths[k])
+
     model.eval()
+    emb_chunks = []
+    t0 = time.perf_counter()
 
-    for start in range(0, len(prompts), batch_size):
-        batch_prompts = prompts[start:start + batch_size]
+    for start in range(0, len(order), batch_size):
+        batch_rows = order[start:start + batch_size]
         text_inputs = processor(
-            text=batch_prompts,
+            text=[unique_prompts[k] for k in batch_rows],
             return_tensors="pt",
             padding=True,
             truncation=True,
@@ -164,9 +264,24 @@ def compute_label_embeddings_from_labelbank(
         with torch.no_grad():
             emb = model.get_text_features(**text_inputs)
             emb = F.normalize(emb, dim=-1)
-        all_prompt_embs.append(emb.detach().cpu())
+        emb_chunks.append(emb.detach().cpu())
+
+    elapsed = max(time.perf_counter() - t0, 1e-9)
+    sorted_embs = torch.cat(emb_chunks, dim=0)
+    unique_embs = torch.empty_like(sorted_embs)
+    unique_embs[torch.tensor(order, dtype=torch.long)] = sorted_embs  # scatter back
+    prompt_embs = unique_embs[torch.tensor([prompt_row[p] for p in prompts], dtype=torch.long)]  # (P, D)
+
+    # both padding ratios over the same unique prompts (file order vs. as run);
+    # deduplication savings are reported on their own
+    pad_file_order = padding_ratio(lengths, batch_size)
+    pad_used = padding_ratio([lengths[k] for k in order], batch_size)
+    print(
+        f"[labels] encoded {len(unique_prompts)} unique of {len(prompts)} prompts in {elapsed:.2f}s "
+        f"({len(unique_prompts) / elapsed:.0f} prompts/s, {len(prompts) - len(unique_prompts)} duplicates skipped); "
+        f"padding {pad_file_order:.1%} in file order, {pad_used:.1%} {'length-sorted' if sort_by_length else 'as run'}"
+    )
 
-    prompt_embs = torch.cat(all_prompt_embs, dim=0)  # (P, D)
     idx = torch.tensor(prompt_label_idx, dtype=torch.long)  # (P,)
 
     # Aggregate prompt embeddings -> label embeddings
@@ -178,6 +293,11 @@ def compute_label_embeddings_from_labelbank(
     label_sum.index_add_(0, idx, prompt_embs)
     counts.index_add_(0, idx, torch.ones_like(idx, dtype=torch.float32))
 
+    # Cached labels: stored vectors are already normalized, use them as-is
+    for i, lid in cached_rows:
+        label_sum[i] = cache[lid]
+        counts[i] = 1.0
+
     counts = torch.clamp(counts, min=1.0).unsqueeze(1)
     label_mat = label_sum / counts
     label_mat = F.normalize(label_mat, dim=-1)  # (N, D)
@@ -185,6 +305,116 @@ def compute_label_embeddings_from_labelbank(
     return labels, label_mat
 
 
+def publish_label_mat(path: str, items: Sequence[Dict[str, Any]], label_mat: torch.Tensor) -> None:
+    """
+    Write labels + label_mat as a compact labelbank with embeddings, so other
+    processes can attach to it memory-mapped. Published as a new generation
+    (labelbank_bin.publish_labelbank_bin): readers never see a half-written bank,
+    and workers already attached keep the generation they mapped.
+    """
+    publish_labelbank_bin(path, list(items), embeddings=label_mat.numpy(), model_id=CLAP_MODEL_ID)
+
+
+def attach_label_mat(bank: BinaryLabelbank) -> Tuple[Sequence[str], torch.Tensor]:
+    """
+    Zero-copy view of a published label matrix: every process attached to the
+    same bank shares the page cache instead of holding its own copy.
+    """
+    with warnings.catch_warnings():
+        # the memory map is read-only; we never write to label_mat
+        warnings.simplefilter("ignore", UserWarning)
+        label_mat = torch.from_numpy(bank.embeddings)
+    return bank.label_names(), label_mat
+
+
+def wait_for_labelbank(path: str, timeout_s: float) -> None:
+    deadline = time.monotonic() + timeout_s
+    while not is_labelbank_bin(path):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"No published labelbank at {path} after {timeout_s:.0f}s")
+        time.sleep(0.2)
+
+
+# Facets in caption order (same order as build_label_v2 captions)
+FACET_KEYS = ["ctx", "gen", "ens", "inst", "energy", "tempo", "mood", "texture", "tension", "phrasing", "arc"]
+DEFAULT_FACETS = ["gen", "inst", "energy", "tempo", "mood", "texture", "tension", "phrasing", "arc"]
+
+
+def build_facet_labelbank(facet_keys: List[str]) -> Tuple[List[Dict[str, Any]], List[Tuple[str, str, int, int]]]:
+    """
+    One pseudo-label per facet phrase, prompt-ensembled with CAPTION_WRAPPERS.
+
+    Returns:
+      labelbank: items for compute_label_embeddings_from_labelbank
+      spans: (facet key, group, start, end) rows of each facet in the label matrix
+    """
+    unknown = [k for k in facet_keys if k not in FACET_KEYS]
+    if unknown:
+        raise ValueError(f"Unknown facets: {unknown}. Choose from {FACET_KEYS}.")
+
+    # manual instrument/genre lists only: no ontology download at analysis time
+    instruments, genres = extract_instrument_and_genre_terms([])
+    vocab = {
+        "ctx": ("head", CONTEXT),
+        "gen": ("head", [f"{g} feel" for g in genres]),
+        "ens": ("head", ENSEMBLE),
+        "inst": ("head", [f"featuring {i}" for i in instruments]),
+        "energy": ("body", ENERGY),
+        "tempo": ("body", TEMPO),
+        "mood": ("body", [m + " tone" for m in MOOD]),
+        "texture": ("body", TEXTURE),
+        "tension": ("body", TENSION),
+        "phrasing": ("body", PHRASING),
+        "arc": ("body", ARC),
+    }
+
+    labelbank: List[Dict[str, Any]] = []
+    spans: List[Tuple[str, str, int, int]] = []
+    for key in FACET_KEYS:
+        if key not in facet_keys:
+            continue
+        group, phrases = vocab[key]
+        if not phrases:
+            # an empty span would leave rank_facet_captions with no caption at all
+            print(f"[facets] skipping '{key}': no phrases")
+            continue
+        start = len(labelbank)
+        for phrase in phrases:
+            prompts = expand_prompts(CAPTION_WRAPPERS, phrase)
+            labelbank.append({"id": label_id(phrase, prompts), "label": phrase, "synonyms": [], "prompts": prompts})
+        spans.append((key, group, start, len(labelbank)))
+    if not spans:
+        raise ValueError(f"No facet phrases for --facets {facet_keys}. Choose from {FACET_KEYS}.")
+    return labelbank, spans
+
+
+def rank_facet_captions(
+    sims: torch.Tensor,
+    spans: List[Tuple[str, str, int, int]],
+    top_k: int,
+) -> List[Dict[str, Any]]:
+    """
+    Compose captions from per-facet scores.
+
+    A caption's score is the mean similarity of its facet phrases, so the best
+    caption takes the best phrase of every facet, and a beam of top_k over each
+    facet's top_k phrases gives the exact top_k over the full cartesian product.
+    """
+    beams: List[Tuple[float, List[Tuple[str, str, int, float]]]] = [(0.0, [])]
+    for key, group, start, end in spans:
+        vals, idx = torch.topk(sims[start:end], min(top_k, end - start))
+        beams = sorted(
+            (
+                (total + float(v), parts + [(key, group, start + int(i), float(v))])
+                for total, parts in beams
+                for v, i in zip(vals, idx)
+            ),
+            key=lambda b: b[0],
+            reverse=True,
+        )[:top_k]
+    return [(total / max(1, len(parts)), parts) for total, parts in beams]
+
+
 def run_embeddings(
     audio_path: str,
     labels: Optional[List[str]],
@@ -193,6 +423,14 @@ def run_embeddings(
     hop_s: Optional[float],
     top_k: int,
     batch_size: int,
+    label_cache: Optional[str] = None,
+    sort_prompts: bool = True,
+    scoring: str = "labels",
+    facets: Optional[List[str]] = None,
+    publish_labels: Optional[str] = None,
+    wait_labels_s: float = 0.0,
+    index_dir: Optional[str] = None,
+    clap_path: Optional[str] = None,
 ):
     """
     Recommended mode:
@@ -200,22 +438,59 @@ def run_embeddings(
     - extract audio embeddings per chunk
     - extract text embeddings once (labels or labelbank prompt-ensembled labels)
     - cosine similarity
+
+    scoring="facets" embeds each facet phrase once instead of whole captions and
+    composes the best caption per chunk from the full facet cartesian product.
+
+    publish_labels writes the label matrix as a compact bank; workers pass that
+    bank as labelbank_json and attach to it without any text encoding
+    (wait_labels_s lets them start before the publisher has finished).
+
+    index_dir adds the chunk embeddings of this track to a TrackIndex
+    (track_index.py) for library-wide similarity search.
+
+    clap_path loads CLAP from a local snapshot (see load_clap).
     """
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    processor = ClapProcessor.from_pretrained("laion/clap-htsat-fused")
-    model = ClapModel.from_pretrained("laion/clap-htsat-fused").to(device)
-    model.eval()
+    processor, model = load_clap(device, clap_path)
 
     # Build label matrix
-    if labelbank_json:
-        labelbank = load_labelbank_json(labelbank_json)
+    facet_spans = None
+    if scoring == "facets":
+        facet_bank, facet_spans = build_facet_labelbank(facets or DEFAULT_FACETS)
         label_names, label_mat = compute_label_embeddings_from_labelbank(
             processor=processor,
             model=model,
-            labelbank=labelbank,
+            labelbank=facet_bank,
             device=device,
             batch_size=batch_size,
+            sort_by_length=sort_prompts,
         )
+        space = math.prod(end - start for _k, _g, start, end in facet_spans)
+        print(f"[facets] {len(facet_bank)} phrases over {len(facet_spans)} facets -> {space:,} virtual captions")
+    elif labelbank_json:
+        if wait_labels_s > 0:
+            wait_for_labelbank(labelbank_json, wait_labels_s)
+        labelbank = load_labelbank_json(labelbank_json)
+        if isinstance(labelbank, BinaryLabelbank) and labelbank.embeddings is not None \
+                and labelbank.model == CLAP_MODEL_ID:
+            # precomputed (stored normalized) in the compact bank: no text encoding at all
+            label_names, label_mat = attach_label_mat(labelbank)
+        else:
+            cache = load_label_cache(label_cache, CLAP_MODEL_ID) if label_cache else None
+            label_names, label_mat = compute_label_embeddings_from_labelbank(
+                processor=processor,
+                model=model,
+                labelbank=labelbank,
+                device=device,
+                batch_size=batch_size,
+                cache=cache,
+                sort_by_length=sort_prompts,
+            )
+            if label_cache:
+                save_label_cache(label_cache, CLAP_MODEL_ID, [item["id"] for item in labelbank], label_mat)
+            if publish_labels:
+                publish_label_mat(publish_labels, labelbank, label_mat)
     else:
         if not labels:
             raise ValueError("Provide --labels/--labels_file or --labelbank_json for embeddings mode.")
@@ -232,12 +507,16 @@ def run_embeddings(
             text_emb = model.get_text_features(**text_inputs)
             text_emb = F.normalize(text_emb, dim=-1)
         label_mat = text_emb.detach().cpu()
+        if publish_labels:
+            items = [{"label": lab, "synonyms": [], "prompts": [lab]} for lab in label_names]
+            publish_label_mat(publish_labels, items, label_mat)
 
     # Audio
     y, sr = load_audio_mono(audio_path, target_sr=48000)
     chunks = chunk_audio(y, sr=sr, chunk_s=chunk_s, hop_s=hop_s)
 
     results = []
+    chunk_embs: List[torch.Tensor] = []
     for (start, end, chunk) in chunks:
         start_s = start / sr
         end_s = end / sr
@@ -248,20 +527,42 @@ def run_embeddings(
         with torch.no_grad():
             audio_emb = model.get_audio_features(**audio_inputs)
             audio_emb = F.normalize(audio_emb, dim=-1).detach().cpu()  # (1, D)
+        chunk_embs.append(audio_emb[0])
+
+        if facet_spans is not None:
+            composed = rank_facet_captions((audio_emb @ label_mat.T).squeeze(0), facet_spans, top_k)
+            ranked = []
+            for score, parts in composed:
+                head = [label_names[row] for _k, group, row, _s in parts if group == "head"]
+                body = [label_names[row] for _k, group, row, _s in parts if group == "body"]
+                ranked.append({"label": format_caption(head, body), "score": score})
+            results.append({
+                "time": seconds_str(start_s, end_s),
+                "top": ranked,
+                "facets": {key: {"phrase": label_names[row], "score": sc} for key, _g, row, sc in composed[0][1]},
+            })
+            continue
 
-        sims = (audio_emb @ label_mat.T).squeeze(0).numpy().tolist()
-
-        ranked = sorted(
-            [{"label": lab, "score": float(sc)} for lab, sc in zip(label_names, sims)],
-            key=lambda x: x["score"],
-            reverse=True,
-        )[:top_k]
+        sims = (audio_emb @ label_mat.T).squeeze(0)
+        vals, idx = torch.topk(sims, min(top_k, sims.shape[0]))
+        ranked = [{"label": label_names[int(i)], "score": float(v)} for v, i in zip(vals, idx)]
 
         results.append({
             "time": seconds_str(start_s, end_s),
             "top": ranked,
         })
 
+    if index_dir and chunk_embs:
+        index = TrackIndex(index_dir)
+        index.add_track(
+            str(Path(audio_path).resolve()),
+            [r["time"] for r in results],
+            torch.stack(chunk_embs).numpy(),
+            CLAP_MODEL_ID,
+        )
+        rebuilt = index.maybe_rebuild_ivf()
+        print(f"[index] {index_dir}: {len(index)} tracks, {index.n_chunks} chunks" + (" (IVF rebuilt)" if rebuilt else ""))
+
     return results
 
 
@@ -278,12 +579,32 @@ def main():
 
     # NEW: labelbank with prompt ensembles
     p.add_argument("--labelbank_json", default=None,
-                   help="JSON labelbank with prompts per label (recommended).")
+                   help="JSON labelbank with prompts per label (recommended), or a compact .lbk directory.")
+    p.add_argument("--label_cache", default=None,
+                   help="NPZ file of label embeddings keyed by label id; only new labels get encoded.")
+
+    p.add_argument("--scoring", choices=["labels", "facets"], default="labels",
+                   help="labels = rank whole captions; facets = score facet phrases and compose the best caption")
+    p.add_argument("--facets", default=",".join(DEFAULT_FACETS),
+                   help=f"Comma-separated facets for --scoring facets (from: {','.join(FACET_KEYS)})")
+
+    p.add_argument("--publish_labels", default=None,
+                   help="Write the label matrix as a compact .lbk other runs can attach to (memory-mapped)")
+    p.add_argument("--wait_labels", type=float, default=0.0,
+                   help="Seconds to wait for --labelbank_json to be published by another process")
+
+    p.add_argument("--index", default=None,
+                   help="Add this track's chunk embeddings to a track index directory (see track_index.py)")
+
+    p.add_argument("--clap_path", default=None,
+                   help=f"Local snapshot of {CLAP_MODEL_ID} to load instead of resolving it on the Hub")
 
     p.add_argument("--top_k", type=int, default=5, help="How many top labels to show")
     p.add_argument("--chunk_s", type=float, default=10.0, help="Chunk size in seconds (embeddings mode)")
     p.add_argument("--hop_s", type=float, default=None, help="Hop size in seconds (embeddings mode). Default = chunk_s")
     p.add_argument("--batch_size", type=int, default=64, help="Text embedding batch size (labelbank mode)")
+    p.add_argument("--sort_prompts", action=argparse.BooleanOptionalAction, default=True,
+                   help="Batch labelbank prompts by token length (less padding). --no-sort_prompts keeps file order.")
     p.add_argument("--out", default="clap_output.json", help="Output JSON filename/path (default: clap_output.json)")
 
 
@@ -304,7 +625,7 @@ def main():
     if args.mode == "pipeline":
         # pipeline ignores labelbank_json by design; it expects a flat candidate label list
         device = 0 if torch.cuda.is_available() else -1
-        output = run_pipeline(audio_path, labels=labels, top_k=args.top_k, device=device)
+        output = run_pipeline(audio_path, labels=labels, top_k=args.top_k, device=device, clap_path=args.clap_path)
     else:
         output = run_embeddings(
             audio_path=audio_path,
@@ -314,6 +635,14 @@ def main():
             hop_s=args.hop_s,
             top_k=args.top_k,
             batch_size=args.batch_size,
+            label_cache=args.label_cache,
+            sort_prompts=args.sort_prompts,
+            scoring=args.scoring,
+            facets=[f.strip() for f in args.facets.split(",") if f.strip()],
+            publish_labels=args.publish_labels,
+            wait_labels_s=args.wait_labels,
+            index_dir=args.index,
+            clap_path=args.clap_path,
         )
 
     print(json.dumps(output, indent=2, ensure_ascii=False))
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Helpers for processes that rewrite a directory other processes are reading
+(labelbank publishing, track index updates).
+
+The lock is an OS lock (flock / msvcrt.locking) on a file that is never
+deleted, so it is released by the OS if the holder crashes: no stale locks.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+
+def replace(src: Path, dst: Path, tries: int = 50) -> None:
+    """os.replace, retried while dst is briefly open in a reader (Windows refuses then)."""
+    for i in range(tries):
+        try:
+            os.replace(src, dst)
+            return
+        except PermissionError:
+            if i == tries - 1:
+                raise
+            time.sleep(0.01)
+
+
+@contextmanager
+def locked(path: Path):
+    """Hold an exclusive lock on path (created if missing) for the with-block."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+
+            while True:
+                try:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass  # LK_LOCK gives up after ~10 s: keep waiting
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            yield  # released when the file is closed
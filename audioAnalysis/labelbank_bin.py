@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+Compact labelbank format (an alternative to clap_unified_labelbank.json).
+
+A bank is a directory, e.g. clap_unified_labelbank.lbk/:
+
+  meta.json        format/version, prompt templates (stored once), count, model id
+  captions.bin     UTF-8 captions back to back (the string table)
+  offsets.npy      int64 (N+1,) byte offsets into captions.bin
+  ids.npy          fixed-width label ids (N,)
+  prompts.json     only entries whose prompts are NOT the templates applied to the label
+  synonyms.json    only entries with non-empty synonyms
+  embeddings.npy   optional float32 (N, D) label embeddings (see --label_cache)
+
+The .npy/.bin files are memory-mapped on load, so opening a 100k-label bank is
+cheap and entries are only decoded when touched.
+
+A bank published for other processes (clap_local_v2.py --publish_labels) keeps
+whole generations side by side and a pointer to the live one:
+
+  CURRENT          name of the current generation, switched with os.replace
+  gen-<stamp>/     one complete bank, never modified once published
+  LOCK             serialises publishers (file_lock.py)
+
+Readers resolve CURRENT when they open the bank, so they see either the old or
+the new bank, never a mix, and keep their memory maps across later publishes.
+
+Convert an existing JSON bank:
+  python labelbank_bin.py --labelbank_json clap_unified_labelbank.json \
+      --out clap_unified_labelbank.lbk --label_cache clap_unified_labelbank.emb.npz
+"""
+
+import argparse
+import json
+import os
+import shutil
+import time
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from build_label_v2 import CAPTION_WRAPPERS, expand_prompts, label_id
+from file_lock import locked, replace
+
+FORMAT_NAME = "bard-labelbank"
+FORMAT_VERSION = 1
+CURRENT_FILE = "CURRENT"
+
+
+def bank_dir(path: str) -> Path:
+    """Directory holding the bank files: the current generation of a published bank, else path itself."""
+    root = Path(path)
+    try:
+        name = (root / CURRENT_FILE).read_text(encoding="utf-8").strip()
+    except (FileNotFoundError, NotADirectoryError):
+        return root
+    return root / name
+
+
+def is_labelbank_bin(path: str) -> bool:
+    return (bank_dir(path) / "meta.json").is_file()
+
+
+def write_labelbank_bin(
+    path: str,
+    bank: List[Dict[str, Any]],
+    templates: List[str] = CAPTION_WRAPPERS,
+    embeddings: Optional[np.ndarray] = None,
+    model_id: Optional[str] = None,
+) -> None:
+    """Write bank (list of {"id", "label", "prompts"} dicts) in the compact format."""
+    out = Path(path)
+    out.mkdir(parents=True, exist_ok=True)
+
+    encoded = [item["label"].encode("utf-8") for item in bank]
+    offsets = np.zeros(len(bank) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+    ids = [item.get("id") or label_id(item["label"], item.get("prompts", [])) for item in bank]
+
+    # Entries with hand-written prompts keep them explicitly
+    extra_prompts = {}
+    for i, item in enumerate(bank):
+        prompts = [str(p) for p in item.get("prompts", [])]
+        if prompts != expand_prompts(templates, item["label"]):
+            extra_prompts[str(i)] = prompts
+
+    (out / "captions.bin").write_bytes(b"".join(encoded))
+    np.save(out / "offsets.npy", offsets)
+    np.save(out / "ids.npy", np.array(ids, dtype="S16"))
+    (out / "prompts.json").write_text(json.dumps(extra_prompts, ensure_ascii=False), encoding="utf-8")
+    synonyms = {str(i): list(item["synonyms"]) for i, item in enumerate(bank) if item.get("synonyms")}
+    (out / "synonyms.json").write_text(json.dumps(synonyms, ensure_ascii=False), encoding="utf-8")
+
+    emb_path = out / "embeddings.npy"
+    if embeddings is not None:
+        if embeddings.shape[0] != len(bank):
+            raise ValueError(f"embeddings has {embeddings.shape[0]} rows, bank has {len(bank)} labels.")
+        np.save(emb_path, embeddings.astype(np.float32))
+    elif emb_path.exists():
+        emb_path.unlink()
+
+    meta = {
+        "format": FORMAT_NAME,
+        "version": FORMAT_VERSION,
+        "count": len(bank),
+        "templates": list(templates),
+        "model": model_id if embeddings is not None else None,
+    }
+    # meta.json last: a directory without it is not a valid bank
+    (out / "meta.json").write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+def publish_labelbank_bin(
+    path: str,
+    bank: List[Dict[str, Any]],
+    templates: List[str] = CAPTION_WRAPPERS,
+    embeddings: Optional[np.ndarray] = None,
+    model_id: Optional[str] = None,
+    keep_s: float = 60.0,
+) -> Path:
+    """
+    Publish bank as the new generation of the bank at path and return its
+    directory. A generation is removed keep_s after it stopped being current,
+    so readers that resolved it just before the switch can still open it (on
+    Windows, one still memory-mapped by a reader is retried on a later publish).
+    """
+    root = Path(path)
+    root.mkdir(parents=True, exist_ok=True)
+    name = f"gen-{time.time_ns():016x}-{os.getpid()}"
+    tmp = root / f"{name}.tmp"
+    write_labelbank_bin(str(tmp), bank, templates, embeddings, model_id)
+
+    with locked(root / "LOCK"):
+        os.replace(tmp, root / name)
+        os.utime(root / name)  # mtime = publish time, i.e. when the previous generation was superseded
+        pointer = root / f"{CURRENT_FILE}.tmp-{os.getpid()}"
+        pointer.write_text(name, encoding="utf-8")
+        replace(pointer, root / CURRENT_FILE)
+
+        gens = sorted((d for d in root.glob("gen-*") if not d.name.endswith(".tmp")), key=lambda d: d.stat().st_mtime)
+        now = time.time()
+        for old, newer in zip(gens, gens[1:]):
+            if now - newer.stat().st_mtime > keep_s:
+                shutil.rmtree(old, ignore_errors=True)
+    return root / name
+
+
+class BinaryLabelbank(Sequence):
+    """
+    Read-only, memory-mapped view of a compact labelbank.
+
+    Behaves like the list returned by load_labelbank_json: bank[i] is
+    {"id", "label", "synonyms", "prompts"}, built on access.
+    """
+
+    def __init__(self, path: str, mmap: bool = True):
+        self.path = bank_dir(path)
+        meta = json.loads((self.path / "meta.json").read_text(encoding="utf-8"))
+        if meta.get("format") != FORMAT_NAME:
+            raise ValueError(f"{path} is not a {FORMAT_NAME} directory.")
+        if meta.get("version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported labelbank version {meta.get('version')} in {path}.")
+
+        mode = "r" if mmap else None
+        self.templates: List[str] = meta["templates"]
+        self.model: Optional[str] = meta.get("model")
+        self._captions = np.memmap(self.path / "captions.bin", dtype=np.uint8, mode="r") \
+            if (self.path / "captions.bin").stat().st_size else np.zeros(0, dtype=np.uint8)
+        self._offsets = np.load(self.path / "offsets.npy", mmap_mode=mode)
+        self._ids = np.load(self.path / "ids.npy", mmap_mode=mode)
+        self._extra = {
+            int(k): v
+            for k, v in json.loads((self.path / "prompts.json").read_text(encoding="utf-8")).items()
+        }
+        syn_path = self.path / "synonyms.json"
+        self._synonyms = {
+            int(k): v for k, v in json.loads(syn_path.read_text(encoding="utf-8")).items()
+        } if syn_path.exists() else {}
+        emb_path = self.path / "embeddings.npy"
+        self.embeddings: Optional[np.ndarray] = np.load(emb_path, mmap_mode=mode) if emb_path.exists() else None
+
+        if len(self._offsets) != meta["count"] + 1:
+            raise ValueError(f"{path}: offsets do not match count in meta.json.")
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def label(self, i: int) -> str:
+        a, b = int(self._offsets[i]), int(self._offsets[i + 1])
+        return self._captions[a:b].tobytes().decode("utf-8")
+
+    def labels(self) -> List[str]:
+        return [self.label(i) for i in range(len(self))]
+
+    def label_names(self) -> "LabelNames":
+        """Lazy sequence of labels (decoded on access, nothing copied up front)."""
+        return LabelNames(self)
+
+    def label_id(self, i: int) -> str:
+        return self._ids[i].decode("ascii")
+
+    def prompts(self, i: int) -> List[str]:
+        if i in self._extra:
+            return list(self._extra[i])
+        return expand_prompts(self.templates, self.label(i))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return {
+            "id": self.label_id(i),
+            "label": self.label(i),
+            "synonyms": list(self._synonyms.get(i, [])),
+            "prompts": self.prompts(i),
+        }
+
+
+class LabelNames(Sequence):
+    def __init__(self, bank: BinaryLabelbank):
+        self._bank = bank
+
+    def __len__(self) -> int:
+        return len(self._bank)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._bank.label(k) for k in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self._bank.label(i)
+
+
+def convert_json(json_path: str, out_path: str, label_cache: Optional[str] = None) -> None:
+    """Convert a JSON labelbank; attach embeddings from a label cache if it covers every id."""
+    bank = json.loads(Path(json_path).read_text(encoding="utf-8"))
+    if not isinstance(bank, list) or not bank:
+        raise ValueError("labelbank_json must be a non-empty JSON list.")
+    for item in bank:
+        if not item.get("id"):
+            item["id"] = label_id(item["label"], item.get("prompts", []))
+
+    embeddings, model_id = None, None
+    if label_cache and Path(label_cache).exists():
+        with np.load(label_cache, allow_pickle=False) as data:
+            rows = {str(i): k for k, i in enumerate(data["ids"])}
+            missing = [item["id"] for item in bank if item["id"] not in rows]
+            if missing:
+                print(f"[WARN] {len(missing)} labels missing from {label_cache}; writing without embeddings.")
+            else:
+                embeddings = data["vecs"][[rows[item["id"]] for item in bank]]
+                model_id = str(data["model"])
+
+    write_labelbank_bin(out_path, bank, embeddings=embeddings, model_id=model_id)
+
+
+def main():
+    p = argparse.ArgumentParser(description="Convert a JSON labelbank to the compact labelbank format.")
+    p.add_argument("--labelbank_json", required=True, help="Input JSON labelbank")
+    p.add_argument("--out", required=True, help="Output directory (e.g. clap_unified_labelbank.lbk)")
+    p.add_argument("--label_cache", default=None, help="Optional NPZ label cache to store embeddings with the bank")
+    args = p.parse_args()
+
+    convert_json(args.labelbank_json, args.out, label_cache=args.label_cache)
+
+    src_size = Path(args.labelbank_json).stat().st_size
+    dst_size = sum(f.stat().st_size for f in Path(args.out).iterdir())
+    bank = BinaryLabelbank(args.out)
+    emb = "with" if bank.embeddings is not None else "without"
+    print(f"Wrote {args.out} ({len(bank)} labels, {emb} embeddings, {dst_size} bytes vs {src_size} bytes JSON)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Prune near-duplicate captions from a labelbank using CLAP text embeddings.
+
+Random caption generation yields many labels that differ by one interchangeable
+word and sit almost on top of each other in CLAP text space. This pass:
+
+  1. clusters labels greedily: a label whose cosine similarity to an already
+     kept label is >= --threshold joins that label's cluster
+  2. optionally shrinks the kept set to --target_size by max-min diversity
+     (repeatedly keep the label least similar to everything kept so far)
+  3. writes the pruned bank; merged captions are listed in "synonyms"
+
+Label embeddings come from --label_cache when possible (see clap_local_v2.py),
+so pruning a bank that was already analyzed needs no text encoding.
+
+Example:
+  python prune_labelbank.py --labelbank_json clap_unified_labelbank.json \
+      --label_cache clap_unified_labelbank.emb.npz --threshold 0.95 --out_json pruned.json
+"""
+
+import argparse
+import json
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import torch
+
+from clap_local_v2 import (
+    CLAP_MODEL_ID,
+    compute_label_embeddings_from_labelbank,
+    load_clap,
+    load_label_cache,
+    load_labelbank_json,
+    save_label_cache,
+)
+
+
+def prune_near_duplicates(
+    label_mat: torch.Tensor,
+    threshold: float,
+    target_size: Optional[int] = None,
+    block: int = 1024,
+) -> Tuple[List[int], List[int]]:
+    """
+    label_mat: (N, D) L2-normalized label embeddings, in preference order
+               (earlier labels win when two are near-duplicates).
+
+    Returns:
+      keep:   sorted indices of kept labels
+      leader: leader[i] = index of the kept label that label i was merged into
+    """
+    n = label_mat.shape[0]
+    keep: List[int] = []
+    leader = list(range(n))
+    kept_mat = label_mat.new_zeros((0, label_mat.shape[1]))
+
+    # Leader clustering, a block at a time: one matmul against kept labels,
+    # one inside the block, then a cheap sequential pass over the block.
+    for start in range(0, n, block):
+        blk = label_mat[start:start + block]
+        if keep:
+            best, arg = (blk @ kept_mat.T).max(dim=1)
+        inner = blk @ blk.T
+        new_local: List[int] = []
+        for j in range(blk.shape[0]):
+            if keep and best[j] >= threshold:
+                leader[start + j] = keep[int(arg[j])]
+                continue
+            if new_local:
+                m, a = inner[j, new_local].max(dim=0)
+                if m >= threshold:
+                    leader[start + j] = start + new_local[int(a)]
+                    continue
+            new_local.append(j)
+        keep += [start + j for j in new_local]
+        kept_mat = torch.cat([kept_mat, blk[new_local]], dim=0)
+
+    if target_size and len(keep) > target_size:
+        # Max-min diversity over the survivors, starting from the first (preferred) one
+        chosen = [0]
+        max_sim = kept_mat @ kept_mat[0]
+        max_sim[0] = float("inf")
+        while len(chosen) < target_size:
+            nxt = int(torch.argmin(max_sim))
+            chosen.append(nxt)
+            max_sim = torch.maximum(max_sim, kept_mat @ kept_mat[nxt])
+            max_sim[nxt] = float("inf")
+        chosen.sort()
+
+        # Dropped survivors (and their clusters) join the most similar chosen label
+        nearest = (kept_mat @ kept_mat[chosen].T).argmax(dim=1)
+        remap = {keep[k]: keep[chosen[int(nearest[k])]] for k in range(len(keep))}
+        leader = [remap[leader[i]] for i in range(n)]
+        keep = [keep[k] for k in chosen]
+
+    return keep, leader
+
+
+def mean_nn_similarity(label_mat: torch.Tensor, sample: int = 2000) -> float:
+    """Mean cosine similarity of each label to its nearest other label (lower = more diverse)."""
+    if label_mat.shape[0] < 2:
+        return 0.0
+    step = max(1, label_mat.shape[0] // sample)
+    sub = label_mat[::step]
+    sims = sub @ label_mat.T
+    idx = torch.arange(0, label_mat.shape[0], step)[: sub.shape[0]]
+    sims[torch.arange(sub.shape[0]), idx] = -1.0  # ignore self
+    return float(sims.max(dim=1).values.mean())
+
+
+def main():
+    p = argparse.ArgumentParser(description="Prune near-duplicate captions from a CLAP labelbank.")
+    p.add_argument("--labelbank_json", required=True, help="Input labelbank (JSON or compact .lbk directory)")
+    p.add_argument("--out_json", required=True, help="Pruned labelbank JSON output path")
+    p.add_argument("--out_bin", default=None, help="Also write the pruned bank (with embeddings) as a compact .lbk")
+    p.add_argument("--label_cache", default=None, help="NPZ label cache to read/update (clap_local_v2.py --label_cache)")
+    p.add_argument("--threshold", type=float, default=0.95, help="Cosine similarity at which captions are merged")
+    p.add_argument("--target_size", type=int, default=None, help="Keep at most this many labels (max-min diversity)")
+    p.add_argument("--batch_size", type=int, default=64, help="Text embedding batch size")
+    p.add_argument("--clap_path", default=None, help="Local CLAP snapshot to load (no Hub lookup)")
+    args = p.parse_args()
+
+    labelbank = load_labelbank_json(args.labelbank_json)
+    items = list(labelbank)
+    cache = load_label_cache(args.label_cache, CLAP_MODEL_ID) if args.label_cache else {}
+
+    if all(item["id"] in cache for item in items):
+        label_mat = torch.stack([cache[item["id"]] for item in items])
+    else:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        processor, model = load_clap(device, args.clap_path)
+        _labels, label_mat = compute_label_embeddings_from_labelbank(
+            processor=processor,
+            model=model,
+            labelbank=items,
+            device=device,
+            batch_size=args.batch_size,
+            cache=cache,
+        )
+        if args.label_cache:
+            save_label_cache(args.label_cache, CLAP_MODEL_ID, [item["id"] for item in items], label_mat)
+    label_mat = torch.nn.functional.normalize(label_mat.float(), dim=-1)
+
+    keep, leader = prune_near_duplicates(label_mat, threshold=args.threshold, target_size=args.target_size)
+
+    members = {k: [] for k in keep}
+    for i, k in enumerate(leader):
+        if i != k:
+            members[k].append(items[i]["label"])
+
+    pruned = []
+    for k in keep:
+        item = dict(items[k])
+        item["synonyms"] = list(item.get("synonyms", [])) + members[k]
+        pruned.append(item)
+
+    Path(args.out_json).write_text(json.dumps(pruned, ensure_ascii=False, indent=2), encoding="utf-8")
+    if args.out_bin:
+        from labelbank_bin import write_labelbank_bin
+        write_labelbank_bin(args.out_bin, pruned, embeddings=label_mat[keep].numpy(), model_id=CLAP_MODEL_ID)
+
+    print(f"Kept {len(keep)} of {len(items)} labels (threshold {args.threshold}, target {args.target_size})")
+    print(
+        f"Mean nearest-neighbour similarity: {mean_nn_similarity(label_mat):.3f} before, "
+        f"{mean_nn_similarity(label_mat[keep]):.3f} after"
+    )
+    print(f"Wrote {args.out_json}" + (f" and {args.out_bin}" if args.out_bin else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+Persistent CLAP index over analyzed tracks.
+
+clap_local_v2.py --index DIR adds every analyzed track here: one vector per
+chunk plus one pooled vector per track. Everything lives in a directory:
+
+  meta.json              model id, dim, tracks [{"track", "name", "start", "end", "times"}],
+                         files {array: file name of its current version}
+  chunks-<v>.npy         float32 (N, D) normalized chunk embeddings (memory-mapped on load)
+  tracks-<v>.npy         float32 (T, D) normalized mean of each track's chunks
+  ivf_centroids-<v>.npy  float32 (L, D) coarse quantizer (spherical k-means)
+  ivf_offsets-<v>.npy    int64 (L+1,) inverted list boundaries
+  ivf_rows-<v>.npy       int64 (N,) chunk rows grouped by list
+  LOCK                   serialises writers (file_lock.py)
+
+Array files are never rewritten: a write saves new versions and then replaces
+meta.json atomically, so readers in other processes see the old or the new
+index, never a mix. Writers (e.g. several clap_local_v2.py runs on one index)
+take the lock and reload the latest index first, so no track is lost.
+Superseded files are removed KEEP_S after they stopped being current.
+
+Chunk search probes the nprobe closest IVF lists, or searches exactly while the
+library is small (< 10k chunks, no IVF yet). New tracks are assigned to the
+existing lists; the centroids are retrained once the library has doubled since
+they were trained (or on --build_ivf). Track search is always exact: there are
+only as many vectors as tracks.
+
+Queries:
+  python track_index.py --index DIR --text "slow melancholic piano" --k 10
+  python track_index.py --index DIR --track song.mp3 --chunk 3 --tracks
+"""
+
+import argparse
+import json
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from file_lock import locked, replace
+
+INDEX_VERSION = 2  # 1: fixed file names, no "files" in meta.json (still readable)
+ARRAYS = ("chunks", "tracks", "ivf_centroids", "ivf_offsets", "ivf_rows")
+KEEP_S = 60.0  # grace for readers that loaded meta.json just before a write
+
+
+def _normalize(x: np.ndarray) -> np.ndarray:
+    x = np.asarray(x, dtype=np.float32)
+    n = np.linalg.norm(x, axis=-1, keepdims=True)
+    return x / np.maximum(n, 1e-12)
+
+
+def spherical_kmeans(x: np.ndarray, k: int, iters: int = 10, seed: int = 0) -> np.ndarray:
+    """Cosine k-means on normalized rows; returns (k, D) normalized centroids."""
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), size=k, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(x @ centroids.T, axis=1)
+        for c in range(k):
+            members = x[assign == c]
+            if len(members):
+                centroids[c] = members.sum(axis=0)
+            else:
+                centroids[c] = x[rng.integers(len(x))]  # re-seed empty lists
+        centroids = _normalize(centroids)
+    return centroids
+
+
+class TrackIndex:
+    def __init__(self, path: str, mmap: bool = True):
+        self.path = Path(path)
+        self.mmap = mmap
+        self._read()
+
+    def _read(self) -> None:
+        meta_path = self.path / "meta.json"
+        if meta_path.exists():
+            self.meta = json.loads(meta_path.read_text(encoding="utf-8"))
+            if self.meta.get("version") not in (1, INDEX_VERSION):
+                raise ValueError(f"Unsupported track index version {self.meta.get('version')} in {self.path}.")
+            if "files" not in self.meta:  # version 1
+                self.meta["files"] = {n: f"{n}.npy" for n in ARRAYS if (self.path / f"{n}.npy").exists()}
+        else:
+            self.meta = {"version": INDEX_VERSION, "model": None, "dim": None, "tracks": [], "ivf_trained_on": 0,
+                         "files": {}}
+        self._committed = dict(self.meta["files"])
+
+        mode = "r" if self.mmap else None
+        for name in ARRAYS:
+            f = self.meta["files"].get(name)
+            setattr(self, name, np.load(self.path / f, mmap_mode=mode) if f else None)
+
+    def __len__(self) -> int:
+        return len(self.meta["tracks"])
+
+    @property
+    def n_chunks(self) -> int:
+        return 0 if self.chunks is None else int(self.chunks.shape[0])
+
+    def ivf_fresh(self) -> bool:
+        return self.ivf_rows is not None and len(self.ivf_rows) == self.n_chunks
+
+    # ---------- writing ----------
+
+    @contextmanager
+    def _writing(self):
+        """Exclusive write on the latest index: lock, reload, then _commit() inside the block."""
+        self.path.mkdir(parents=True, exist_ok=True)
+        with locked(self.path / "LOCK"):
+            self._read()  # another process may have written since we loaded
+            self._version = f"{time.time_ns():x}"
+            yield
+
+    def _save(self, name: str, arr: np.ndarray) -> None:
+        f = f"{name}-{self._version}.npy"
+        np.save(self.path / f, arr)
+        self.meta["files"][name] = f
+        setattr(self, name, arr)
+
+    def _commit(self) -> None:
+        """Switch readers to the files named in self.meta, then drop long-superseded versions."""
+        self.meta["version"] = INDEX_VERSION
+        tmp = self.path / f"meta.json.tmp-{os.getpid()}"
+        tmp.write_text(json.dumps(self.meta, ensure_ascii=False, indent=2), encoding="utf-8")
+        replace(tmp, self.path / "meta.json")
+
+        now = time.time()
+        live = set(self.meta["files"].values())
+        for f in set(self._committed.values()) - live:
+            try:
+                os.utime(self.path / f, (now, now))  # superseded now: removable KEEP_S from now
+            except FileNotFoundError:
+                pass
+        for p in self.path.glob("*.npy"):
+            if p.name not in live and p.name.startswith(ARRAYS) and now - p.stat().st_mtime > KEEP_S:
+                try:
+                    p.unlink()
+                except OSError:
+                    pass  # Windows: still memory-mapped by a reader, retried on a later write
+        self._committed = dict(self.meta["files"])
+
+    def add_track(self, track: str, times: List[str], chunk_embs: np.ndarray, model_id: str) -> None:
+        """Add (or replace) one track's chunk embeddings and write a new version of the index."""
+        chunk_embs = _normalize(chunk_embs)
+        with self._writing():
+            if self.meta["model"] not in (None, model_id):
+                raise ValueError(f"Index was built with {self.meta['model']}, not {model_id}.")
+            if self.meta["dim"] not in (None, chunk_embs.shape[1]):
+                raise ValueError(f"Index dim is {self.meta['dim']}, got {chunk_embs.shape[1]}.")
+
+            old = [t for t in self.meta["tracks"] if t["track"] != track]
+            parts = [np.asarray(self.chunks[t["start"]:t["end"]]) for t in old]
+            entries = []
+            row = 0
+            for t, part in zip(old, parts):
+                entries.append({**t, "start": row, "end": row + len(part)})
+                row += len(part)
+            entries.append({
+                "track": track,
+                "name": Path(track).name,
+                "start": row,
+                "end": row + len(chunk_embs),
+                "times": list(times),
+            })
+            parts.append(chunk_embs)
+
+            chunks = np.concatenate(parts, axis=0).astype(np.float32)
+            del parts
+            tracks = _normalize(np.stack([chunks[e["start"]:e["end"]].mean(axis=0) for e in entries]))
+
+            self._save("chunks", chunks)
+            self._save("tracks", tracks)
+            self.meta.update({"model": model_id, "dim": int(chunks.shape[1]), "tracks": entries})
+            if self.ivf_centroids is not None:
+                self._write_lists(np.asarray(self.ivf_centroids))
+            self._commit()
+
+    def build_ivf(self, nlist: Optional[int] = None, iters: int = 10, seed: int = 0) -> None:
+        """(Re)build the coarse quantizer and inverted lists over all chunks."""
+        with self._writing():
+            x = np.asarray(self.chunks)
+            nlist = nlist or max(1, int(np.sqrt(len(x))))
+            nlist = min(nlist, len(x))
+            train = x if len(x) <= 50_000 else x[np.random.default_rng(seed).choice(len(x), 50_000, replace=False)]
+            centroids = spherical_kmeans(train, nlist, iters=iters, seed=seed)
+
+            self._save("ivf_centroids", centroids)
+            self.meta["ivf_trained_on"] = len(x)
+            self._write_lists(centroids)
+            self._commit()
+
+    def _write_lists(self, centroids: np.ndarray) -> None:
+        """Assign every chunk to its closest centroid and store the inverted lists."""
+        x = np.asarray(self.chunks)
+        assign = np.argmax(x @ centroids.T, axis=1)
+        rows = np.argsort(assign, kind="stable").astype(np.int64)
+        offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assign, minlength=len(centroids)))
+
+        self._save("ivf_offsets", offsets)
+        self._save("ivf_rows", rows)
+
+    def maybe_rebuild_ivf(self, min_chunks: int = 10_000) -> bool:
+        """Retrain the IVF once the index is big enough and has doubled since the last training."""
+        if self.n_chunks < min_chunks or self.n_chunks <= 2 * self.meta.get("ivf_trained_on", 0):
+            return False
+        self.build_ivf()
+        return True
+
+    # ---------- queries ----------
+
+    def chunk_vector(self, track: str, chunk: int) -> np.ndarray:
+        for t in self.meta["tracks"]:
+            if track in (t["track"], t["name"]):
+                if not 0 <= chunk < t["end"] - t["start"]:
+                    raise IndexError(f"{t['name']} has {t['end'] - t['start']} chunks.")
+                return np.asarray(self.chunks[t["start"] + chunk])
+        raise KeyError(f"Track not in index: {track}")
+
+    def _chunk_ref(self, row: int) -> Dict[str, Any]:
+        # tracks are stored contiguously and in order: binary search on start rows
+        starts = [t["start"] for t in self.meta["tracks"]]
+        ti = int(np.searchsorted(starts, row, side="right")) - 1
+        t = self.meta["tracks"][ti]
+        return {"track": t["name"], "chunk": row - t["start"], "time": t["times"][row - t["start"]]}
+
+    def search_chunks(self, query: np.ndarray, k: int = 10, nprobe: int = 8) -> List[Dict[str, Any]]:
+        """Most similar chunks across the library (IVF if fresh, else exact)."""
+        if self.n_chunks == 0:
+            return []
+        q = _normalize(query).reshape(-1)
+        if self.ivf_fresh():
+            lists = np.argsort(-(self.ivf_centroids @ q))[:nprobe]
+            rows = np.concatenate([self.ivf_rows[self.ivf_offsets[c]:self.ivf_offsets[c + 1]] for c in lists])
+            rows = np.sort(rows)  # sequential reads from the memory map
+        else:
+            rows = np.arange(self.n_chunks)
+        scores = np.asarray(self.chunks[rows]) @ q
+        top = np.argsort(-scores)[:k]
+        return [{**self._chunk_ref(int(rows[i])), "score": float(scores[i])} for i in top]
+
+    def search_tracks(self, query: np.ndarray, k: int = 10) -> List[Dict[str, Any]]:
+        """Tracks whose pooled vector is most similar to the query."""
+        if len(self) == 0:
+            return []
+        q = _normalize(query).reshape(-1)
+        scores = np.asarray(self.tracks) @ q
+        top = np.argsort(-scores)[:k]
+        return [{"track": self.meta["tracks"][i]["name"], "score": float(scores[i])} for i in top]
+
+
+def embed_text_query(text: str, clap_path: Optional[str] = None) -> np.ndarray:
+    """CLAP text embedding of a query, prompt-ensembled like labelbank labels."""
+    import torch
+
+    from build_label_v2 import CAPTION_WRAPPERS, expand_prompts
+    from clap_local_v2 import compute_label_embeddings_from_labelbank, load_clap
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    processor, model = load_clap(device, clap_path)
+    bank = [{"label": text, "synonyms": [], "prompts": expand_prompts(CAPTION_WRAPPERS, text)}]
+    _labels, mat = compute_label_embeddings_from_labelbank(processor, model, bank, device)
+    return mat[0].numpy()
+
+
+def main():
+    p = argparse.ArgumentParser(description="Query the library of analyzed tracks.")
+    p.add_argument("--index", required=True, help="Track index directory (clap_local_v2.py --index)")
+    p.add_argument("--text", default=None, help="Text prompt query")
+    p.add_argument("--track", default=None, help="Query by a chunk of an indexed track (path or file name)")
+    p.add_argument("--chunk", type=int, default=0, help="Chunk number for --track")
+    p.add_argument("--tracks", action="store_true", help="Return whole tracks instead of segments")
+    p.add_argument("--clap_path", default=None, help="Local CLAP snapshot for --text (no Hub lookup)")
+    p.add_argument("--k", type=int, default=10)
+    p.add_argument("--nprobe", type=int, default=8, help="IVF lists to probe (chunk search)")
+    p.add_argument("--build_ivf", action="store_true", help="Rebuild the IVF lists before querying")
+    p.add_argument("--nlist", type=int, default=None, help="IVF list count (default sqrt(#chunks))")
+    args = p.parse_args()
+
+    index = TrackIndex(args.index)
+    print(f"Index: {len(index)} tracks, {index.n_chunks} chunks, IVF {'on' if index.ivf_fresh() else 'off (exact search)'}")
+
+    if args.build_ivf:
+        t0 = time.perf_counter()
+        index.build_ivf(nlist=args.nlist)
+        print(f"Built IVF ({len(index.ivf_centroids)} lists) in {time.perf_counter() - t0:.2f}s")
+
+    if args.text:
+        query = embed_text_query(args.text, args.clap_path)
+    elif args.track:
+        query = index.chunk_vector(args.track, args.chunk)
+    else:
+        return
+
+    t0 = time.perf_counter()
+    if args.tracks:
+        hits = index.search_tracks(query, k=args.k)
+    else:
+        hits = index.search_chunks(query, k=args.k, nprobe=args.nprobe)
+    elapsed_ms = (time.perf_counter() - t0) * 1000
+
+    print(json.dumps(hits, indent=2, ensure_ascii=False))
+    print(f"\nQuery time: {elapsed_ms:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
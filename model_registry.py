@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Local model snapshots for offline runs.
+
+The pipeline loads two Hugging Face models: CLAP (laion/clap-htsat-fused) in
+audioAnalysis and the story LLM in storyCreation. Left alone, from_pretrained
+resolves both against the Hub at startup, which is slow and fails on offline
+hosts. With a registry BARD.py points each stage at a pinned local snapshot
+and runs the stages with HF_HUB_OFFLINE=1.
+
+A snapshot is looked up, in this order:
+  1. the --models JSON file: {"laion/clap-htsat-fused": "/models/clap", ...}
+     (relative paths are relative to the file)
+  2. --model_dir/<org>--<name> or --model_dir/<org>/<name>
+     (huggingface-cli download <id> --local-dir ...)
+  3. --model_dir/models--<org>--<name>/snapshots/<revision>
+     (a Hugging Face cache directory; the revision refs/main points to)
+
+check_snapshot lists the files a stage needs that are missing, so a broken
+snapshot fails in a second instead of after the audio analysis. Stdlib only
+(it never imports torch, not even to look for CUDA): it runs before the
+pipeline's heavy imports.
+
+  python model_registry.py --model_dir /models laion/clap-htsat-fused mistralai/Mistral-7B-Instruct-v0.2
+"""
+
+import argparse
+import importlib.util
+import json
+import re
+import shutil
+import subprocess
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+CLAP_MODEL_ID = "laion/clap-htsat-fused"
+# the story script's defaults (storyCreation/story_from_description.py DEFAULT_MODEL / DEFAULT_CPU_MODEL)
+STORY_MODEL_ID = "mistralai/Mistral-7B-Instruct-v0.2"
+STORY_CPU_MODEL_ID = "Qwen/Qwen2.5-1.5B-Instruct"
+
+WEIGHT_FILES = ("model.safetensors", "model.safetensors.index.json", "pytorch_model.bin", "pytorch_model.bin.index.json")
+
+# every group must have one of its files
+REQUIRED_FILES = {
+    "clap": [("config.json",), ("preprocessor_config.json", "processor_config.json"), ("tokenizer.json", "vocab.json"),
+             WEIGHT_FILES],
+    "causal-lm": [("config.json",), ("tokenizer_config.json",), ("tokenizer.json", "tokenizer.model"), WEIGHT_FILES],
+}
+
+
+def has_cuda() -> bool:
+    """
+    torch.cuda.is_available() without importing torch (seconds): a CUDA build
+    of torch (torch/version.py names a CUDA version) and a GPU listed by
+    nvidia-smi.
+    """
+    spec = importlib.util.find_spec("torch")
+    if spec is None or not spec.submodule_search_locations:
+        return False
+    version_py = Path(list(spec.submodule_search_locations)[0]) / "version.py"
+    if not version_py.exists() or not re.search(r"^cuda\b[^=\n]*=\s*['\"]", version_py.read_text(encoding="utf-8"), re.M):
+        return False
+    smi = shutil.which("nvidia-smi")
+    if smi is None:
+        return False
+    try:
+        out = subprocess.run([smi, "-L"], capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return out.returncode == 0 and "GPU" in out.stdout
+
+
+def default_story_model() -> str:
+    """The story model story_from_description picks without --model: Mistral on CUDA, the small CPU model otherwise."""
+    return STORY_MODEL_ID if has_cuda() else STORY_CPU_MODEL_ID
+
+
+def load_registry(path: Optional[str]) -> Dict[str, str]:
+    """{model id: local directory} from a --models file (relative paths resolved against the file)."""
+    if not path:
+        return {}
+    data = json.loads(Path(path).read_text(encoding="utf-8"))
+    if not isinstance(data, dict):
+        raise ValueError(f"{path}: expected a JSON object of model id -> directory.")
+    base = Path(path).resolve().parent
+    return {model_id: str((base / Path(d).expanduser()).resolve()) for model_id, d in data.items()}
+
+
+def resolve(model_id: str, model_dir: Optional[str] = None, registry: Optional[Dict[str, str]] = None) -> Optional[Path]:
+    """Local snapshot directory of model_id, or None if there is none."""
+    if registry and model_id in registry:
+        return Path(registry[model_id])
+    if Path(model_id).expanduser().is_dir():
+        return Path(model_id).expanduser().resolve()  # already a local path
+    if not model_dir:
+        return None
+
+    root = Path(model_dir).expanduser()
+    for cand in (root / model_id.replace("/", "--"), root / model_id):
+        if (cand / "config.json").exists():
+            return cand.resolve()
+
+    cache = root / f"models--{model_id.replace('/', '--')}"
+    ref = cache / "refs" / "main"
+    if ref.exists():
+        return (cache / "snapshots" / ref.read_text(encoding="utf-8").strip()).resolve()
+    revisions = sorted((cache / "snapshots").glob("*")) if (cache / "snapshots").is_dir() else []
+    if len(revisions) == 1:
+        return revisions[0].resolve()
+    return None
+
+
+def check_snapshot(path: Path, kind: str) -> List[str]:
+    """Missing files of a snapshot for a model of this kind ("clap" / "causal-lm")."""
+    if not path.is_dir():
+        return [f"{path} does not exist"]
+    missing = [" or ".join(group) for group in REQUIRED_FILES[kind] if not any((path / f).exists() for f in group)]
+    for index in ("model.safetensors.index.json", "pytorch_model.bin.index.json"):
+        if (path / index).exists():
+            shards = set(json.loads((path / index).read_text(encoding="utf-8"))["weight_map"].values())
+            missing += sorted(s for s in shards if not (path / s).exists())
+    return missing
+
+
+def preflight(stages: List[Tuple[str, str, str]], model_dir: Optional[str] = None,
+              registry_path: Optional[str] = None) -> Dict[str, str]:
+    """
+    stages: (stage name, model id, kind). Returns {model id: local directory};
+    raises FileNotFoundError listing every stage whose snapshot is missing or
+    incomplete.
+    """
+    registry = load_registry(registry_path)
+    resolved: Dict[str, str] = {}
+    problems = []
+    for stage, model_id, kind in stages:
+        path = resolve(model_id, model_dir, registry)
+        if path is None:
+            problems.append(f"{stage}: no local snapshot of {model_id}")
+            continue
+        missing = check_snapshot(path, kind)
+        if missing:
+            problems.append(f"{stage}: {model_id} at {path} is missing {', '.join(missing)}")
+            continue
+        resolved[model_id] = str(path)
+        print(f"[models] {stage}: {model_id} -> {path}")
+    if problems:
+        raise FileNotFoundError("Offline model check failed:\n  " + "\n  ".join(problems))
+    return resolved
+
+
+def main():
+    p = argparse.ArgumentParser(description="Check that local snapshots of the pipeline's models are complete.")
+    p.add_argument("model_ids", nargs="*", default=None,
+                   help="Model ids to check (default: CLAP and the story model this host would use)")
+    p.add_argument("--model_dir", default=None, help="Directory holding the snapshots (or a Hugging Face cache)")
+    p.add_argument("--models", default=None, help="JSON registry: {model id: local directory}")
+    args = p.parse_args()
+    args.model_ids = args.model_ids or [CLAP_MODEL_ID, default_story_model()]
+
+    stages = [(m, m, "clap" if "clap" in m.lower() else "causal-lm") for m in args.model_ids]
+    try:
+        preflight(stages, args.model_dir, args.models)
+    except FileNotFoundError as e:
+        raise SystemExit(str(e))
+    print("[models] all snapshots complete")
+
+
+if __name__ == "__main__":
+    main()
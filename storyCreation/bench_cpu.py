@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+CPU story-generation benchmark: load time, decode tokens/sec and peak RSS for
+the old float32 fallback vs. the weight-only CPU path (bfloat16 / int8 / int4).
+
+Each configuration runs in its own process so peak RSS is not shared.
+
+  python bench_cpu.py --model Qwen/Qwen2.5-1.5B-Instruct
+  python bench_cpu.py --model mistralai/Mistral-7B-Instruct-v0.2 --configs fp32_fallback int4
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+CONFIGS = ["fp32_fallback", "bf16", "int8", "int4"]
+
+PROMPT = (
+    "Write scene 1 of a short tale set in a lighthouse in 1923. "
+    "About 90 words. End with a complete sentence."
+)
+
+
+def peak_rss_mb() -> float:
+    try:
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on Linux
+    except ImportError:  # Windows
+        import psutil
+
+        return psutil.Process().memory_info().peak_wset / 2**20
+
+
+def rss_mb() -> float:
+    import psutil
+
+    return psutil.Process().memory_info().rss / 2**20
+
+
+def run_config(model_id: str, config: str, new_tokens: int, threads) -> dict:
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    from cpu_quant import set_cpu_threads
+    from story_from_description import inst_template, load_model_cpu, mistral_inst
+
+    t0 = time.perf_counter()
+    tokenizer = AutoTokenizer.from_pretrained(model_id, use_fast=True)
+    if config == "fp32_fallback":
+        # what load_model did on CPU before: full precision, device_map="auto"
+        n_threads = torch.get_num_threads()
+        model = AutoModelForCausalLM.from_pretrained(model_id, device_map="auto", dtype=torch.float32)
+    else:
+        n_threads = set_cpu_threads(threads)
+        model = load_model_cpu(model_id, quant="none" if config == "bf16" else config, threads=threads)
+    model.eval()
+    load_s = time.perf_counter() - t0
+
+    inputs = tokenizer(mistral_inst(PROMPT, inst_template(tokenizer)), return_tensors="pt")
+    gen = dict(
+        do_sample=False,
+        min_new_tokens=new_tokens,
+        max_new_tokens=new_tokens,
+        pad_token_id=tokenizer.eos_token_id,
+    )
+    with torch.inference_mode():
+        model.generate(**inputs, **{**gen, "min_new_tokens": 4, "max_new_tokens": 4})  # warm-up
+        t0 = time.perf_counter()
+        out = model.generate(**inputs, **gen)
+        gen_s = time.perf_counter() - t0
+    n = out.shape[-1] - inputs["input_ids"].shape[-1]
+
+    return {
+        "config": config,
+        "threads": n_threads,
+        "load_s": round(load_s, 2),
+        "tokens": int(n),
+        "tok_per_s": round(n / gen_s, 2),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "rss_mb": round(rss_mb(), 1),  # after loading/quantization transients are gone
+    }
+
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark CPU story generation (tokens/sec, peak RSS).")
+    p.add_argument("--model", default="Qwen/Qwen2.5-1.5B-Instruct", help="HF model id or local path")
+    p.add_argument("--configs", nargs="+", choices=CONFIGS, default=CONFIGS)
+    p.add_argument("--new_tokens", type=int, default=64, help="Tokens decoded per measurement")
+    p.add_argument("--threads", type=int, default=None, help="CPU threads (default: physical cores)")
+    p.add_argument("--worker", choices=CONFIGS, default=None, help=argparse.SUPPRESS)
+    args = p.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_config(args.model, args.worker, args.new_tokens, args.threads)))
+        return
+
+    results = []
+    for config in args.configs:
+        cmd = [sys.executable, __file__, "--model", args.model, "--worker", config, "--new_tokens", str(args.new_tokens)]
+        if args.threads:
+            cmd += ["--threads", str(args.threads)]
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(f"[bench] {config} failed:\n{proc.stderr.strip()[-2000:]}")
+            continue
+        results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+        r = results[-1]
+        print(
+            f"[bench] {config:14s} load {r['load_s']:7.2f}s  {r['tok_per_s']:8.2f} tok/s  "
+            f"peak RSS {r['peak_rss_mb']:9.1f} MB  RSS {r['rss_mb']:9.1f} MB  ({r['threads']} threads)",
+            flush=True,
+        )
+
+    base = next((r for r in results if r["config"] == "fp32_fallback"), None)
+    if base:
+        for r in results:
+            if r is not base:
+                print(
+                    f"[bench] {r['config']}: {r['tok_per_s'] / base['tok_per_s']:.2f}x tok/s, "
+                    f"{r['peak_rss_mb'] / base['peak_rss_mb']:.2f}x peak RSS, "
+                    f"{r['rss_mb'] / base['rss_mb']:.2f}x RSS vs fp32_fallback"
+                )
+
+
+if __name__ == "__main__":
+    main()
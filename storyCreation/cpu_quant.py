@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Weight-only INT8 / INT4 quantization for CPU inference (no CUDA, no bitsandbytes).
+
+Every nn.Linear of the model is replaced by a WeightOnlyLinear that keeps its
+weight as int8 (per output channel scales) or packed int4 (asymmetric, per
+group of input channels) and multiplies with torch's CPU kernels
+(aten._weight_int8pack_mm / aten._weight_int4pack_mm_for_cpu). Activations
+stay bfloat16. A 7B model takes ~7.5 GB in int8 and ~4 GB in int4 instead of
+28 GB in float32.
+
+save_quantized / load_quantized keep the quantized model in a directory
+(config + tokenizer + one torch file, memory-mapped on load), so later runs
+skip reading and re-quantizing the full-precision checkpoint.
+"""
+
+import ctypes
+import gc
+import json
+import os
+import sys
+from pathlib import Path
+from typing import Optional
+
+import torch
+from torch import nn
+
+
+# Rows per call above which int8 layers dequantize instead of using the kernel
+DEQUANT_ROWS = 16
+
+
+def physical_cores() -> int:
+    try:
+        import psutil
+
+        return psutil.cpu_count(logical=False) or os.cpu_count() or 1
+    except ImportError:
+        return os.cpu_count() or 1
+
+
+def set_cpu_threads(threads: Optional[int] = None) -> int:
+    """
+    One intra-op thread per physical core (hyper-threads only add contention
+    in matmuls); decoding is sequential, so a single inter-op thread.
+    """
+    threads = threads or physical_cores()
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # already set (only allowed before the first parallel op)
+    return threads
+
+
+def _int4_layout(in_features: int, group_size: int):
+    """(group_size, inner_k_tiles) the int4 kernel accepts for this width, or None."""
+    groups = [g for g in (group_size, 128, 64, 32) if g <= group_size and in_features % g == 0]
+    tiles = [t for t in (8, 4, 2) if in_features % (t * 16) == 0]
+    if not groups or not tiles:
+        return None
+    return groups[0], tiles[0]
+
+
+class WeightOnlyLinear(nn.Module):
+    """nn.Linear replacement with int8 or int4 weights and bfloat16 activations."""
+
+    def __init__(self, in_features: int, out_features: int, bits: int, group_size: int = 0, bias: bool = False):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.group_size = group_size
+        if bits == 8:
+            self.register_buffer("weight_q", torch.empty(out_features, in_features, dtype=torch.int8))
+            self.register_buffer("scales", torch.empty(out_features, dtype=torch.bfloat16))
+        else:
+            self.register_buffer("weight_q", torch.empty(0, dtype=torch.uint8))  # packed by the CPU kernel
+            self.register_buffer(
+                "scales", torch.empty(in_features // group_size, out_features, 2, dtype=torch.bfloat16)
+            )
+        self.register_buffer("bias", torch.empty(out_features, dtype=torch.bfloat16) if bias else None)
+
+    @classmethod
+    def from_linear(cls, linear: nn.Linear, bits: int, group_size: int = 128) -> Optional["WeightOnlyLinear"]:
+        """Quantize one layer; None if its shape does not fit the int4 kernel."""
+        w = linear.weight.detach().float()
+        n, k = w.shape
+        if bits == 8:
+            layer = cls(k, n, 8, bias=linear.bias is not None)
+            scales = w.abs().amax(dim=1).clamp(min=1e-8) / 127.0
+            layer.weight_q = (w / scales[:, None]).round().clamp(-128, 127).to(torch.int8)
+            layer.scales = scales.to(torch.bfloat16)
+        else:
+            layout = _int4_layout(k, group_size)
+            if layout is None:
+                return None
+            group_size, inner_k_tiles = layout
+            layer = cls(k, n, 4, group_size=group_size, bias=linear.bias is not None)
+            groups = w.reshape(-1, group_size)
+            lo, hi = groups.amin(dim=1, keepdim=True), groups.amax(dim=1, keepdim=True)
+            scales = (hi - lo).clamp(min=1e-6) / 15.0
+            zeros = lo + scales * 8  # the kernel computes (q - 8) * scale + zero
+            q = groups.sub(lo).div(scales).round().clamp(0, 15).to(torch.int32).reshape(n, k)
+            layer.weight_q = torch.ops.aten._convert_weight_to_int4pack_for_cpu(q, inner_k_tiles)
+            layer.scales = (
+                torch.cat([scales.reshape(n, -1, 1), zeros.reshape(n, -1, 1)], dim=2)
+                .transpose(0, 1)
+                .contiguous()
+                .to(torch.bfloat16)
+            )
+        if linear.bias is not None:
+            layer.bias = linear.bias.detach().to(torch.bfloat16)
+        return layer
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        shape = x.shape
+        x2 = x.reshape(-1, self.in_features).to(torch.bfloat16)
+        if self.bits == 8 and x2.shape[0] > DEQUANT_ROWS:
+            # prefill of long / batched prompts: one dequantized bf16 matmul beats the
+            # weight-only kernel (~10x at 500+ rows)
+            y = nn.functional.linear(x2, self.weight_q.to(torch.bfloat16) * self.scales[:, None])
+        elif self.bits == 8:
+            y = torch.ops.aten._weight_int8pack_mm(x2, self.weight_q, self.scales)
+        else:
+            y = torch.ops.aten._weight_int4pack_mm_for_cpu(x2, self.weight_q, self.group_size, self.scales)
+        if self.bias is not None:
+            y = y + self.bias
+        return y.reshape(*shape[:-1], self.out_features).to(x.dtype)
+
+    def extra_repr(self) -> str:
+        g = f", group_size={self.group_size}" if self.bits == 4 else ""
+        return f"in_features={self.in_features}, out_features={self.out_features}, bits={self.bits}{g}"
+
+
+def release_freed_memory() -> None:
+    """Hand freed float temporaries back to the OS (glibc keeps them in its heap otherwise)."""
+    gc.collect()
+    if sys.platform.startswith("linux"):
+        try:
+            ctypes.CDLL("libc.so.6").malloc_trim(0)
+        except OSError:
+            pass
+
+
+def quantize_weights(model: nn.Module, bits: int = 8, group_size: int = 128) -> nn.Module:
+    """
+    Replace every nn.Linear with a WeightOnlyLinear, layer by layer (the float
+    weights are released as we go, so peak memory stays near the bf16 size).
+    With bits=4 the output head stays int8: it is the most quantization-
+    sensitive layer and a small share of the weights.
+    """
+    if bits not in (4, 8):
+        raise ValueError(f"bits must be 4 or 8, got {bits}")
+    if bits == 4 and not hasattr(torch.ops.aten, "_weight_int4pack_mm_for_cpu"):
+        raise RuntimeError(
+            f"int4 needs torch's CPU int4 kernel (torch >= 2.6); torch {torch.__version__} has none. "
+            "Upgrade torch or use --cpu_quant int8."
+        )
+    head = model.get_output_embeddings() if hasattr(model, "get_output_embeddings") else None
+    for _name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            if not isinstance(child, nn.Linear):
+                continue
+            layer_bits = 8 if child is head else bits
+            q = WeightOnlyLinear.from_linear(child, layer_bits, group_size)
+            if q is None and layer_bits == 4:
+                q = WeightOnlyLinear.from_linear(child, 8)
+            setattr(module, child_name, q)
+    release_freed_memory()
+    return model
+
+
+QUANT_FORMAT_VERSION = 1
+
+
+def save_quantized(model: nn.Module, tokenizer, path: str, source_model: str) -> None:
+    """Write a quantized model (and its tokenizer) for load_quantized."""
+    out = Path(path)
+    out.mkdir(parents=True, exist_ok=True)
+    layers = {
+        name: [m.in_features, m.out_features, m.bits, m.group_size, m.bias is not None]
+        for name, m in model.named_modules()
+        if isinstance(m, WeightOnlyLinear)
+    }
+    # non-persistent buffers too (e.g. rotary inv_freq): the skeleton is built on the meta device
+    tensors = {name: t.detach() for name, t in model.named_parameters()}
+    tensors.update({name: t for name, t in model.named_buffers()})
+    torch.save(tensors, out / "weights.pt")
+    model.config.save_pretrained(out)
+    tokenizer.save_pretrained(out)
+    meta = {
+        "version": QUANT_FORMAT_VERSION,
+        "source_model": source_model,
+        "quant": getattr(model, "cpu_quant", "none"),
+        "torch": torch.__version__,
+        "layers": layers,
+    }
+    # meta last: a directory without it is not a complete snapshot
+    (out / "quant_meta.json").write_text(json.dumps(meta, indent=2), encoding="utf-8")
+
+
+def load_quantized(path: str) -> Optional[nn.Module]:
+    """
+    Model saved by save_quantized, with its tensors memory-mapped from
+    weights.pt (pages are read on first use). None if the directory is
+    missing, incomplete or was written by another torch version (the packed
+    int4 layout belongs to torch's CPU kernel).
+    """
+    from transformers import AutoConfig, AutoModelForCausalLM
+
+    src = Path(path)
+    meta_path = src / "quant_meta.json"
+    if not meta_path.exists():
+        return None
+    meta = json.loads(meta_path.read_text(encoding="utf-8"))
+    if meta.get("version") != QUANT_FORMAT_VERSION or meta.get("torch") != torch.__version__:
+        print(f"[quant] {path} was written by torch {meta.get('torch')}; re-quantizing.")
+        return None
+
+    config = AutoConfig.from_pretrained(src)
+    with torch.device("meta"):
+        model = AutoModelForCausalLM.from_config(config, dtype=torch.bfloat16)
+        for name, (k, n, bits, group_size, bias) in meta["layers"].items():
+            parent, _, child = name.rpartition(".")
+            setattr(model.get_submodule(parent), child, WeightOnlyLinear(k, n, bits, group_size, bias))
+
+    tensors = torch.load(src / "weights.pt", mmap=True, weights_only=True, map_location="cpu")
+    for name, t in tensors.items():
+        parent, _, attr = name.rpartition(".")
+        module = model.get_submodule(parent)
+        if attr in module._parameters:
+            module._parameters[attr] = nn.Parameter(t, requires_grad=False)
+        else:
+            module._buffers[attr] = t
+    if hasattr(model, "tie_weights") and model.get_output_embeddings() is not None \
+            and not isinstance(model.get_output_embeddings(), WeightOnlyLinear):
+        model.tie_weights()
+
+    missing = [name for name, t in list(model.named_parameters()) + list(model.named_buffers()) if t.is_meta]
+    if missing:
+        raise ValueError(f"{path}: no saved values for {missing[:5]}")
+    model.cpu_quant = meta["quant"]
+    model.eval()
+    return model
@@ -2,23 +2,71 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import copy
+import hashlib
 import json
+import os
 import random
-from typing import Any, Dict, List, Tuple, Optional
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Tuple, Optional
 
 import re  # <-- add at top
 
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
+from transformers import (
+    AutoTokenizer,
+    AutoModelForCausalLM,
+    BitsAndBytesConfig,
+    DynamicCache,
+    LogitsProcessor,
+    StoppingCriteria,
+    TextIteratorStreamer,
+)
 
 
 MOOD_LABELS = ["ENERGETIC", "SOLO", "CALM", "DEEP", "DISSONANT", "ANXIOUS"]
 
+DEFAULT_MODEL = "mistralai/Mistral-7B-Instruct-v0.2"
+DEFAULT_CPU_MODEL = "Qwen/Qwen2.5-1.5B-Instruct"  # used without CUDA unless --model is given
+
 
 # ---------- small utilities ----------
 
-def mistral_inst(user_text: str) -> str:
-    return f"<s>[INST] {user_text.strip()} [/INST]"
+# Instruction wrapper around every prompt, (open, close): Mistral [INST] tags
+# by default, the tokenizer's own chat template for other models (inst_template).
+Inst = Tuple[str, str]
+MISTRAL_INST: Inst = ("<s>[INST] ", " [/INST]")
+
+
+def inst_template(tokenizer) -> Inst:
+    """tokenizer's chat template split around the user prompt, or MISTRAL_INST for [INST] models."""
+    template = getattr(tokenizer, "chat_template", None)
+    if not template or "[INST]" in str(template):
+        return MISTRAL_INST
+    marker = "\u0000PROMPT\u0000"
+    rendered = tokenizer.apply_chat_template(
+        [{"role": "user", "content": marker}], tokenize=False, add_generation_prompt=True
+    )
+    inst_open, inst_close = rendered.split(marker)
+    return inst_open, inst_close
+
+
+def mistral_inst(user_text: str, inst: Inst = MISTRAL_INST) -> str:
+    return f"{inst[0]}{user_text.strip()}{inst[1]}"
+
+
+# mistral_inst split in two: a prefix identical for every fragment of a run
+# (its KV cache is reused) and a per-fragment tail. prefix + tail is one prompt.
+
+def mistral_inst_prefix(shared_text: str, inst: Inst = MISTRAL_INST) -> str:
+    return f"{inst[0]}{shared_text.strip()}\n\n"
+
+
+def mistral_inst_tail(tail_text: str, inst: Inst = MISTRAL_INST) -> str:
+    return f"{tail_text.strip()}{inst[1]}"
 
 
 
@@ -64,11 +112,41 @@ def truncate_to_words(text: str, n_words: int) -> str:
 
 
 
-def estimate_max_new_tokens(target_words: int) -> int:
+def estimate_max_new_tokens(target_words: int, tokens_per_word: Optional[float] = None) -> int:
     # Rough but effective: tokens ~= words * (1.2..1.6). Keep tight for speed.
     if not target_words or target_words <= 0:
         return 180
-    return max(48, int(target_words * 1.45))
+    if tokens_per_word is None:
+        return max(48, int(target_words * 1.45))
+    # Calibrated ratio (see update_calibration): room to finish the last sentence
+    # plus the MOOD/TEXT header. WordBudgetStopping normally ends decoding earlier.
+    return max(48, int(target_words * tokens_per_word * 1.35) + 12)
+
+
+def load_calibration(path: str) -> Dict[str, Any]:
+    p = Path(path)
+    return json.loads(p.read_text(encoding="utf-8")) if p.exists() else {}
+
+
+def calibrated_tokens_per_word(calib: Dict[str, Any], model_id: str) -> Optional[float]:
+    entry = calib.get(model_id)
+    if not entry or entry.get("words", 0) < 50:
+        return None
+    return entry["tokens"] / entry["words"]
+
+
+def update_calibration(path: str, model_id: str, tokens: int, words: int, decay: float = 0.8) -> float:
+    """Add one run's kept tokens/words for model_id (older runs fade by decay); returns the new ratio."""
+    calib = load_calibration(path)
+    entry = calib.get(model_id, {"tokens": 0.0, "words": 0.0, "runs": 0})
+    entry = {
+        "tokens": entry["tokens"] * decay + tokens,
+        "words": entry["words"] * decay + words,
+        "runs": entry["runs"] + 1,
+    }
+    calib[model_id] = entry
+    Path(path).write_text(json.dumps(calib, indent=2), encoding="utf-8")
+    return entry["tokens"] / max(entry["words"], 1e-9)
 
 
 def parse_block(raw: str) -> Tuple[str, str, str]:
@@ -108,15 +186,129 @@ def parse_block(raw: str) -> Tuple[str, str, str]:
     return mood, text, facts
 
 
+def parse_fallbacks(raw: str, need_facts: bool = False) -> List[str]:
+    """Which parts parse_block had to guess: "mood" (CALM used), "text" (no TEXT: header), "facts"."""
+    lines = [ln.strip().upper() for ln in raw.strip().splitlines()[:10]]
+    mood_line = next((ln for ln in lines if ln.startswith("MOOD:")), None)
+    missing = []
+    if mood_line is None or mood_line.split(":", 1)[1].strip() not in MOOD_LABELS:
+        missing.append("mood")
+    if "TEXT:" not in raw.upper():
+        missing.append("text")
+    if need_facts and not parse_block(raw)[2]:
+        missing.append("facts")
+    return missing
+
+
 
 
 # ---------- model loading / generation ----------
 
-def load_model(model_id: str, use_4bit: bool = True):
-    tokenizer = AutoTokenizer.from_pretrained(model_id, use_fast=True)
+def quantized_snapshot_dir(root: str, model_id: str, mode: str) -> Path:
+    """Where --quantized_dir keeps one model in one quantization mode."""
+    name = model_id.strip("/\\").replace("/", "--").replace("\\", "--").replace(":", "")
+    return Path(root) / f"{name}-{mode}"
+
+
+def publish_snapshot(snapshot: Path, write, keep_s: float = 3600.0) -> None:
+    """
+    write(directory) into a temp dir next to snapshot, then rename it into
+    place: a run killed (or a disk filling up) mid-save leaves no half-written
+    snapshot for later runs to load. A stale snapshot is renamed aside, never
+    deleted in place: a concurrent run sees the old or the new one (or, in
+    between, none and loads the model itself), and one still reading the old
+    one has keep_s before a later publish removes it.
+    """
+    tmp = Path(f"{snapshot}.tmp-{os.getpid()}")
+    if tmp.exists():
+        shutil.rmtree(tmp)
+    try:
+        write(tmp)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+    for old in snapshot.parent.glob(f"{snapshot.name}.old-*"):
+        try:
+            if time.time() - old.stat().st_mtime > keep_s:
+                shutil.rmtree(old, ignore_errors=True)
+        except FileNotFoundError:
+            pass  # removed by a concurrent run
+    aside = Path(f"{snapshot}.old-{time.time_ns():x}-{os.getpid()}")
+    try:
+        os.replace(snapshot, aside)  # stale snapshot (e.g. written by another torch version)
+        os.utime(aside)  # mtime = when it was replaced
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        # Windows: the stale snapshot is still open in another process
+        print(f"[load] could not replace {snapshot} ({e}); keeping it")
+        shutil.rmtree(tmp, ignore_errors=True)
+        return
+    try:
+        os.replace(tmp, snapshot)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)  # another run published first: keep its snapshot
+
+
+def load_model(
+    model_id: str,
+    use_4bit: bool = True,
+    cpu_quant: str = "int8",
+    threads: Optional[int] = None,
+    quantized_dir: Optional[str] = None,
+    model_path: Optional[str] = None,
+):
+    """
+    With quantized_dir, the quantized model is saved there on first use and
+    loaded from there (without re-quantizing) on later runs. model_path: a
+    local snapshot of model_id, read without any Hub lookup (model_id still
+    names the caches). Prints the load time.
+    """
+    t0 = time.perf_counter()
+    cuda = torch.cuda.is_available()
+    mode = ("nf4" if use_4bit else "fp16") if cuda else f"cpu-{cpu_quant}"
+    snapshot = quantized_snapshot_dir(quantized_dir, model_id, mode) if quantized_dir and mode != "fp16" else None
+
+    if snapshot is not None and snapshot.exists():
+        model = None
+        if cuda:
+            # bitsandbytes weights are stored pre-quantized; safetensors are memory-mapped
+            model = AutoModelForCausalLM.from_pretrained(snapshot, device_map="auto", dtype=torch.float16)
+        else:
+            from cpu_quant import load_quantized, set_cpu_threads
+
+            set_cpu_threads(threads)
+            model = load_quantized(str(snapshot))
+        if model is not None:
+            tokenizer = AutoTokenizer.from_pretrained(snapshot, use_fast=True)
+            if tokenizer.pad_token is None:
+                tokenizer.pad_token = tokenizer.eos_token
+            model.eval()
+            if cuda:
+                torch.backends.cuda.matmul.allow_tf32 = True
+            model.load_mode = mode
+            print(f"[load] {mode} model from {snapshot} in {time.perf_counter() - t0:.2f}s")
+            return model, tokenizer
+
+    source = model_path or model_id
+    local = {"local_files_only": True} if model_path else {}
+    tokenizer = AutoTokenizer.from_pretrained(source, use_fast=True, **local)
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
 
+    if not cuda:
+        # bitsandbytes NF4 needs CUDA: use CPU weight-only quantization instead
+        model = load_model_cpu(source, quant=cpu_quant, threads=threads, local_files_only=bool(model_path))
+        model.load_mode = mode
+        print(f"[load] {mode} model from {source} in {time.perf_counter() - t0:.2f}s")
+        if snapshot is not None and cpu_quant != "none":
+            from cpu_quant import save_quantized
+
+            publish_snapshot(snapshot, lambda d: save_quantized(model, tokenizer, str(d), model_id))
+            print(f"[load] saved quantized model to {snapshot}")
+        return model, tokenizer
+
     quant_cfg = None
     if use_4bit:
         quant_cfg = BitsAndBytesConfig(
@@ -128,29 +320,347 @@ def load_model(model_id: str, use_4bit: bool = True):
 
     try:
         model = AutoModelForCausalLM.from_pretrained(
-            model_id,
+            source,
             device_map="auto",
             torch_dtype=torch.float16,
             quantization_config=quant_cfg,
+            **local,
         )
     except Exception as e:
         print("⚠️  4-bit load failed. Falling back to non-quantized load.")
         print(f"Details: {e}")
+        snapshot = None
+        mode = "fp16"
         model = AutoModelForCausalLM.from_pretrained(
-            model_id,
+            source,
             device_map="auto",
             torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
+            **local,
         )
 
     model.eval()
+    model.load_mode = mode  # nf4 / fp16: part of the prefix-cache and checkpoint keys
 
     # Small speed knobs (safe defaults)
     if torch.cuda.is_available():
         torch.backends.cuda.matmul.allow_tf32 = True
 
+    print(f"[load] {mode} model from {source} in {time.perf_counter() - t0:.2f}s")
+    if snapshot is not None:
+        def write(d: Path) -> None:
+            model.save_pretrained(d)
+            tokenizer.save_pretrained(d)
+
+        publish_snapshot(snapshot, write)
+        print(f"[load] saved quantized model to {snapshot}")
     return model, tokenizer
 
 
+def load_model_cpu(model_id: str, quant: str = "int8", threads: Optional[int] = None, local_files_only: bool = False):
+    """bfloat16 model with int8/int4 weight-only Linear layers (quant="none": plain bfloat16)."""
+    from cpu_quant import quantize_weights, set_cpu_threads
+
+    n_threads = set_cpu_threads(threads)
+    model = AutoModelForCausalLM.from_pretrained(
+        model_id, dtype=torch.bfloat16, low_cpu_mem_usage=True, local_files_only=local_files_only
+    )
+    if quant != "none":
+        quantize_weights(model, bits=4 if quant == "int4" else 8)
+    model.eval()
+    model.cpu_quant = quant  # part of the prefix-cache key: quantized KV values differ
+    print(f"[cpu] {quant if quant != 'none' else 'bfloat16'} weights, {n_threads} threads")
+    return model
+
+
+class _FirstStepTimer(LogitsProcessor):
+    """Records when the first decode step starts, i.e. when prefill has finished."""
+
+    def __init__(self):
+        self.t_first: Optional[float] = None
+
+    def __call__(self, input_ids, scores):
+        if self.t_first is None:
+            self.t_first = time.perf_counter()
+        return scores
+
+
+class _ForwardCounter:
+    """Counts forward calls of each model while active (assisted-decoding stats)."""
+
+    def __init__(self, *models):
+        self.models = [m for m in models if m is not None]
+        self.calls = [0] * len(self.models)
+        self._handles = []
+
+    def __enter__(self):
+        for i, m in enumerate(self.models):
+            self._handles.append(m.register_forward_hook(lambda *_a, i=i: self._count(i)))
+        return self
+
+    def _count(self, i: int) -> None:
+        self.calls[i] += 1
+
+    def __exit__(self, *exc):
+        for h in self._handles:
+            h.remove()
+
+
+def _reached_word_target(text: str, n_words: int) -> bool:
+    """True once text has n_words and the sentence running past them has ended (as truncate_to_words cuts)."""
+    words = text.split()
+    if len(words) <= n_words:
+        return False
+    if len(words) >= n_words + 60:  # truncate_to_words' EXTRA: it gives up looking there
+        return True
+    norm = " ".join(words) + (" " if text[-1:].isspace() else "")
+    boundary = len(" ".join(words[:n_words]))
+    m = _SENT_END.search(norm, boundary)
+    # one more character must follow, or a closing quote could still be on its way
+    return m is not None and m.end() < len(norm)
+
+
+class WordBudgetStopping(StoppingCriteria):
+    """
+    Stops decoding where truncate_to_words would cut the TEXT section anyway:
+    at the first sentence end after the word target. With need_facts (scene 1)
+    it keeps going until the FACTS block's last field (SETTING) is complete.
+    """
+
+    _SETTING_LINE = re.compile(r"^\s*SETTING[^\n]*:[^\n]*\S[^\n]*\n", re.M | re.I)
+
+    def __init__(self, tokenizer, n_prompt: int, words: int, need_facts: bool = False):
+        self.tokenizer = tokenizer
+        self.n_prompt = n_prompt
+        self.words = words
+        self.need_facts = need_facts
+
+    def _done(self, text: str) -> bool:
+        u = text.upper()
+        t_pos = u.find("TEXT:")
+        if t_pos == -1:
+            return False
+        f_pos = u.find("FACTS:", t_pos)
+        if self.need_facts:
+            return f_pos != -1 and self._SETTING_LINE.search(text, f_pos) is not None
+        if f_pos != -1:
+            return True  # past TEXT: nothing after this point is kept
+        return _reached_word_target(text[t_pos + 5:], self.words)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = [
+            self._done(self.tokenizer.decode(row[self.n_prompt:], skip_special_tokens=True))
+            for row in input_ids
+        ]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+FACT_FIELDS = [
+    "PROTAGONIST",
+    "SIDE CHARACTER",
+    "GOAL",
+    "CENTRAL CONFLICT",
+    "MYSTERY (known / missing)",
+    "SETTING (place + year)",
+]
+
+
+def _piece_ids(tokenizer, piece: str) -> List[int]:
+    """Token ids of piece as it tokenizes mid-text (no leading-space marker of its own)."""
+    anchor = tokenizer.encode(".", add_special_tokens=False)
+    ids = tokenizer.encode("." + piece, add_special_tokens=False)
+    if ids[:len(anchor)] == anchor:
+        return ids[len(anchor):]
+    return tokenizer.encode(piece, add_special_tokens=False)
+
+
+class HeaderFormatProcessor(LogitsProcessor):
+    """
+    Constrains output to the format parse_block reads:
+      MOOD: <label>  -- "MOOD:" forced, the label restricted to MOOD_LABELS
+                        (one sampled step when their first tokens differ,
+                        the rest of the label forced)
+      TEXT:          -- forced, then free text
+    With need_facts, once the text has reached the word target (see
+    WordBudgetStopping) "FACTS:" and every field name are forced too; only
+    the field values (one line each) are free. If the model writes FACTS:
+    on its own the rest is left free.
+
+    The state of each row follows the generated tokens and is rebuilt when
+    they are not an extension of what it saw (assisted decoding rollbacks).
+    """
+
+    def __init__(self, tokenizer, n_prompt: int, words: Optional[int] = None, need_facts: bool = False):
+        self.tokenizer = tokenizer
+        self.n_prompt = n_prompt
+        self.words = words
+        self.plan: List[Tuple[str, Any]] = [
+            ("force", _piece_ids(tokenizer, "MOOD:")),
+            ("choice", [_piece_ids(tokenizer, f" {label}") for label in MOOD_LABELS]),
+            ("force", _piece_ids(tokenizer, "\nTEXT:\n")),
+            ("text", None),
+        ]
+        if need_facts:
+            for i, field in enumerate(FACT_FIELDS):
+                head = "\n\nFACTS:\n" if i == 0 else ""
+                self.plan.append(("force", _piece_ids(tokenizer, f"{head}{field}:")))
+                self.plan.append(("line", None))
+        self._rows: Dict[int, Dict[str, Any]] = {}
+
+    @staticmethod
+    def _new_state() -> Dict[str, Any]:
+        return {"seen": [], "step": 0, "pos": 0, "chosen": [], "free_ids": [], "free": False}
+
+    def _advance(self, st: Dict[str, Any], tok: int) -> None:
+        st["seen"].append(tok)
+        if st["free"] or st["step"] >= len(self.plan):
+            return
+        kind, arg = self.plan[st["step"]]
+        if kind == "force":
+            if tok != arg[st["pos"]]:
+                st["free"] = True  # not ours (e.g. padding of a finished row)
+                return
+            st["pos"] += 1
+            if st["pos"] == len(arg):
+                st["step"], st["pos"] = st["step"] + 1, 0
+        elif kind == "choice":
+            st["chosen"].append(tok)
+            if st["chosen"] in arg:
+                st["step"], st["chosen"] = st["step"] + 1, []
+            elif not any(seq[:len(st["chosen"])] == st["chosen"] for seq in arg):
+                st["free"] = True
+        else:  # "text" / "line": free until its end condition
+            st["free_ids"].append(tok)
+            text = self.tokenizer.decode(st["free_ids"], skip_special_tokens=True)
+            if kind == "text":
+                if "FACTS:" in text.upper():
+                    st["free"] = True
+                    return
+                ended = self.words is not None and _reached_word_target(text, self.words)
+            else:
+                ended = "\n" in text
+            if ended and st["step"] + 1 < len(self.plan):
+                st["step"], st["free_ids"] = st["step"] + 1, []
+
+    def _allowed(self, st: Dict[str, Any]) -> Optional[List[int]]:
+        if st["free"] or st["step"] >= len(self.plan):
+            return None
+        kind, arg = self.plan[st["step"]]
+        if kind == "force":
+            return [arg[st["pos"]]]
+        if kind == "choice":
+            n = len(st["chosen"])
+            return sorted({seq[n] for seq in arg if seq[:n] == st["chosen"] and len(seq) > n})
+        return None
+
+    def __call__(self, input_ids, scores):
+        for row in range(input_ids.shape[0]):
+            generated = input_ids[row, self.n_prompt:].tolist()
+            st = self._rows.get(row)
+            if st is None or generated[:len(st["seen"])] != st["seen"]:
+                st = self._rows[row] = self._new_state()
+            for tok in generated[len(st["seen"]):]:
+                self._advance(st, tok)
+            allowed = self._allowed(st)
+            if allowed is not None:
+                keep = scores[row, allowed]
+                scores[row] = float("-inf")
+                scores[row, allowed] = keep
+        return scores
+
+
+def _cache_layers(cache) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    if hasattr(cache, "layers"):  # transformers >= 4.56
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    return list(zip(cache.key_cache, cache.value_cache))
+
+
+class PrefixCache:
+    """
+    KV cache of the shared prompt prefix, computed once per run and copied for
+    every fragment so each generate call only prefills its dynamic tail.
+    Optionally persisted in cache_dir, keyed by model + dtype + load mode
+    (nf4 / fp16 / cpu-*: the weight format changes the KV values) + prefix text.
+    """
+
+    def __init__(self, model, tokenizer, model_id: str, prefix_text: str, cache_dir: Optional[str] = None):
+        self.prefix_text = prefix_text
+        self.input_ids = tokenizer(prefix_text, return_tensors="pt")["input_ids"].to(model.device)
+
+        quant = getattr(model, "cpu_quant", "")
+        load_mode = getattr(model, "load_mode", "")
+        key = hashlib.sha1(
+            f"{model_id}|{model.dtype}|{quant}|{load_mode}|{prefix_text}".encode("utf-8")
+        ).hexdigest()[:16]
+        path = Path(cache_dir) / f"prefix-{key}.pt" if cache_dir else None
+
+        t0 = time.perf_counter()
+        if path is not None and path.exists():
+            self.cache = DynamicCache()
+            for i, (k, v) in enumerate(torch.load(path, map_location=model.device)):
+                self.cache.update(k, v, i)
+            source = f"loaded {path.name}"
+        else:
+            with torch.inference_mode():
+                self.cache = model(input_ids=self.input_ids, past_key_values=DynamicCache(), use_cache=True).past_key_values
+            source = "computed"
+            if path is not None:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                torch.save([(k.cpu(), v.cpu()) for k, v in _cache_layers(self.cache)], path)
+                source += f", saved {path.name}"
+        self.build_s = time.perf_counter() - t0
+        print(f"[prefix] {self.input_ids.shape[-1]} shared prompt tokens ({source} in {self.build_s:.2f}s)")
+
+    def __len__(self) -> int:
+        return self.input_ids.shape[-1]
+
+
+def _prepare_inputs(model, tokenizer, prompt: str, prefix: Optional[PrefixCache]):
+    """Tokenized inputs for generate, plus a copy of the prefix KV cache if it applies."""
+    if prefix is not None and prompt.startswith(prefix.prefix_text):
+        tail_ids = tokenizer(prompt[len(prefix.prefix_text):], add_special_tokens=False, return_tensors="pt")["input_ids"]
+        input_ids = torch.cat([prefix.input_ids, tail_ids.to(model.device)], dim=-1)
+        inputs = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+        return inputs, copy.deepcopy(prefix.cache)  # generate extends the cache in place
+
+    inputs = tokenizer(prompt, return_tensors="pt")
+    # Works well on single-GPU setups (your case).
+    return {k: v.to(model.device) for k, v in inputs.items()}, None
+
+
+def _processors(timer, tokenizer, inputs, stop_words: Optional[int], need_facts: bool,
+                header_format: bool) -> List[LogitsProcessor]:
+    processors: List[LogitsProcessor] = [timer]
+    if header_format:
+        processors.append(HeaderFormatProcessor(tokenizer, inputs["input_ids"].shape[-1], stop_words, need_facts))
+    return processors
+
+
+def _stopping(tokenizer, inputs, stop_words: Optional[int], need_facts: bool) -> List[StoppingCriteria]:
+    if not stop_words or stop_words <= 0:
+        return []
+    return [WordBudgetStopping(tokenizer, inputs["input_ids"].shape[-1], stop_words, need_facts)]
+
+
+def _fill_stats(stats, inputs, past, prefix, n_generated, timer, t0, t_end, counter=None) -> None:
+    if stats is None:
+        return
+    if counter is not None and len(counter.models) == 2:
+        # each verification pass of the target model keeps the accepted draft
+        # tokens plus one token of its own; every draft forward proposes one token
+        target_passes, proposed = counter.calls
+        stats["draft_proposed"] = proposed
+        stats["draft_accepted"] = max(0, min(proposed, int(n_generated) - target_passes))
+    n_prompt = inputs["input_ids"].shape[-1]
+    t_first = timer.t_first or t_end
+    stats.update({
+        "prompt_tokens": int(n_prompt),
+        "cached_prompt_tokens": len(prefix) if past is not None else 0,
+        "generated_tokens": int(n_generated),
+        "prefill_s": t_first - t0,
+        "decode_s": t_end - t_first,
+    })
+
+
 @torch.inference_mode()
 def generate_once(
     model,
@@ -159,11 +669,153 @@ def generate_once(
     max_new_tokens: int,
     temperature: float,
     top_p: float,
+    prefix: Optional[PrefixCache] = None,
+    stats: Optional[Dict[str, Any]] = None,
+    stop_words: Optional[int] = None,
+    need_facts: bool = False,
+    draft=None,
+    header_format: bool = False,
 ) -> str:
-    inputs = tokenizer(prompt, return_tensors="pt")
-    # Works well on single-GPU setups (your case).
-    inputs = {k: v.to(model.device) for k, v in inputs.items()}
+    """
+    If prefix is given and prompt starts with its text, the prefix KV cache is
+    reused and only the rest of the prompt is prefilled. stats (if given) gets
+    prompt/cached token counts and prefill/decode times. stop_words enables
+    WordBudgetStopping (need_facts: the output must also carry FACTS).
+    draft (a small model sharing the tokenizer) turns on assisted decoding;
+    stats then also gets draft_proposed / draft_accepted tokens.
+    header_format constrains the output to MOOD/TEXT(/FACTS) (HeaderFormatProcessor).
+    """
+    inputs, past = _prepare_inputs(model, tokenizer, prompt, prefix)
+
+    timer = _FirstStepTimer()
+    counter = _ForwardCounter(model, draft)
+    t0 = time.perf_counter()
+    with counter:
+        out_ids = model.generate(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            do_sample=True,
+            temperature=temperature,
+            top_p=top_p,
+            use_cache=True,
+            past_key_values=past,
+            logits_processor=_processors(timer, tokenizer, inputs, stop_words, need_facts, header_format),
+            stopping_criteria=_stopping(tokenizer, inputs, stop_words, need_facts),
+            **({"assistant_model": draft} if draft is not None else {}),
+            pad_token_id=tokenizer.eos_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+        )
+    t_end = time.perf_counter()
+
+    # Only decode the newly generated tokens
+    gen_ids = out_ids[0][inputs["input_ids"].shape[-1]:]
+    _fill_stats(stats, inputs, past, prefix, gen_ids.shape[-1], timer, t0, t_end, counter)
+    return tokenizer.decode(gen_ids, skip_special_tokens=True).strip()
 
+
+def generate_stream(
+    model,
+    tokenizer,
+    prompt: str,
+    max_new_tokens: int,
+    temperature: float,
+    top_p: float,
+    prefix: Optional[PrefixCache] = None,
+    stats: Optional[Dict[str, Any]] = None,
+    stop_words: Optional[int] = None,
+    need_facts: bool = False,
+    draft=None,
+    header_format: bool = False,
+) -> Iterator[str]:
+    """
+    Same as generate_once, but yields decoded text pieces while decoding runs
+    (model.generate works in a background thread). stats is filled once the
+    stream is exhausted. Feed the pieces to a SentenceStream to get sentences.
+    """
+    inputs, past = _prepare_inputs(model, tokenizer, prompt, prefix)
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    timer = _FirstStepTimer()
+    counter = _ForwardCounter(model, draft)
+    result: Dict[str, Any] = {}
+
+    def run():
+        try:
+            with torch.inference_mode(), counter:
+                result["ids"] = model.generate(
+                    **inputs,
+                    max_new_tokens=max_new_tokens,
+                    do_sample=True,
+                    temperature=temperature,
+                    top_p=top_p,
+                    use_cache=True,
+                    past_key_values=past,
+                    logits_processor=_processors(timer, tokenizer, inputs, stop_words, need_facts, header_format),
+                    stopping_criteria=_stopping(tokenizer, inputs, stop_words, need_facts),
+                    streamer=streamer,
+                    **({"assistant_model": draft} if draft is not None else {}),
+                    pad_token_id=tokenizer.eos_token_id,
+                    eos_token_id=tokenizer.eos_token_id,
+                )
+        except Exception as e:
+            result["error"] = e
+            streamer.end()  # unblock the consumer
+        result["t_end"] = time.perf_counter()
+
+    t0 = time.perf_counter()
+    worker = threading.Thread(target=run, daemon=True)
+    worker.start()
+    for piece in streamer:
+        if piece:
+            yield piece
+    worker.join()
+    if "error" in result:
+        raise result["error"]
+
+    n_generated = result["ids"].shape[-1] - inputs["input_ids"].shape[-1]
+    _fill_stats(stats, inputs, past, prefix, n_generated, timer, t0, result["t_end"], counter)
+
+
+@torch.inference_mode()
+def generate_batch(
+    model,
+    tokenizer,
+    prompts: List[str],
+    max_new_tokens: int,
+    temperature: float,
+    top_p: float,
+    prefix: Optional[PrefixCache] = None,
+    stats: Optional[List[Dict[str, Any]]] = None,
+    stop_words: Optional[int] = None,
+    need_facts: bool = False,
+    header_format: bool = False,
+) -> List[str]:
+    """
+    generate_once for several prompts in one padded generate call. If they
+    all start with the prefix, its KV cache is repeated over the batch and
+    each tail is left-padded right after it (padding masked out), so the
+    prefix is still not recomputed. stats: one dict per prompt.
+    """
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    use_prefix = prefix is not None and all(p.startswith(prefix.prefix_text) for p in prompts)
+    if use_prefix:
+        head = prefix.input_ids[0].tolist()
+        seqs = [tokenizer(p[len(prefix.prefix_text):], add_special_tokens=False)["input_ids"] for p in prompts]
+    else:
+        head = []
+        seqs = [tokenizer(p)["input_ids"] for p in prompts]
+    width = max(len(q) for q in seqs)
+    input_ids = torch.tensor([head + [pad_id] * (width - len(q)) + q for q in seqs], device=model.device)
+    attention_mask = torch.tensor(
+        [[1] * len(head) + [0] * (width - len(q)) + [1] * len(q) for q in seqs], device=model.device
+    )
+    inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+    past = None
+    if use_prefix:
+        past = copy.deepcopy(prefix.cache)
+        past.batch_repeat_interleave(len(prompts))
+
+    timer = _FirstStepTimer()
+    t0 = time.perf_counter()
     out_ids = model.generate(
         **inputs,
         max_new_tokens=max_new_tokens,
@@ -171,22 +823,103 @@ def generate_once(
         temperature=temperature,
         top_p=top_p,
         use_cache=True,
-        pad_token_id=tokenizer.eos_token_id,
+        past_key_values=past,
+        logits_processor=_processors(timer, tokenizer, inputs, stop_words, need_facts, header_format),
+        stopping_criteria=_stopping(tokenizer, inputs, stop_words, need_facts),
+        pad_token_id=pad_id,
         eos_token_id=tokenizer.eos_token_id,
     )
+    t_end = time.perf_counter()
+
+    texts = []
+    for i, row in enumerate(out_ids[:, input_ids.shape[-1]:]):
+        # a row ends at its eos, or where generate started padding it (a row the
+        # word-budget stop finished has no eos, and pad != eos for e.g. Qwen)
+        eos = (row == tokenizer.eos_token_id).nonzero()
+        pad = (row == pad_id).nonzero()
+        n_generated = row.shape[-1]
+        if len(eos):
+            n_generated = int(eos[0, 0]) + 1
+        if len(pad) and pad_id != tokenizer.eos_token_id:
+            n_generated = min(n_generated, int(pad[0, 0]))
+        texts.append(tokenizer.decode(row[:n_generated], skip_special_tokens=True).strip())
+        if stats is not None:
+            _fill_stats(stats[i], inputs, None, None, n_generated, timer, t0, t_end)
+            stats[i].update({
+                "prompt_tokens": len(head) + len(seqs[i]),
+                "cached_prompt_tokens": len(head),
+                "padding_tokens": width - len(seqs[i]),
+                "batch_size": len(prompts),
+            })
+    return texts
+
+
+class SentenceStream:
+    """
+    Incremental parse_block for streamed output: feed() raw text pieces and
+    get back the TEXT sentences completed so far. The mood is known as soon
+    as the TEXT: header has arrived; everything after FACTS: is ignored.
+    """
 
-    # Only decode the newly generated tokens
-    gen_ids = out_ids[0][inputs["input_ids"].shape[-1]:]
-    return tokenizer.decode(gen_ids, skip_special_tokens=True).strip()
+    def __init__(self):
+        self.raw = ""
+        self.mood: Optional[str] = None
+        self._pos: Optional[int] = None  # start of the not-yet-emitted TEXT
+        self._done = False
+
+    def feed(self, piece: str) -> List[str]:
+        self.raw += piece
+        return self._scan(final=False)
+
+    def close(self) -> List[str]:
+        """Call when the stream ends: flushes the last (unterminated) sentence."""
+        return self._scan(final=True)
+
+    def _scan(self, final: bool) -> List[str]:
+        if self._done:
+            return []
+        if self._pos is None:
+            t_pos = self.raw.upper().find("TEXT:")
+            if t_pos == -1 and not final:
+                return []
+            self.mood = parse_block(self.raw[:max(t_pos, 0)])[0]
+            self._pos = t_pos + 5 if t_pos != -1 else 0
+
+        region = self.raw[self._pos:]
+        f_pos = region.upper().find("FACTS:")
+        if f_pos != -1:
+            region = region[:f_pos]
+            final = self._done = True
+
+        sentences = []
+        start = 0
+        for m in _SENT_END.finditer(region):
+            # "Dr." / "3.5" / "...": only a punctuation mark followed by space ends a sentence
+            if m.end() < len(region) and region[m.end()].isspace():
+                sentences.append(region[start:m.end()])
+                start = m.end()
+        if final:
+            sentences.append(region[start:])
+            start = len(region)
+            self._done = True
+        self._pos += start
+
+        out = []
+        for sent in sentences:
+            lines = [ln for ln in sent.splitlines() if not ln.strip().upper().startswith("MOOD:")]
+            sent = " ".join(" ".join(lines).split())
+            if sent:
+                out.append(sent)
+        return out
 
 
 # ---------- prompt builder (short, fast) ----------
 
-def build_prompt_first(music_prompt: str, words: int) -> str:
-    return mistral_inst(
+def build_prompt_prefix(words: int, inst: Inst = MISTRAL_INST) -> str:
+    """Instruction block shared by every fragment of a run (see PrefixCache)."""
+    return mistral_inst_prefix(
         f"""
-Write scene 1 of ONE coherent tale.
-In ONE short sentence, establish the setting (place + year) and keep it consistent.
+Write ONE coherent tale, one scene at a time.
 Never mention instruments/audio terms. Use MUSIC FEELING only for emotion/pacing/tension.
 
 Pick exactly one MOOD label from: {", ".join(MOOD_LABELS)}.
@@ -196,6 +929,18 @@ MOOD: <LABEL>
 TEXT:
 About {words} words. End with a complete sentence (no cut-off).
 1–2 short paragraphs.
+""",
+        inst,
+    )
+
+
+def build_prompt_first(music_prompt: str, words: int, inst: Inst = MISTRAL_INST) -> str:
+    return build_prompt_prefix(words, inst) + mistral_inst_tail(
+        f"""
+Write scene 1.
+In ONE short sentence, establish the setting (place + year) and keep it consistent.
+
+After TEXT, also output:
 FACTS:
 PROTAGONIST: ...
 SIDE CHARACTER: ...
@@ -206,43 +951,139 @@ SETTING (place + year): ...
 
 MUSIC FEELING:
 {music_prompt}
-"""
+""",
+        inst,
     )
 
 
-def build_prompt_next(prev_text: str, facts: str, music_prompt: str, words: int, is_last: bool) -> str:
+def build_prompt_next(prev_text: str, facts: str, music_prompt: str, words: int, is_last: bool,
+                      memory: str = "", inst: Inst = MISTRAL_INST) -> str:
     end_rule = (
         "This is the FINAL scene: resolve the central conflict and reveal/close the mystery with clear closure."
         if is_last
         else
         "End with a small hook into the next scene."
     )
+    memory_block = f"\nSTORY SO FAR (binding):\n{memory}\n" if memory else ""
 
-    return mistral_inst(
+    return build_prompt_prefix(words, inst) + mistral_inst_tail(
         f"""
 Continue the SAME tale. Facts and previous scene are binding.
-Never mention instruments/audio terms. Use MUSIC FEELING only for emotion/pacing/tension.
 
 FACTS (binding, keep consistent):
 {facts}
-
+{memory_block}
 PREVIOUS SCENE (binding):
 {prev_text}
 
 {end_rule}
 
-Pick exactly one MOOD label from: {", ".join(MOOD_LABELS)}.
+MUSIC FEELING:
+{music_prompt}
+""",
+        inst,
+    )
+
+
+def build_prompt_memory(memory: str, scenes: List[str], words: int, inst: Inst = MISTRAL_INST) -> str:
+    """Fold the latest scenes into the running summary (--long_form)."""
+    new_scenes = "\n\n".join(scenes)
+    return mistral_inst(
+        f"""
+Update the summary of a tale that is still being written.
+
+SUMMARY SO FAR:
+{memory or "(the tale has just started)"}
+
+NEW SCENES:
+{new_scenes}
+
+Rewrite the summary so it covers the whole tale, in at most {words} words.
+Keep who is where, what they want, what has been revealed and which threads are still open.
+Drop scenery and details that no longer matter. Plain prose, no headings.
+""",
+        inst,
+    )
+
+
+def build_prompt_outline(music_prompts: List[str], inst: Inst = MISTRAL_INST) -> str:
+    """--mode outline: plan every scene in one call (facts + one line per scene)."""
+    n = len(music_prompts)
+    feelings = "\n".join(f"{i}. {m}" for i, m in enumerate(music_prompts, start=1))
+    return mistral_inst(
+        f"""
+Plan ONE coherent tale of {n} scenes, one scene per music section below.
+Never mention instruments/audio terms. Use the music only for emotion/pacing/tension.
+Scene 1 establishes the setting (place + year). Scene {n} resolves the central
+conflict and reveals/closes the mystery.
 
 Output EXACTLY:
-MOOD: <LABEL>
-TEXT:
-About {words} words. End with a complete sentence (no cut-off).
-1–2 short paragraphs.
+FACTS:
+PROTAGONIST: ...
+SIDE CHARACTER: ...
+GOAL: ...
+CENTRAL CONFLICT: ...
+MYSTERY (known / missing): ...
+SETTING (place + year): ...
+OUTLINE:
+SCENE 1: <one line: what happens>
+...
+SCENE {n}: <one line: what happens>
+
+MUSIC FEELING PER SCENE:
+{feelings}
+""",
+        inst,
+    )
+
 
+_SCENE_LINE = re.compile(r"^\s*SCENE\s*(\d+)\s*[:.)-]\s*(.+?)\s*$", re.M | re.I)
+
+
+def parse_outline(raw: str, n_scenes: int) -> Tuple[str, List[str]]:
+    """FACTS block and one line per scene ("" where the outline skipped a scene)."""
+    u = raw.upper()
+    f_pos = u.find("FACTS:")
+    o_pos = u.find("OUTLINE:")
+    facts = raw[f_pos + 6:o_pos if o_pos > f_pos else None].strip() if f_pos != -1 else ""
+
+    scenes = [""] * n_scenes
+    for m in _SCENE_LINE.finditer(raw[o_pos:] if o_pos != -1 else raw):
+        i = int(m.group(1)) - 1
+        if 0 <= i < n_scenes and not scenes[i]:
+            scenes[i] = m.group(2)
+    return facts, scenes
+
+
+def build_prompt_scene(facts: str, scenes: List[str], idx: int, music_prompt: str, words: int,
+                       inst: Inst = MISTRAL_INST) -> str:
+    """--mode outline: one scene written from the plan alone (no previous scene text)."""
+    n = len(scenes)
+    outline = "\n".join(f"SCENE {i}: {sc or '...'}" for i, sc in enumerate(scenes, start=1))
+    if idx == n - 1:
+        end_rule = "This is the FINAL scene: resolve the central conflict and reveal/close the mystery with clear closure."
+    else:
+        end_rule = "End with a small hook into the next scene."
+    if idx == 0:
+        end_rule = "In ONE short sentence, establish the setting (place + year).\n" + end_rule
+
+    return build_prompt_prefix(words, inst) + mistral_inst_tail(
+        f"""
+Write scene {idx + 1} of {n}. Facts and outline are binding.
+
+FACTS (binding, keep consistent):
+{facts}
+
+OUTLINE (binding):
+{outline}
+
+THIS SCENE: {scenes[idx] or f"scene {idx + 1} of the outline"}
+{end_rule}
 
 MUSIC FEELING:
 {music_prompt}
-"""
+""",
+        inst,
     )
 
 
@@ -304,80 +1145,764 @@ def load_segments(path: str) -> List[Dict[str, Any]]:
 
 
 
-def main():
-    p = argparse.ArgumentParser(description="Fast fragmented story generator from text music prompts (English).")
-    p.add_argument("--segments", required=True, help="Path to JSON with segments[].music_prompt")
-    p.add_argument("--out_json", default="story.json", help="Output JSON path")
-    p.add_argument("--out_txt", default="full_story.txt", help="Output full story text path")
-    p.add_argument("--model", default="mistralai/Mistral-7B-Instruct-v0.2", help="HF model id")
-    p.add_argument("--no_4bit", action="store_true", help="Disable 4-bit quantization")
-    p.add_argument("--words", type=int, default=90, help="Target words per fragment (no mid-word cuts)")
-    p.add_argument("--temperature", type=float, default=0.65)
-    p.add_argument("--top_p", type=float, default=0.9)
-    p.add_argument("--seed", type=int, default=None)
-    p.add_argument("--print_live", action="store_true", help="Print each fragment as soon as generated")
-    args = p.parse_args()
+class OscTargets:
+    """--osc_stream receivers (e.g. the Processing sketch and the voice server): every message goes to all of them."""
 
-    if args.seed is not None:
-        random.seed(args.seed)
-        torch.manual_seed(args.seed)
-        if torch.cuda.is_available():
-            torch.cuda.manual_seed_all(args.seed)
+    def __init__(self, targets: List[str]):
+        from pythonosc import udp_client
 
-    segments = load_segments(args.segments)
+        self.clients = []
+        for target in targets:
+            host, port = target.rsplit(":", 1)
+            self.clients.append(udp_client.SimpleUDPClient(host, int(port)))
 
-    print(f"Loading model: {args.model}")
-    model, tokenizer = load_model(args.model, use_4bit=(not args.no_4bit))
+    def send_message(self, address: str, value) -> None:
+        for client in self.clients:
+            client.send_message(address, value)
+
+
+def stream_fragment(seg_id, pieces: Iterator[str], words: int, print_live: bool, osc=None, timed: bool = True) -> str:
+    """
+    Consume a generate_stream and pass each TEXT sentence on as soon as it is
+    complete. Sentences stop once the word target is reached (where
+    truncate_to_words cuts), so consumers get the same text as story.json.
+    Returns the raw output for parse_block.
+    """
+    parser = SentenceStream()
+    t0 = time.perf_counter()
+    n_words = 0
+    first = True
+
+    def emit(sentences: List[str]) -> None:
+        nonlocal n_words, first
+        for sent in sentences:
+            if words and n_words >= words:
+                return
+            n_words += len(sent.split())
+            if first:
+                if timed:
+                    print(f"[stream] fragment {seg_id}: first sentence after {time.perf_counter() - t0:.2f}s", flush=True)
+                if print_live:
+                    print(f"\n=== FRAGMENT {seg_id} | MOOD={parser.mood} ===", flush=True)
+                first = False
+            if print_live:
+                print(sent, flush=True)
+            if osc is not None:
+                osc.send_message("/sentence", [int(seg_id), str(parser.mood), sent])
+
+    for piece in pieces:
+        emit(parser.feed(piece))
+    emit(parser.close())
+    if print_live and not first:
+        print(flush=True)
+    return parser.raw
+
+
+def finish_fragment(seg_id, raw: str, stats: Dict[str, Any], tokenizer, words: int, note: str = "",
+                    quiet: bool = False, label: Optional[str] = None,
+                    need_facts: bool = False) -> Tuple[Dict[str, Any], str, Dict[str, Any]]:
+    """parse_block + truncate_to_words for one generated fragment; prints its [gen] line."""
+    mood, text, facts = parse_block(raw)
+    text = truncate_to_words(text, words)
+    text = " ".join(text.split())
+
+    record = dict(stats)
+    record["kept_tokens"] = len(tokenizer(text, add_special_tokens=False)["input_ids"])
+    record["kept_words"] = len(text.split())
+    record["parse_fallback"] = parse_fallbacks(raw, need_facts)
+    if record["parse_fallback"]:
+        note += f", parse fallback: {'/'.join(record['parse_fallback'])}"
+    if not quiet:
+        cached = stats.get("cached_prompt_tokens", 0)
+        print(
+            f"[gen] fragment {label or seg_id}: prompt {stats['prompt_tokens']} tok "
+            f"({cached} cached, {stats['prompt_tokens'] - cached} prefilled), "
+            f"prefill {stats['prefill_s']:.2f}s, decode {stats['decode_s']:.2f}s, "
+            f"generated {stats['generated_tokens']} tok / {stats['max_new_tokens']}, "
+            f"kept {record['kept_tokens']} tok ({record['kept_words']} words){note}",
+            flush=True,
+        )
+    return {"id": seg_id, "mood": mood, "text": text}, facts, record
+
+
+class FragmentCheckpoints:
+    """
+    Every finished fragment (raw output + stats) saved in a directory, keyed
+    by the model, the sampling settings, the prompt and the key of the
+    fragment it continues. The prompt already carries the music prompt, the
+    previous text and the facts, so a fragment is reused only when the whole
+    chain that led to it is unchanged: a crashed run resumes where it died,
+    and editing segment N regenerates from N on.
+
+    max_new_tokens is left out of the key: it follows the tokens/word
+    calibration, which moves a little after every run, and with the word
+    stop it is only a ceiling.
+    """
+
+    def __init__(self, path: str, model, model_id: str, args, mode: str):
+        self.dir = Path(path)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.settings = json.dumps({
+            "model": model_id,
+            "dtype": str(model.dtype),
+            "quant": getattr(model, "cpu_quant", ""),
+            "load_mode": getattr(model, "load_mode", ""),  # nf4 and fp16 CUDA runs share dtype and quant
+            "mode": mode,
+            "seed": args.seed,
+            "temperature": args.temperature,
+            "top_p": args.top_p,
+            "words": args.words,
+            "word_stop": not args.no_word_stop,
+            "header_format": not args.free_format,
+            "draft": [args.draft_model, args.draft_tokens] if args.draft_model else None,
+        }, sort_keys=True)
+        self.hits = 0
+
+    def key(self, parent: str, prompt: str) -> str:
+        return hashlib.sha1(f"{self.settings}|{parent}|{prompt}".encode("utf-8")).hexdigest()[:16]
+
+    def load(self, key: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        path = self.dir / f"frag-{key}.json"
+        if not path.exists():
+            return None
+        data = json.loads(path.read_text(encoding="utf-8"))
+        self.hits += 1
+        return data["raw"], {**data["stats"], "checkpoint": True}
+
+    def save(self, key: str, raw: str, stats: Dict[str, Any]) -> None:
+        path = self.dir / f"frag-{key}.json"
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"raw": raw, "stats": stats}, ensure_ascii=False), encoding="utf-8")
+        tmp.replace(path)  # a run killed mid-write leaves no half checkpoint
+
+
+def clip_to_tokens(tokenizer, text: str, n_tokens: int) -> str:
+    """At most n_tokens of text, cut back to the last sentence end when it has to be shortened."""
+    ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+    if len(ids) <= n_tokens:
+        return text
+    clipped = tokenizer.decode(ids[:n_tokens], skip_special_tokens=True)
+    ends = list(_SENT_END.finditer(clipped))
+    return clipped[:ends[-1].end()].strip() if ends else clipped.strip()
+
+
+class StoryMemory:
+    """
+    Rolling summary of the story for --long_form. Every `every` fragments the
+    summary and the scenes written since are compressed into a new summary of
+    at most `budget` tokens, so the prompt of fragment 300 is as long as the
+    prompt of fragment 10. Summaries are checkpointed like fragments.
+    """
 
-    base_max_new_tokens = estimate_max_new_tokens(args.words)
+    TEMPERATURE = 0.3  # summaries should be faithful, not inventive
+
+    def __init__(self, budget: int, every: int, inst: Inst = MISTRAL_INST):
+        self.budget = budget
+        self.every = max(1, every)
+        self.inst = inst
+        self.text = ""
+        self.pending: List[str] = []
+        self.n_scenes = 0
+
+    def add(self, model, tokenizer, args, scene: str, label, chain: str = "",
+            ckpt: Optional["FragmentCheckpoints"] = None) -> None:
+        self.pending.append(scene)
+        self.n_scenes += 1
+        if len(self.pending) < self.every:
+            return
+        prompt = build_prompt_memory(self.text, self.pending, max(20, self.budget * 3 // 4), self.inst)
+        key = ckpt.key(chain, prompt) if ckpt is not None else ""
+        hit = ckpt.load(key) if ckpt is not None else None
+        if hit is not None:
+            raw, stats = hit
+        else:
+            if args.seed is not None:
+                torch.manual_seed(args.seed + self.n_scenes)
+            stats: Dict[str, Any] = {}
+            raw = generate_once(
+                model=model,
+                tokenizer=tokenizer,
+                prompt=prompt,
+                max_new_tokens=self.budget,
+                temperature=self.TEMPERATURE,
+                top_p=args.top_p,
+                stats=stats,
+            )
+            if ckpt is not None:
+                ckpt.save(key, raw, stats)
+        self.text = clip_to_tokens(tokenizer, " ".join(raw.split()), self.budget)
+        n_tokens = len(tokenizer(self.text, add_special_tokens=False)["input_ids"])
+        print(
+            f"[memory] after fragment {label}: {len(self.pending)} scenes folded into {n_tokens} tok "
+            f"(prompt {stats['prompt_tokens']} tok, {stats['prefill_s'] + stats['decode_s']:.2f}s"
+            f"{', reused' if hit is not None else ''})",
+            flush=True,
+        )
+        self.pending = []
+
+
+def run_sequential(model, tokenizer, segments, args, base_max_new_tokens: int, prefix=None, osc=None,
+                   draft=None, quiet: bool = False, inst: Inst = MISTRAL_INST,
+                   ckpt: Optional[FragmentCheckpoints] = None) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    One fragment after another; each prompt carries the facts and the previous
+    scene (and with --long_form the rolling StoryMemory summary). With --seed,
+    fragment i samples from seed + i, so a resumed run continues exactly like
+    an uninterrupted one.
+    """
+    stream = (args.print_live or osc is not None) and not quiet
+    memory = StoryMemory(args.memory_tokens, args.memory_every, inst) if args.long_form else None
     prev_text = ""
     facts = ""
+    chain = ""
     n_segments = len(segments)
     fragments: List[Dict[str, Any]] = []
-    story_parts: List[str] = []
+    records: List[Dict[str, Any]] = []
 
     for idx, seg in enumerate(segments):
         seg_id = seg.get("id", idx + 1)
         music_prompt = seg["music_prompt"].strip()
 
         is_last = (idx == n_segments - 1)
-        prompt = build_prompt_first(music_prompt, args.words) if idx == 0 else build_prompt_next(prev_text, facts, music_prompt, args.words, is_last)
+        if idx == 0:
+            prompt = build_prompt_first(music_prompt, args.words, inst)
+        else:
+            prompt = build_prompt_next(prev_text, facts, music_prompt, args.words, is_last,
+                                       memory=memory.text if memory is not None else "", inst=inst)
+        key = ckpt.key(chain, prompt) if ckpt is not None else ""
+        chain = key
+        hit = ckpt.load(key) if ckpt is not None else None
+        if hit is not None:
+            raw, stats = hit
+            if stream:
+                stream_fragment(seg_id, iter([raw]), args.words, args.print_live, osc, timed=False)
+            fragment, new_facts, record = finish_fragment(seg_id, raw, stats, tokenizer, args.words, quiet=True,
+                                                          need_facts=(idx == 0))
+            if not quiet:
+                print(f"[ckpt] fragment {seg_id}: reused frag-{key}.json", flush=True)
+            if idx == 0 and new_facts.strip():
+                facts = new_facts
+            prev_text = fragment["text"]
+            fragments.append(fragment)
+            records.append(record)
+            if memory is not None and not is_last:
+                memory.add(model, tokenizer, args, prev_text, seg_id, chain, ckpt)
+            continue
+
+        if args.seed is not None:
+            torch.manual_seed(args.seed + idx)
         max_new_tokens = base_max_new_tokens + (60 if idx == 0 else 0) + (40 if is_last else 0)
-        raw = generate_once(
+        stats: Dict[str, Any] = {"max_new_tokens": max_new_tokens}
+        gen_kwargs = dict(
             model=model,
             tokenizer=tokenizer,
             prompt=prompt,
             max_new_tokens=max_new_tokens,
             temperature=args.temperature,
             top_p=args.top_p,
+            prefix=prefix,
+            stats=stats,
+            stop_words=None if args.no_word_stop else args.words,
+            need_facts=(idx == 0),
+            draft=draft,
+            header_format=not args.free_format,
         )
-
-        mood, text, new_facts = parse_block(raw)
+        if stream:
+            raw = stream_fragment(seg_id, generate_stream(**gen_kwargs), args.words, args.print_live, osc)
+        else:
+            raw = generate_once(**gen_kwargs)
+
+        note = ""
+        if draft is not None:
+            acc = stats["draft_accepted"] / max(stats["draft_proposed"], 1)
+            note = f", draft accepted {stats['draft_accepted']}/{stats['draft_proposed']} ({100 * acc:.0f}%)"
+            if args.draft_compare:
+                base: Dict[str, Any] = {}
+                generate_once(**{**gen_kwargs, "draft": None, "stats": base})
+                stats["base_generated_tokens"] = base["generated_tokens"]
+                stats["base_s"] = base["prefill_s"] + base["decode_s"]
+                gen_s = stats["prefill_s"] + stats["decode_s"]
+                speedup = (stats["generated_tokens"] / gen_s) / (base["generated_tokens"] / stats["base_s"])
+                note += f", {speedup:.2f}x tok/s vs no draft"
+
+        if ckpt is not None:
+            ckpt.save(key, raw, stats)
+        fragment, new_facts, record = finish_fragment(seg_id, raw, stats, tokenizer, args.words, note, quiet,
+                                                      need_facts=(idx == 0))
         if idx == 0 and new_facts.strip():
             facts = new_facts
+        prev_text = fragment["text"]
+        fragments.append(fragment)
+        records.append(record)
+        if memory is not None and not is_last:
+            memory.add(model, tokenizer, args, prev_text, seg_id, chain, ckpt)
 
-        text = truncate_to_words(text, args.words)
-        text = " ".join(text.split())
-        prev_text = text  # <-- move here
+    return fragments, records
 
-        if args.print_live:
-            print(f"\n=== FRAGMENT {seg_id} | MOOD={mood} ===\n{text}\n", flush=True)
 
-        fragments.append({"id": seg_id, "mood": mood, "text": text})
-        story_parts.append(text)
+def run_outline(model, tokenizer, segments, args, base_max_new_tokens: int, prefix=None,
+                osc=None, inst: Inst = MISTRAL_INST, ckpt: Optional[FragmentCheckpoints] = None) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    One call plans the tale (FACTS + one line per scene); then every scene is
+    written from the plan and its own music feeling, --batch_size scenes per
+    batched generate call. Scenes no longer wait for each other. With --seed
+    every batch samples from seed + 1 + its first scene index, so a run resumed
+    from checkpoints (saved batch by batch) continues like an uninterrupted one.
+    """
+    n_segments = len(segments)
+    music = [seg["music_prompt"].strip() for seg in segments]
+
+    outline_prompt = build_prompt_outline(music, inst)
+    outline_key = ckpt.key("", outline_prompt) if ckpt is not None else ""
+    hit = ckpt.load(outline_key) if ckpt is not None else None
+    if hit is not None:
+        raw, stats = hit
+    else:
+        if args.seed is not None:
+            torch.manual_seed(args.seed)
+        stats: Dict[str, Any] = {}
+        raw = generate_once(
+            model=model,
+            tokenizer=tokenizer,
+            prompt=outline_prompt,
+            max_new_tokens=120 + 40 * n_segments,
+            temperature=args.temperature,
+            top_p=args.top_p,
+            stats=stats,
+        )
+        if ckpt is not None:
+            ckpt.save(outline_key, raw, stats)
+    facts, scenes = parse_outline(raw, n_segments)
+    print(
+        f"[outline] {stats['generated_tokens']} tok in {stats['prefill_s'] + stats['decode_s']:.2f}s, "
+        f"{sum(1 for sc in scenes if sc)}/{n_segments} scene lines"
+        + (f" (reused frag-{outline_key}.json)" if hit is not None else ""),
+        flush=True,
+    )
+
+    prompts = [
+        build_prompt_scene(facts, scenes, idx, music[idx], args.words, inst)
+        for idx in range(n_segments)
+    ]
+    keys = [ckpt.key(outline_key, prompt) if ckpt is not None else "" for prompt in prompts]
+    results: Dict[int, Tuple[str, Dict[str, Any]]] = {}
+    if ckpt is not None:
+        for idx, key in enumerate(keys):
+            hit = ckpt.load(key)
+            if hit is not None:
+                results[idx] = hit
+                print(f"[ckpt] fragment {segments[idx].get('id', idx + 1)}: reused frag-{key}.json", flush=True)
+
+    fragments: List[Dict[str, Any]] = []
+    records: List[Dict[str, Any]] = []
+
+    def flush_ready() -> None:
+        # pass scenes on in story order as soon as every earlier one is done
+        while len(fragments) in results:
+            idx = len(fragments)
+            raw, st = results[idx]
+            seg_id = segments[idx].get("id", idx + 1)
+            if args.print_live or osc is not None:
+                stream_fragment(seg_id, iter([raw]), args.words, args.print_live, osc, timed=False)
+            fragment, _facts, record = finish_fragment(
+                seg_id, raw, st, tokenizer, args.words, quiet=st.get("checkpoint", False)
+            )
+            fragments.append(fragment)
+            records.append(record)
+
+    flush_ready()
+    todo = [idx for idx in range(n_segments) if idx not in results]
+    max_new_tokens = base_max_new_tokens + 40  # the last scene's closure allowance, for the whole batch
+    for start in range(0, len(todo), max(1, args.batch_size)):
+        batch = todo[start:start + args.batch_size]
+        if args.seed is not None:
+            torch.manual_seed(args.seed + 1 + batch[0])
+        batch_stats: List[Dict[str, Any]] = [{"max_new_tokens": max_new_tokens} for _ in batch]
+        raws = generate_batch(
+            model=model,
+            tokenizer=tokenizer,
+            prompts=[prompts[idx] for idx in batch],
+            max_new_tokens=max_new_tokens,
+            temperature=args.temperature,
+            top_p=args.top_p,
+            prefix=prefix,
+            stats=batch_stats,
+            stop_words=None if args.no_word_stop else args.words,
+            header_format=not args.free_format,
+        )
+        for idx, raw, st in zip(batch, raws, batch_stats):
+            if ckpt is not None:
+                ckpt.save(keys[idx], raw, st)
+            results[idx] = (raw, st)
+        flush_ready()
 
-    full_story = "\n\n".join(story_parts).strip()
+    return fragments, records
 
+
+def run_multi(model, tokenizer, stories: List[List[Dict[str, Any]]], names: List[str], args,
+              base_max_new_tokens: int, prefix=None, inst: Inst = MISTRAL_INST,
+              ckpt: Optional[FragmentCheckpoints] = None) -> Tuple[List[List[Dict[str, Any]]], List[Dict[str, Any]]]:
+    """
+    Several stories in lockstep: fragment i of every story (same prompts as
+    run_sequential) goes through one padded generate_batch call, --batch_size
+    stories at a time. Stories may have different lengths. With --seed each
+    batch is seeded from its fragment index and first story, so a resumed run
+    continues like an uninterrupted one.
+    """
+    n_stories = len(stories)
+    fragments: List[List[Dict[str, Any]]] = [[] for _ in stories]
+    facts = [""] * n_stories
+    chains = [""] * n_stories
+    records: List[Dict[str, Any]] = []
+
+    def finish(k: int, idx: int, raw: str, st: Dict[str, Any]) -> None:
+        seg_id = stories[k][idx].get("id", idx + 1)
+        fragment, new_facts, record = finish_fragment(
+            seg_id, raw, st, tokenizer, args.words, label=f"{names[k]}#{seg_id}", quiet=st.get("checkpoint", False),
+            need_facts=(idx == 0),
+        )
+        record["story"] = names[k]
+        if st.get("checkpoint"):
+            print(f"[ckpt] fragment {names[k]}#{seg_id}: reused frag-{chains[k]}.json", flush=True)
+        if idx == 0 and new_facts.strip():
+            facts[k] = new_facts
+        fragments[k].append(fragment)
+        records.append(record)
+
+    for idx in range(max(len(segs) for segs in stories)):
+        prompts: Dict[int, str] = {}
+        todo = []
+        for k in range(n_stories):
+            if idx >= len(stories[k]):
+                continue
+            music_prompt = stories[k][idx]["music_prompt"].strip()
+            is_last = (idx == len(stories[k]) - 1)
+            if idx == 0:
+                prompts[k] = build_prompt_first(music_prompt, args.words, inst)
+            else:
+                prompts[k] = build_prompt_next(fragments[k][-1]["text"], facts[k], music_prompt, args.words, is_last,
+                                               inst=inst)
+            if ckpt is not None:
+                chains[k] = ckpt.key(chains[k], prompts[k])
+                hit = ckpt.load(chains[k])
+                if hit is not None:
+                    finish(k, idx, *hit)
+                    continue
+            todo.append(k)
+
+        for start in range(0, len(todo), max(1, args.batch_size)):
+            batch = todo[start:start + args.batch_size]
+            if args.seed is not None:
+                torch.manual_seed(args.seed + idx * n_stories + batch[0])
+            max_new_tokens = base_max_new_tokens + (60 if idx == 0 else 0)
+            if any(idx == len(stories[k]) - 1 for k in batch):
+                max_new_tokens += 40
+            batch_stats: List[Dict[str, Any]] = [{"max_new_tokens": max_new_tokens} for _ in batch]
+            raws = generate_batch(
+                model=model,
+                tokenizer=tokenizer,
+                prompts=[prompts[k] for k in batch],
+                max_new_tokens=max_new_tokens,
+                temperature=args.temperature,
+                top_p=args.top_p,
+                prefix=prefix,
+                stats=batch_stats,
+                stop_words=None if args.no_word_stop else args.words,
+                need_facts=(idx == 0),
+                header_format=not args.free_format,
+            )
+            for k, raw, st in zip(batch, raws, batch_stats):
+                if ckpt is not None:
+                    ckpt.save(chains[k], raw, st)
+                finish(k, idx, raw, st)
+
+    return fragments, records
+
+
+def story_out_paths(out_json: str, out_txt: str, name: str) -> Tuple[str, str]:
+    """story.json -> story.<name>.json (one output pair per --segments file)."""
+    j, t = Path(out_json), Path(out_txt)
+    return str(j.with_name(f"{j.stem}.{name}{j.suffix}")), str(t.with_name(f"{t.stem}.{name}{t.suffix}"))
+
+
+TELEMETRY_FIELDS = [
+    "prompt_tokens", "cached_prompt_tokens", "generated_tokens", "max_new_tokens",
+    "kept_tokens", "kept_words", "prefill_s", "decode_s",
+]
+
+
+def fragment_metrics(record: Dict[str, Any]) -> Dict[str, Any]:
+    """The --telemetry entry of one fragment."""
+    m: Dict[str, Any] = {k: record[k] for k in TELEMETRY_FIELDS if k in record}
+    for k in ("prefill_s", "decode_s"):
+        m[k] = round(m[k], 4)
+    m["tok_per_s"] = round(record["generated_tokens"] / record["decode_s"], 2) if record["decode_s"] > 0 else None
+    m["parse_fallback"] = record.get("parse_fallback", [])
+    if record.get("checkpoint"):
+        m["reused"] = True  # timings are from the run that generated it
+    return m
+
+
+def telemetry_summary(records: List[Dict[str, Any]], args) -> Dict[str, Any]:
+    generated = sum(r["generated_tokens"] for r in records)
+    decode_s = sum(r["decode_s"] for r in records)
+    return {
+        "model": args.model,
+        "mode": "lockstep" if any("story" in r for r in records) else args.mode,
+        "words": args.words,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "fragments": len(records),
+        "prompt_tokens": sum(r["prompt_tokens"] for r in records),
+        "max_prompt_tokens": max((r["prompt_tokens"] for r in records), default=0),
+        "generated_tokens": generated,
+        "kept_tokens": sum(r["kept_tokens"] for r in records),
+        "kept_ratio": round(sum(r["kept_tokens"] for r in records) / generated, 3) if generated else None,
+        "prefill_s": round(sum(r["prefill_s"] for r in records), 3),
+        "decode_s": round(decode_s, 3),
+        "tok_per_s": round(generated / decode_s, 2) if decode_s > 0 else None,
+        "parse_fallbacks": sum(1 for r in records if r.get("parse_fallback")),
+        "reused": sum(1 for r in records if r.get("checkpoint")),
+    }
+
+
+def save_story(fragments: List[Dict[str, Any]], out_json: str, out_txt: str,
+               records: Optional[List[Dict[str, Any]]] = None, args=None) -> None:
+    """records (one per fragment, --telemetry) adds a "metrics" entry to each fragment and a "summary" block."""
+    full_story = "\n\n".join(frag["text"] for frag in fragments).strip()
+
+    if records is not None:
+        fragments = [{**frag, "metrics": fragment_metrics(r)} for frag, r in zip(fragments, records)]
     out = {"fragments": fragments, "full_story": full_story}
+    if records is not None:
+        out["summary"] = telemetry_summary(records, args)
 
-    with open(args.out_json, "w", encoding="utf-8") as f:
+    with open(out_json, "w", encoding="utf-8") as f:
         json.dump(out, f, ensure_ascii=False, indent=2)
 
-    with open(args.out_txt, "w", encoding="utf-8") as f:
+    with open(out_txt, "w", encoding="utf-8") as f:
         f.write(full_story)
 
-    print(f"Saved JSON: {args.out_json}")
-    print(f"Saved full story: {args.out_txt}")
+    print(f"Saved JSON: {out_json}")
+    print(f"Saved full story: {out_txt}")
+
+
+def print_summary(records: List[Dict[str, Any]], args, draft=None) -> None:
+    """Run totals (generated vs kept, draft acceptance) and the tokens/word calibration update."""
+    reused = sum(1 for r in records if r.get("checkpoint"))
+    if reused:
+        print(f"[ckpt] reused {reused} of {len(records)} fragments, generated {len(records) - reused}")
+    if args.long_form and len(records) > 1:
+        sizes = [r["prompt_tokens"] for r in records]
+        quarter = max(1, len(sizes) // 4)
+        print(
+            f"[memory] prompt tokens per fragment: min {min(sizes)}, max {max(sizes)}, "
+            f"mean of first {quarter} {sum(sizes[:quarter]) / quarter:.0f}, "
+            f"mean of last {quarter} {sum(sizes[-quarter:]) / quarter:.0f}"
+        )
+    records = [r for r in records if not r.get("checkpoint")]  # counted in the run that generated them
+    total_generated = sum(r["generated_tokens"] for r in records)
+    total_kept = sum(r["kept_tokens"] for r in records)
+    total_words = sum(r["kept_words"] for r in records)
+
+    if total_generated:
+        print(f"[gen] total: generated {total_generated} tok, kept {total_kept} tok ({100 * total_kept / total_generated:.0f}%)")
+    drafted = [r for r in records if "draft_proposed" in r]
+    if draft is not None and drafted:
+        gen_s = sum(r["prefill_s"] + r["decode_s"] for r in drafted)
+        tps = sum(r["generated_tokens"] for r in drafted) / gen_s
+        acc = sum(r["draft_accepted"] for r in drafted) / max(sum(r["draft_proposed"] for r in drafted), 1)
+        line = f"[draft] {args.draft_model}: acceptance {100 * acc:.0f}%, {tps:.1f} tok/s"
+        base_s = sum(r.get("base_s", 0.0) for r in drafted)
+        if base_s > 0:
+            base_tps = sum(r["base_generated_tokens"] for r in drafted) / base_s
+            line += f" vs {base_tps:.1f} tok/s without draft ({tps / base_tps:.2f}x)"
+        print(line)
+    if total_words:
+        ratio = update_calibration(args.calibration, args.model, total_kept, total_words)
+        print(f"[calib] {args.model}: {ratio:.2f} tokens/word (saved to {args.calibration})")
+
+
+def main():
+    p = argparse.ArgumentParser(description="Fast fragmented story generator from text music prompts (English).")
+    p.add_argument("--segments", required=True, nargs="+",
+                   help="Path to JSON with segments[].music_prompt; several files = several stories in lockstep "
+                        "(written to story.<name>.json / full_story.<name>.txt)")
+    p.add_argument("--out_json", default="story.json", help="Output JSON path")
+    p.add_argument("--out_txt", default="full_story.txt", help="Output full story text path")
+    p.add_argument("--model", default=None,
+                   help=f"HF model id (default: {DEFAULT_MODEL} with CUDA, {DEFAULT_CPU_MODEL} on CPU)")
+    p.add_argument("--model_path", default=None,
+                   help="Local snapshot of --model to load instead of resolving it on the Hub "
+                        "(--model still names the calibration, caches and checkpoints)")
+    p.add_argument("--no_4bit", action="store_true", help="Disable 4-bit quantization")
+    p.add_argument("--cpu_quant", choices=["int8", "int4", "none"], default="int8",
+                   help="Weight-only quantization when running without CUDA")
+    p.add_argument("--threads", type=int, default=None, help="CPU threads (default: physical cores)")
+    p.add_argument("--draft_model", default=None,
+                   help="Small model with the same tokenizer for assisted (speculative) decoding")
+    p.add_argument("--draft_tokens", type=int, default=None,
+                   help="Tokens the draft proposes per step (default: transformers' adaptive schedule)")
+    p.add_argument("--draft_compare", action="store_true",
+                   help="Also time every fragment without the draft and report the speedup (doubles the run time)")
+    p.add_argument("--quantized_dir", default=None,
+                   help="Save the quantized model here on first use and load it from here afterwards")
+    p.add_argument("--words", type=int, default=90, help="Target words per fragment (no mid-word cuts)")
+    p.add_argument("--temperature", type=float, default=0.65)
+    p.add_argument("--top_p", type=float, default=0.9)
+    p.add_argument("--seed", type=int, default=None)
+    p.add_argument("--print_live", action="store_true",
+                   help="Stream each fragment to the console sentence by sentence while it is generated")
+    p.add_argument("--osc_stream", default=None, nargs="+", metavar="HOST:PORT",
+                   help="Also send each streamed sentence as OSC /sentence [id, mood, text] to these receivers "
+                        "(e.g. 127.0.0.1:5005 for the sketch, 127.0.0.1:5006 for voice_server.py)")
+    p.add_argument("--no_prefix_cache", action="store_true",
+                   help="Prefill the full prompt for every fragment (disable shared-prefix KV reuse)")
+    p.add_argument("--prefix_cache_dir", default=None,
+                   help="Persist the shared-prefix KV cache here (per model) and reuse it on later runs")
+    p.add_argument("--no_word_stop", action="store_true",
+                   help="Decode up to max_new_tokens instead of stopping at the first sentence end after --words")
+    p.add_argument("--mode", choices=["sequential", "outline"], default="sequential",
+                   help="sequential: each scene sees the previous one; outline: plan all scenes in one call, "
+                        "then generate them together in batched calls")
+    p.add_argument("--batch_size", type=int, default=8,
+                   help="Sequences per batched generate call (--mode outline scenes, or stories with several --segments)")
+    p.add_argument("--compare_sequential", action="store_true",
+                   help="After --mode outline or a multi-story run, also run the sequential mode and report both wall times")
+    p.add_argument("--free_format", action="store_true",
+                   help="Do not constrain the MOOD/TEXT/FACTS headers (let the model write them and parse afterwards)")
+    p.add_argument("--long_form", action="store_true",
+                   help="Sequential mode for long sets (hundreds of segments): prompts carry a rolling summary of the "
+                        "story, capped at --memory_tokens, instead of growing or losing the thread")
+    p.add_argument("--memory_tokens", type=int, default=160, help="Token budget of the --long_form summary")
+    p.add_argument("--memory_every", type=int, default=4,
+                   help="Fold the latest scenes into the --long_form summary every N fragments")
+    p.add_argument("--checkpoint_dir", default=None,
+                   help="Save every finished fragment here and reuse the ones whose model, settings and input "
+                        "chain are unchanged (resume a crashed run, regenerate only from the first edited segment). "
+                        "With --seed a resumed run writes the same story as an uninterrupted one; in outline / "
+                        "lockstep mode only with the same --batch_size, since scenes are sampled batch by batch")
+    p.add_argument("--telemetry", action="store_true",
+                   help="Write per-fragment metrics (tokens, prefill/decode time, tok/s, parse fallbacks) and a "
+                        "summary block into the output JSON")
+    p.add_argument("--calibration", default=str(Path(__file__).with_name("tokens_per_word.json")),
+                   help="Per-model tokens/word learned from past runs (sizes max_new_tokens); updated after each run")
+    args = p.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+        torch.manual_seed(args.seed)
+        if torch.cuda.is_available():
+            torch.cuda.manual_seed_all(args.seed)
+
+    stories = [load_segments(path) for path in args.segments]
+    names = [Path(path).stem for path in args.segments]
+    if len(set(names)) != len(names):
+        names = [f"{i + 1}-{name}" for i, name in enumerate(names)]
+    if len(stories) > 1 and args.mode != "sequential":
+        p.error("several --segments files run in lockstep; --mode outline takes a single file")
+    if args.long_form and (len(stories) > 1 or args.mode != "sequential"):
+        p.error("--long_form works with --mode sequential and a single --segments file")
+    segments = stories[0]
+
+    if args.model is None:
+        args.model = DEFAULT_MODEL if torch.cuda.is_available() else DEFAULT_CPU_MODEL
+    print(f"Loading model: {args.model}")
+    model, tokenizer = load_model(
+        args.model,
+        use_4bit=(not args.no_4bit),
+        cpu_quant=args.cpu_quant,
+        threads=args.threads,
+        quantized_dir=args.quantized_dir,
+        model_path=args.model_path,
+    )
+    inst = inst_template(tokenizer)
+    if inst != MISTRAL_INST:
+        print("[prompt] using the tokenizer's chat template")
+
+    draft = None
+    if args.draft_model:
+        print(f"Loading draft model: {args.draft_model}")
+        draft, draft_tokenizer = load_model(
+            args.draft_model,
+            use_4bit=False,
+            cpu_quant=args.cpu_quant,
+            threads=args.threads,
+            quantized_dir=args.quantized_dir,
+        )
+        if draft_tokenizer.get_vocab() != tokenizer.get_vocab():
+            raise ValueError(f"--draft_model {args.draft_model} does not share the tokenizer of {args.model}.")
+        if args.draft_tokens:
+            draft.generation_config.num_assistant_tokens = args.draft_tokens
+            draft.generation_config.num_assistant_tokens_schedule = "constant"
+
+    prefix = None
+    if not args.no_prefix_cache:
+        prefix = PrefixCache(model, tokenizer, args.model, build_prompt_prefix(args.words, inst), args.prefix_cache_dir)
+
+    osc = None
+    if args.osc_stream:
+        osc = OscTargets(args.osc_stream)
+    stream = args.print_live or osc is not None
+
+    tokens_per_word = calibrated_tokens_per_word(load_calibration(args.calibration), args.model)
+    base_max_new_tokens = estimate_max_new_tokens(args.words, tokens_per_word)
+    if tokens_per_word is not None:
+        print(f"[calib] {tokens_per_word:.2f} tokens/word -> max_new_tokens {base_max_new_tokens}")
+
+    ckpt = None
+    if args.checkpoint_dir:
+        mode = "lockstep" if len(stories) > 1 else args.mode
+        ckpt = FragmentCheckpoints(args.checkpoint_dir, model, args.model, args, mode)
+
+    if len(stories) > 1:
+        t0 = time.perf_counter()
+        all_fragments, records = run_multi(
+            model, tokenizer, stories, names, args, base_max_new_tokens, prefix=prefix, inst=inst, ckpt=ckpt
+        )
+        wall_s = time.perf_counter() - t0
+        n_frags = sum(len(frags) for frags in all_fragments)
+        print(f"[time] lockstep: {len(stories)} stories, {n_frags} fragments in {wall_s:.2f}s")
+        if args.compare_sequential:
+            t0 = time.perf_counter()
+            for segs in stories:
+                run_sequential(model, tokenizer, segs, args, base_max_new_tokens, prefix=prefix, draft=draft, quiet=True,
+                               inst=inst)
+            seq_s = time.perf_counter() - t0
+            print(f"[time] one story at a time: {n_frags} fragments in {seq_s:.2f}s (lockstep speedup {seq_s / wall_s:.2f}x)")
+        print_summary(records, args)
+        for name, frags in zip(names, all_fragments):
+            story_records = [r for r in records if r["story"] == name] if args.telemetry else None
+            save_story(frags, *story_out_paths(args.out_json, args.out_txt, name), records=story_records, args=args)
+        return
+
+    run = dict(
+        model=model,
+        tokenizer=tokenizer,
+        segments=segments,
+        args=args,
+        base_max_new_tokens=base_max_new_tokens,
+        prefix=prefix,
+        osc=osc,
+        inst=inst,
+    )
+    t0 = time.perf_counter()
+    if args.mode == "outline":
+        if draft is not None:
+            print("[draft] assisted decoding works on one sequence at a time; not used for batched scenes")
+        fragments, records = run_outline(**run, ckpt=ckpt)
+    else:
+        fragments, records = run_sequential(**run, draft=draft, ckpt=ckpt)
+    wall_s = time.perf_counter() - t0
+    print(f"[time] {args.mode}: {len(fragments)} fragments in {wall_s:.2f}s")
+
+    if args.compare_sequential and args.mode != "sequential":
+        t0 = time.perf_counter()
+        run_sequential(**{**run, "osc": None}, draft=draft, quiet=True)
+        seq_s = time.perf_counter() - t0
+        print(f"[time] sequential: {len(fragments)} fragments in {seq_s:.2f}s ({args.mode} speedup {seq_s / wall_s:.2f}x)")
+
+    print_summary(records, args, draft)
+    save_story(fragments, args.out_json, args.out_txt, records=records if args.telemetry else None, args=args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,530 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local story-generation service: the model stays loaded and the fragments of
+any number of shows are generated together with continuous batching.
+
+Every decode step is one forward over all in-flight fragments. A request that
+arrives meanwhile is prefilled on its own (reusing the shared-prefix KV cache)
+and joins the running batch at the next step; a finished fragment leaves it at
+once. Nobody waits for the slowest fragment of a batch, and nobody waits for a
+batch to fill up.
+
+  POST /fragment  {"show": "A", "music_prompt": "...", "last": false}
+                  -> {"show", "fragment": {"id", "mood", "text"}, "timing": {...}}
+  POST /reset     {"show": "A"}    forget a show's story so far
+  GET  /stats     queue wait, time to first token, throughput, batch size
+
+Each show continues like run_sequential: fragment 1 writes the FACTS, later
+fragments see them and the previous scene.
+
+  python story_server.py --port 5010
+  python story_server.py --model /path/to/small-model --bench_clients 4   # self-contained load test
+"""
+
+import argparse
+import collections
+import json
+import queue
+import statistics
+import threading
+import time
+import traceback
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import torch
+from transformers import DynamicCache, TemperatureLogitsWarper, TopPLogitsWarper
+
+from story_from_description import (
+    DEFAULT_CPU_MODEL,
+    DEFAULT_MODEL,
+    MISTRAL_INST,
+    HeaderFormatProcessor,
+    PrefixCache,
+    WordBudgetStopping,
+    _cache_layers,
+    _prepare_inputs,
+    build_prompt_first,
+    build_prompt_next,
+    build_prompt_prefix,
+    calibrated_tokens_per_word,
+    estimate_max_new_tokens,
+    finish_fragment,
+    inst_template,
+    load_calibration,
+    load_model,
+    load_segments,
+)
+
+
+class FragmentRequest:
+    """One fragment to generate; the HTTP thread waits on done."""
+
+    def __init__(self, label: str, seg_id: int, prompt: str, max_new_tokens: int, need_facts: bool):
+        self.label = label
+        self.seg_id = seg_id
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.need_facts = need_facts
+        self.t_arrival = time.perf_counter()
+        self.t_first: Optional[float] = None
+        self.ids: List[int] = []
+        self.position = 0  # position of the next token fed to the model
+        self.header: Optional[HeaderFormatProcessor] = None
+        self.stop: Optional[WordBudgetStopping] = None
+        self.stats: Dict[str, Any] = {"max_new_tokens": max_new_tokens}
+        self.result = None  # (fragment, facts, record) from finish_fragment
+        self.error: Optional[str] = None
+        self.done = threading.Event()
+
+
+def _summary(values) -> Dict[str, float]:
+    values = sorted(values)
+    if not values:
+        return {}
+    return {
+        "mean": round(statistics.fmean(values), 4),
+        "p50": round(values[len(values) // 2], 4),
+        "p95": round(values[min(len(values) - 1, int(0.95 * len(values)))], 4),
+    }
+
+
+class ContinuousBatcher:
+    """
+    Owns the model: a single worker thread admits queued requests between
+    decode steps and runs every step over all active rows. Rows have different
+    lengths; the batch KV cache is left-padded to the longest row, the padding
+    is masked out and every row gets its own position ids.
+    """
+
+    def __init__(self, model, tokenizer, args, prefix: Optional[PrefixCache] = None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.args = args
+        self.prefix = prefix
+        self.max_batch = max(1, args.max_batch)
+        self.warpers = [TemperatureLogitsWarper(args.temperature), TopPLogitsWarper(args.top_p)]
+        self.queue: "queue.Queue[FragmentRequest]" = queue.Queue()
+        self.rows: List[FragmentRequest] = []
+        self.cache: Optional[DynamicCache] = None
+        self.mask: Optional[torch.Tensor] = None
+
+        self.lock = threading.Lock()
+        self.t_start = time.perf_counter()
+        self.completed = 0
+        self.tokens = 0
+        self.busy_s = 0.0
+        self.steps = 0
+        self.step_rows = 0
+        self.queue_wait = collections.deque(maxlen=1000)
+        self.ttft = collections.deque(maxlen=1000)
+
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def submit(self, req: FragmentRequest) -> None:
+        self.queue.put(req)
+
+    # ---------- worker ----------
+
+    def _loop(self) -> None:
+        while True:
+            if not self.rows:
+                pending = [self.queue.get()]  # idle: block until there is work
+            else:
+                pending = []
+            while len(self.rows) + len(pending) < self.max_batch:
+                try:
+                    pending.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            t0 = time.perf_counter()
+            try:
+                with torch.inference_mode():
+                    for req in pending:
+                        self._admit(req)
+                    if self.rows:
+                        self._step()
+            except Exception:
+                err = traceback.format_exc()
+                print(f"[server] generation failed:\n{err}", flush=True)
+                for req in self.rows + pending:
+                    if not req.done.is_set():
+                        req.error = err.strip().splitlines()[-1]
+                        req.done.set()
+                self.rows, self.cache, self.mask = [], None, None
+            with self.lock:
+                self.busy_s += time.perf_counter() - t0
+
+    def _admit(self, req: FragmentRequest) -> None:
+        """Prefill one request alone, sample its first token and add it to the batch."""
+        t0 = time.perf_counter()
+        req.stats["queue_wait_s"] = t0 - req.t_arrival
+        inputs, past = _prepare_inputs(self.model, self.tokenizer, req.prompt, self.prefix)
+        n_prompt = inputs["input_ids"].shape[-1]
+        n_cached = len(self.prefix) if past is not None else 0
+        out = self.model(
+            input_ids=inputs["input_ids"][:, n_cached:],  # generate() skips the cached part itself; we must too
+            attention_mask=inputs["attention_mask"],
+            past_key_values=past if past is not None else DynamicCache(),
+            use_cache=True,
+        )
+        req.position = n_prompt
+        if not self.args.free_format:
+            req.header = HeaderFormatProcessor(self.tokenizer, 0, None if self.args.no_word_stop else self.args.words,
+                                               req.need_facts)
+        if not self.args.no_word_stop:
+            req.stop = WordBudgetStopping(self.tokenizer, 0, self.args.words, req.need_facts)
+        req.stats.update({
+            "prompt_tokens": int(n_prompt),
+            "cached_prompt_tokens": n_cached,
+        })
+
+        token = self._sample([req], out.logits[:, -1, :])[0]
+        req.t_first = time.perf_counter()
+        req.stats["prefill_s"] = req.t_first - t0
+        req.stats["ttft_s"] = req.t_first - req.t_arrival
+        if self._accept(req, token):
+            self._finish(req)
+            return
+        self._join(req, out.past_key_values, n_prompt)
+
+    def _join(self, req: FragmentRequest, row_cache, n_prompt: int) -> None:
+        row_layers = _cache_layers(row_cache)
+        row_mask = torch.ones(1, n_prompt, dtype=torch.long, device=self.model.device)
+        if self.cache is None:
+            self.rows, self.cache, self.mask = [req], row_cache, row_mask
+            return
+        width = max(self.mask.shape[1], n_prompt)
+        layers = [
+            (torch.cat([_left_pad(k, width), _left_pad(rk, width)]), torch.cat([_left_pad(v, width), _left_pad(rv, width)]))
+            for (k, v), (rk, rv) in zip(_cache_layers(self.cache), row_layers)
+        ]
+        self.mask = torch.cat([_left_pad_mask(self.mask, width), _left_pad_mask(row_mask, width)])
+        self.cache = _build_cache(layers)
+        self.rows.append(req)
+
+    def _step(self) -> None:
+        """One decode step for every active row."""
+        dev = self.model.device
+        input_ids = torch.tensor([[r.ids[-1]] for r in self.rows], device=dev)
+        position_ids = torch.tensor([[r.position] for r in self.rows], device=dev)
+        self.mask = torch.cat([self.mask, self.mask.new_ones(len(self.rows), 1)], dim=1)
+        out = self.model(
+            input_ids=input_ids,
+            attention_mask=self.mask,
+            position_ids=position_ids,
+            past_key_values=self.cache,
+            use_cache=True,
+        )
+        self.cache = out.past_key_values
+        with self.lock:
+            self.steps += 1
+            self.step_rows += len(self.rows)
+
+        finished = []
+        for req, token in zip(self.rows, self._sample(self.rows, out.logits[:, -1, :])):
+            req.position += 1
+            if self._accept(req, token):
+                finished.append(req)
+        if finished:
+            self._drop(finished)
+
+    def _sample(self, rows: List[FragmentRequest], logits: torch.Tensor) -> List[int]:
+        scores = logits.float()
+        for i, req in enumerate(rows):
+            if req.header is not None:
+                generated = torch.tensor([req.ids], dtype=torch.long)
+                scores[i:i + 1] = req.header(generated, scores[i:i + 1])
+        for warper in self.warpers:
+            scores = warper(None, scores)
+        probs = torch.softmax(scores, dim=-1)
+        return torch.multinomial(probs, num_samples=1)[:, 0].tolist()
+
+    def _accept(self, req: FragmentRequest, token: int) -> bool:
+        """Append token; True when the fragment is complete."""
+        req.ids.append(token)
+        if token == self.tokenizer.eos_token_id or len(req.ids) >= req.max_new_tokens:
+            return True
+        return req.stop is not None and bool(req.stop(torch.tensor([req.ids]), None)[0])
+
+    def _drop(self, finished: List[FragmentRequest]) -> None:
+        keep = [i for i, r in enumerate(self.rows) if r not in finished]
+        if keep:
+            idx = torch.tensor(keep, device=self.model.device)
+            mask = self.mask[idx]
+            first = int((mask.sum(dim=0) > 0).nonzero()[0, 0])  # columns that are padding in every row left
+            self.cache = _build_cache([(k[idx, :, first:], v[idx, :, first:]) for k, v in _cache_layers(self.cache)])
+            self.mask = mask[:, first:]
+            self.rows = [self.rows[i] for i in keep]
+        else:
+            self.rows, self.cache, self.mask = [], None, None
+        for req in finished:
+            self._finish(req)
+
+    def _finish(self, req: FragmentRequest) -> None:
+        t_end = time.perf_counter()
+        req.stats.update({
+            "generated_tokens": len(req.ids),
+            "decode_s": t_end - req.t_first,
+            "total_s": t_end - req.t_arrival,
+        })
+        raw = self.tokenizer.decode(req.ids, skip_special_tokens=True).strip()
+        req.result = finish_fragment(req.seg_id, raw, req.stats, self.tokenizer, self.args.words, label=req.label,
+                                     need_facts=req.need_facts)
+        with self.lock:
+            self.completed += 1
+            self.tokens += len(req.ids)
+            self.queue_wait.append(req.stats["queue_wait_s"])
+            self.ttft.append(req.stats["ttft_s"])
+        req.done.set()
+
+    # ---------- metrics ----------
+
+    def metrics(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "completed": self.completed,
+                "active": len(self.rows),
+                "queued": self.queue.qsize(),
+                "generated_tokens": self.tokens,
+                "busy_s": round(self.busy_s, 3),
+                "uptime_s": round(time.perf_counter() - self.t_start, 3),
+                "throughput_tok_s": round(self.tokens / self.busy_s, 2) if self.busy_s else 0.0,
+                "mean_batch_size": round(self.step_rows / self.steps, 2) if self.steps else 0.0,
+                "queue_wait_s": _summary(self.queue_wait),
+                "ttft_s": _summary(self.ttft),
+            }
+
+
+def _left_pad(x: torch.Tensor, width: int) -> torch.Tensor:
+    """(B, H, T, D) cache tensor -> (B, H, width, D), zeros in front."""
+    n = width - x.shape[2]
+    if n <= 0:
+        return x
+    return torch.cat([x.new_zeros(x.shape[0], x.shape[1], n, x.shape[3]), x], dim=2)
+
+
+def _left_pad_mask(mask: torch.Tensor, width: int) -> torch.Tensor:
+    n = width - mask.shape[1]
+    if n <= 0:
+        return mask
+    return torch.cat([mask.new_zeros(mask.shape[0], n), mask], dim=1)
+
+
+def _build_cache(layers) -> DynamicCache:
+    cache = DynamicCache()
+    for i, (k, v) in enumerate(layers):
+        cache.update(k, v, i)
+    return cache
+
+
+class StoryService:
+    """Per-show story state on top of the batcher (requests of one show run in order)."""
+
+    def __init__(self, batcher: ContinuousBatcher, args, base_max_new_tokens: int, inst=MISTRAL_INST):
+        self.batcher = batcher
+        self.args = args
+        self.inst = inst
+        self.base_max_new_tokens = base_max_new_tokens
+        self.shows: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+
+    def _show(self, show: str) -> Dict[str, Any]:
+        with self.lock:
+            if show not in self.shows:
+                self.shows[show] = {"lock": threading.Lock(), "n": 0, "prev_text": "", "facts": ""}
+            return self.shows[show]
+
+    def reset(self, show: str) -> None:
+        with self.lock:
+            self.shows.pop(show, None)
+
+    def next_fragment(self, show: str, music_prompt: str, last: bool = False) -> Dict[str, Any]:
+        st = self._show(show)
+        with st["lock"]:
+            idx = st["n"]
+            if idx == 0:
+                prompt = build_prompt_first(music_prompt, self.args.words, self.inst)
+            else:
+                prompt = build_prompt_next(st["prev_text"], st["facts"], music_prompt, self.args.words, last,
+                                           inst=self.inst)
+            max_new_tokens = self.base_max_new_tokens + (60 if idx == 0 else 0) + (40 if last else 0)
+            req = FragmentRequest(f"{show}#{idx + 1}", idx + 1, prompt, max_new_tokens, need_facts=(idx == 0))
+            self.batcher.submit(req)
+            req.done.wait()
+            if req.error:
+                raise RuntimeError(req.error)
+
+            fragment, facts, record = req.result
+            if idx == 0 and facts.strip():
+                st["facts"] = facts
+            st["prev_text"] = fragment["text"]
+            st["n"] = idx + 1
+
+        timing = {k: record[k] for k in (
+            "queue_wait_s", "ttft_s", "prefill_s", "decode_s", "total_s",
+            "prompt_tokens", "cached_prompt_tokens", "generated_tokens", "kept_tokens", "parse_fallback",
+        )}
+        timing["tok_per_s"] = round(record["generated_tokens"] / max(record["decode_s"], 1e-9), 2)
+        return {"show": show, "fragment": fragment, "timing": timing}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def _reply(self, code: int, body: Dict[str, Any]) -> None:
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._reply(200, self.server.service.batcher.metrics())
+        else:
+            self._reply(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except json.JSONDecodeError as e:
+            self._reply(400, {"error": f"bad JSON: {e}"})
+            return
+        service = self.server.service
+        show = str(body.get("show", "default"))
+        if self.path == "/fragment":
+            if not str(body.get("music_prompt", "")).strip():
+                self._reply(400, {"error": "music_prompt is required"})
+                return
+            try:
+                self._reply(200, service.next_fragment(show, str(body["music_prompt"]).strip(), bool(body.get("last"))))
+            except RuntimeError as e:
+                self._reply(500, {"error": str(e)})
+        elif self.path == "/reset":
+            service.reset(show)
+            self._reply(200, {"show": show, "reset": True})
+        else:
+            self._reply(404, {"error": f"unknown path {self.path}"})
+
+    def log_message(self, fmt, *args):
+        pass  # the [gen] lines already log every fragment
+
+
+def _post(url: str, body: Dict[str, Any]) -> Dict[str, Any]:
+    req = urllib.request.Request(url, json.dumps(body).encode("utf-8"), {"Content-Type": "application/json"})
+    with urllib.request.urlopen(req) as resp:
+        return json.loads(resp.read())
+
+
+def run_bench(base_url: str, music: List[str], clients: int, fragments: int) -> None:
+    """clients concurrent shows, each asking for its fragments one after the other."""
+
+    def show(k: int) -> None:
+        for i in range(fragments):
+            try:
+                _post(f"{base_url}/fragment", {
+                    "show": f"bench{k}",
+                    "music_prompt": music[(k + i) % len(music)],
+                    "last": i == fragments - 1,
+                })
+            except urllib.error.HTTPError as e:
+                print(f"[bench] show bench{k}: {e.code} {e.read().decode('utf-8', 'replace')}")
+                return
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=show, args=(k,)) for k in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall_s = time.perf_counter() - t0
+
+    with urllib.request.urlopen(f"{base_url}/stats") as resp:
+        stats = json.loads(resp.read())
+    print(json.dumps(stats, indent=2))
+    print(
+        f"[bench] {clients} shows x {fragments} fragments in {wall_s:.2f}s: "
+        f"{stats['generated_tokens'] / wall_s:.1f} tok/s, mean batch {stats['mean_batch_size']}, "
+        f"TTFT p50 {stats['ttft_s'].get('p50', 0):.2f}s, queue wait p50 {stats['queue_wait_s'].get('p50', 0):.2f}s"
+    )
+
+
+def main():
+    p = argparse.ArgumentParser(description="Local story-generation server with continuous batching (HTTP on localhost).")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=5010)
+    p.add_argument("--model", default=None,
+                   help=f"HF model id or local path (default: {DEFAULT_MODEL} with CUDA, {DEFAULT_CPU_MODEL} on CPU)")
+    p.add_argument("--model_path", default=None, help="Local snapshot of --model (no Hub lookup)")
+    p.add_argument("--no_4bit", action="store_true", help="Disable 4-bit quantization")
+    p.add_argument("--cpu_quant", choices=["int8", "int4", "none"], default="int8",
+                   help="Weight-only quantization when running without CUDA")
+    p.add_argument("--threads", type=int, default=None, help="CPU threads (default: physical cores)")
+    p.add_argument("--quantized_dir", default=None,
+                   help="Save the quantized model here on first use and load it from here afterwards")
+    p.add_argument("--max_batch", type=int, default=16, help="Fragments decoded together at most")
+    p.add_argument("--words", type=int, default=90, help="Target words per fragment")
+    p.add_argument("--temperature", type=float, default=0.65)
+    p.add_argument("--top_p", type=float, default=0.9)
+    p.add_argument("--seed", type=int, default=None)
+    p.add_argument("--no_prefix_cache", action="store_true", help="Prefill the full prompt of every request")
+    p.add_argument("--no_word_stop", action="store_true", help="Decode up to max_new_tokens")
+    p.add_argument("--free_format", action="store_true", help="Do not constrain the MOOD/TEXT/FACTS headers")
+    p.add_argument("--calibration", default=str(Path(__file__).with_name("tokens_per_word.json")),
+                   help="Tokens/word file written by story_from_description.py (sizes max_new_tokens)")
+    p.add_argument("--bench_clients", type=int, default=0,
+                   help="Load test: start the server, run this many concurrent shows against it, print the stats, exit")
+    p.add_argument("--bench_fragments", type=int, default=3, help="Fragments per show for --bench_clients")
+    p.add_argument("--segments", default=str(Path(__file__).with_name("segments.json")),
+                   help="Music prompts for --bench_clients")
+    args = p.parse_args()
+
+    if args.seed is not None:
+        torch.manual_seed(args.seed)
+    if args.model is None:
+        args.model = DEFAULT_MODEL if torch.cuda.is_available() else DEFAULT_CPU_MODEL
+    print(f"Loading model: {args.model}")
+    model, tokenizer = load_model(
+        args.model,
+        use_4bit=(not args.no_4bit),
+        cpu_quant=args.cpu_quant,
+        threads=args.threads,
+        quantized_dir=args.quantized_dir,
+        model_path=args.model_path,
+    )
+    inst = inst_template(tokenizer)
+    if inst != MISTRAL_INST:
+        print("[prompt] using the tokenizer's chat template")
+    prefix = None
+    if not args.no_prefix_cache:
+        prefix = PrefixCache(model, tokenizer, args.model, build_prompt_prefix(args.words, inst))
+
+    tokens_per_word = calibrated_tokens_per_word(load_calibration(args.calibration), args.model)
+    batcher = ContinuousBatcher(model, tokenizer, args, prefix)
+    service = StoryService(batcher, args, estimate_max_new_tokens(args.words, tokens_per_word), inst)
+
+    server = ThreadingHTTPServer((args.host, args.port), _Handler)
+    server.daemon_threads = True
+    server.service = service
+    base_url = f"http://{args.host}:{server.server_address[1]}"
+    print(f"[server] listening on {base_url} (max batch {batcher.max_batch})", flush=True)
+
+    if args.bench_clients:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        music = [seg["music_prompt"].strip() for seg in load_segments(args.segments)]
+        run_bench(base_url, music, args.bench_clients, args.bench_fragments)
+        server.shutdown()
+        return
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n[server] stopped")
+
+
+if __name__ == "__main__":
+    main()